@@ -1,7 +1,37 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-from classify import predict_with_uncertainty, get_prediction_explanation
-import traceback
+import metrics
+from classify import (CASCADE_BY_DEFAULT, AdaptiveSampling, Cascade, ModelNotLoaded, ModelVersion,
+                      TestTimeAugmentation, mc_config_tag, predict_with_uncertainty, iter_batch_predictions,
+                      get_prediction_explanation, get_registry, seed_from_params)
+from batching import USE_MICRO_BATCHING, get_batcher
+from cache import get_cache
+from workers import NUM_WORKERS, get_pool
+from uploads import (ALLOWED_EXTENSIONS, MAX_FILE_SIZE, check_image_header, detach_uploads, iter_batch_files,
+                     get_extension)
+from collections import deque
+import hmac
+import json
+import logging
+import os
+import time
+
+# ✅ Set BAYESDR_ADAPTIVE_MC=1 to sample until convergence unless ?adaptive=0
+ADAPTIVE_BY_DEFAULT = os.environ.get("BAYESDR_ADAPTIVE_MC", "0") == "1"
+
+# ✅ Serving mode: BAYESDR_WORKERS=N runs inference in N worker processes
+# Memory per process: the result cache (BAYESDR_CACHE_MB, default 256) lives in this
+# process only; each worker holds up to BAYESDR_MAX_LOADED_MODELS models instead.
+# Under gunicorn every server process has its own cache.
+USE_WORKER_POOL = NUM_WORKERS > 0
+REQUEST_TIMEOUT = 120  # seconds
+PORT = int(os.environ.get("BAYESDR_PORT", "5500"))
+
+# ✅ Model admin endpoints (/api/models/...) need "Authorization: Bearer <token>"; unset = disabled
+ADMIN_TOKEN = os.environ.get("BAYESDR_ADMIN_TOKEN", "")
+
+metrics.configure_logging()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
@@ -12,6 +42,86 @@ CORS(app, origins=[
     "http://localhost:3001"  # Backup port
 ])
 
+@app.before_request
+def _begin_trace():
+    g.trace, g.trace_token = metrics.begin_request(request.headers.get("X-Request-ID"))
+
+@app.after_request
+def _finish_trace(response):
+    """Tag the response with its request ID and stage timings, record metrics."""
+    trace = g.get("trace")
+    if trace is not None:
+        response.headers["X-Request-ID"] = trace.request_id
+        if trace.stages:
+            response.headers["Server-Timing"] = trace.server_timing()
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.finish_request(trace, endpoint, response.status_code)
+    return response
+
+@app.teardown_request
+def _release_trace(exc):
+    # After a streamed response has been sent, not when the headers go out
+    token = g.pop("trace_token", None)
+    if token is not None:
+        metrics.release_request(token)
+
+def _adaptive_from_request(default=ADAPTIVE_BY_DEFAULT):
+    """
+    Read adaptive MC Dropout settings from the query string.
+    
+    Query: adaptive=1, plus optional tolerance, min_iterations, max_iterations
+    Returns: AdaptiveSampling, or None for the fixed 30-iteration mode
+    Raises: ValueError for invalid settings
+    """
+    return AdaptiveSampling.from_params(request.args, default=default)
+
+def _mc_settings_from_request():
+    """
+    Read the MC Dropout settings from the query string.
+    
+    Query: adaptive settings (see _adaptive_from_request), seed=image|<int>|random
+           for reproducible (seeded) or stochastic dropout masks, tta=1
+           (optional tta_views) for test-time augmentation, and cascade=1|0
+           (optional cascade_confidence, cascade_uncertainty, cascade_max_entropy)
+    Returns: Tuple of (AdaptiveSampling or None, seed, TestTimeAugmentation or None, Cascade or None)
+    Raises: ValueError for invalid settings
+    """
+    tta = TestTimeAugmentation.from_params(request.args)
+    # TTA replaces the adaptive default, but not an explicit ?adaptive=1
+    adaptive = _adaptive_from_request(default=ADAPTIVE_BY_DEFAULT and tta is None)
+    cascade = Cascade.from_params(request.args, default=CASCADE_BY_DEFAULT)
+    mc_config_tag(30, adaptive, tta)  # Rejects unsupported combinations
+    return adaptive, seed_from_params(request.args), tta, cascade
+
+def _model_from_request():
+    """
+    Pick the model version for this request.
+    
+    Query: model=<name> for a registered version; otherwise the candidate
+           version for its share of the traffic, else the active one
+    Returns: Version name
+    Raises: ValueError for unknown versions; ModelNotLoaded for a version
+            that is not in memory (requests never wait for a model to load)
+    """
+    return get_registry().route(request.args.get("model"))
+
+def _tag_result(result, model):
+    """Record which model version produced a result, in the result and in the metrics."""
+    result["model_version"] = model
+    metrics.MODEL_PREDICTIONS.inc(version=model, class_name=result["class_name"])
+
+def _predict(image_bytes, adaptive=None, seed=None, tta=None, cascade=None, model=None):
+    """Run one prediction on the worker pool, the micro-batcher, or in-line."""
+    if USE_WORKER_POOL:
+        return get_pool().predict(image_bytes, n_iterations=30, adaptive=adaptive, seed=seed, tta=tta,
+                                  cascade=cascade, model=model, timeout=REQUEST_TIMEOUT)
+    if USE_MICRO_BATCHING:
+        # Shares one backbone pass with concurrent requests
+        return get_batcher().predict(image_bytes, n_iterations=30, adaptive=adaptive, seed=seed, tta=tta,
+                                     cascade=cascade, model=model, timeout=REQUEST_TIMEOUT)
+    return predict_with_uncertainty(image_bytes, n_iterations=30, adaptive=adaptive, seed=seed, tta=tta,
+                                    cascade=cascade, model=model)
+
 @app.route("/", methods=["GET"])
 def index():
     """Health check endpoint."""
@@ -21,22 +131,48 @@ def index():
         "version": "1.0.0",
         "endpoints": {
             "health": "/ (GET)",
-            "classify": "/api/classify (POST)"
+            "classify": "/api/classify (POST)",
+            "classify_batch": "/api/classify/batch (POST)",
+            "models": "/api/models (GET)",
+            "metrics": "/api/metrics (GET)"
         }
     })
 
+@app.route("/api/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Request, stage and image counters/histograms in the Prometheus text format."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route("/api/health", methods=["GET"])
 def health():
     """Detailed health check with model status."""
     try:
-        from classify import load_model
-        model = load_model()
+        if USE_WORKER_POOL:
+            # The front process never loads the model; workers do
+            pool = get_pool()
+            return jsonify({
+                "status": "healthy" if pool.ready else "starting",
+                "model_loaded": pool.ready,
+                "model_version": get_registry().active,
+                "models": get_registry().stats(),
+                "workers": pool.stats(),
+                "cache": get_cache().stats()
+            }), 200 if pool.ready else 503
+        
+        from classify import get_model_info, get_startup_timings
+        info = get_model_info()
         
         return jsonify({
             "status": "healthy",
-            "model_loaded": model is not None,
-            "model_input_shape": str(model.input_shape) if model else None,
-            "model_output_shape": str(model.output_shape) if model else None
+            "model_loaded": True,
+            "model_version": info["model_version"],
+            "model_input_shape": info["input_shape"],
+            "model_output_shape": info["output_shape"],
+            "backbone_runtime": info["backbone_runtime"],
+            "models": get_registry().stats(),
+            "startup": get_startup_timings(),
+            "batching": get_batcher().stats() if USE_MICRO_BATCHING else None,
+            "cache": get_cache().stats()
         })
     except Exception as e:
         return jsonify({
@@ -44,24 +180,145 @@ def health():
             "error": str(e)
         }), 500
 
+def _admin_denied():
+    """An error response unless the request carries BAYESDR_ADMIN_TOKEN, else None."""
+    if not ADMIN_TOKEN:
+        return jsonify({
+            "success": False,
+            "error": "Forbidden",
+            "message": "Model admin endpoints are disabled; set BAYESDR_ADMIN_TOKEN to enable them"
+        }), 403
+    supplied = request.headers.get("Authorization", "").encode()
+    if not hmac.compare_digest(supplied, f"Bearer {ADMIN_TOKEN}".encode()):
+        return jsonify({
+            "success": False,
+            "error": "Unauthorized",
+            "message": "Missing or wrong admin token"
+        }), 401
+    return None
+
+def _preload():
+    """How a version is loaded before it gets traffic: here, or in every pool worker."""
+    return get_pool().follow if USE_WORKER_POOL else True
+
+def _register_from_body(name):
+    """Register `name` from an optional JSON {"path": ...} body (e.g. a new notebook checkpoint)."""
+    body = request.get_json(silent=True) or {}
+    if body.get("path"):
+        get_registry().register(ModelVersion.from_path(name, body["path"]), replace=True)
+    return body
+
+@app.route("/api/models", methods=["GET"])
+def list_models():
+    """Registered model versions with their state, the active one and the candidate."""
+    return jsonify(get_registry().stats())
+
+@app.route("/api/models/<name>/activate", methods=["POST"])
+def activate_model(name):
+    """
+    Hot-swap the active model version, without a restart.
+    
+    Expects: Authorization: Bearer <BAYESDR_ADMIN_TOKEN>; optional JSON
+             {"path": "..."} to register (or re-point) `name` first
+    Returns: 202 at once; the version loads and warms up in the background
+             and is swapped in when ready. In-flight requests finish on the
+             previous version. Follow progress in /api/models.
+    """
+    denied = _admin_denied()
+    if denied is not None:
+        return denied
+    
+    try:
+        _register_from_body(name)
+        get_registry().activate(name, preload=_preload())
+    except ValueError as e:
+        return jsonify({"success": False, "error": "Invalid model version", "message": str(e)}), 400
+    
+    logger.info("🔄 Activating model version %s", name)
+    return jsonify({"success": True, "activating": name, "models": get_registry().stats()}), 202
+
+@app.route("/api/models/<name>/candidate", methods=["POST"])
+def set_candidate_model(name):
+    """
+    Send a share of the traffic to a candidate version, to compare it with the active one.
+    
+    Expects: admin token (see activate_model); JSON {"percent": 10} (0 = only
+             requests with ?model=<name>), optional "path" as for activate
+    Returns: 202 at once; the candidate gets traffic once it is warmed up
+    """
+    denied = _admin_denied()
+    if denied is not None:
+        return denied
+    
+    try:
+        body = _register_from_body(name)
+        get_registry().set_candidate(name, body.get("percent", 0), preload=_preload())
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": "Invalid candidate", "message": str(e)}), 400
+    
+    return jsonify({"success": True, "candidate": name, "models": get_registry().stats()}), 202
+
+@app.route("/api/models/candidate", methods=["DELETE"])
+def clear_candidate_model():
+    """Stop routing traffic to the candidate version (admin token required)."""
+    denied = _admin_denied()
+    if denied is not None:
+        return denied
+    
+    get_registry().set_candidate(None, preload=_preload())
+    return jsonify({"success": True, "models": get_registry().stats()}), 200
+
 @app.route("/api/classify", methods=["POST"])
 def classify():
     """
     Classify a fundus image for Diabetic Retinopathy.
     
     Expects: multipart/form-data with 'image' file
-    Returns: JSON with prediction, confidence, uncertainty, and probabilities
+    Query:   adaptive=1 to draw MC samples until mean/std/entropy converge
+             (optional tolerance, min_iterations, max_iterations);
+             seed=image or seed=<int> for bit-reproducible results, seed=random
+             for stochastic ones (default: BAYESDR_MC_SEED);
+             tta=1 to also average over flipped/rotated views, with a
+             per-view breakdown (optional tta_views=identity,hflip,rot10,...);
+             cascade=1 to answer confident images from a cheap first pass and
+             run MC Dropout only on the rest (default: BAYESDR_CASCADE);
+             model=<version> to use a registered model version (see /api/models)
+    Returns: JSON with prediction, confidence, uncertainty, probabilities
+             and the model_version that produced them
     """
     try:
+        # ✅ Parse the multipart body (timed together with reading the image below)
+        upload_started = time.perf_counter()
+        files = request.files
+        
         # ✅ Validate request has files
-        if "image" not in request.files:
+        if "image" not in files:
             return jsonify({
                 "success": False,
                 "error": "No image uploaded",
                 "message": "Please upload an image file in 'image' field"
             }), 400
         
-        file = request.files["image"]
+        file = files["image"]
+        
+        # ✅ Validate MC Dropout settings
+        try:
+            adaptive, seed, tta, cascade = _mc_settings_from_request()
+            model = _model_from_request()
+            if cascade is not None:
+                cascade.check_runtime(get_registry().version(model).runtime)
+        except ModelNotLoaded as e:
+            return jsonify({
+                "success": False,
+                "error": "Model version not loaded",
+                "message": str(e)
+            }), 409
+        except ValueError as e:
+            return jsonify({
+                "success": False,
+                "error": "Invalid parameters",
+                "message": str(e)
+            }), 400
         
         # ✅ Check if file is empty
         if file.filename == "":
@@ -72,14 +329,13 @@ def classify():
             }), 400
         
         # ✅ Check file extension
-        allowed_extensions = {"png", "jpg", "jpeg", "bmp", "tiff"}
-        file_ext = file.filename.rsplit(".", 1)[-1].lower() if "." in file.filename else ""
+        file_ext = get_extension(file.filename)
         
-        if file_ext not in allowed_extensions:
+        if file_ext not in ALLOWED_EXTENSIONS:
             return jsonify({
                 "success": False,
                 "error": "Invalid file type",
-                "message": f"Allowed types: {', '.join(allowed_extensions).upper()}",
+                "message": f"Allowed types: {', '.join(ALLOWED_EXTENSIONS).upper()}",
                 "received": file_ext
             }), 400
         
@@ -88,22 +344,18 @@ def classify():
         file_size = file.tell()  # Get size
         file.seek(0)  # Reset to start
         
-        max_size = 10 * 1024 * 1024  # 10MB
-        if file_size > max_size:
+        if file_size > MAX_FILE_SIZE:
             return jsonify({
                 "success": False,
                 "error": "File too large",
                 "message": f"Maximum file size is 10MB. Your file: {file_size / (1024*1024):.2f}MB"
             }), 400
         
-        print(f"\n{'='*70}")
-        print(f"📥 Received image: {file.filename}")
-        print(f"   Size: {file_size / 1024:.2f} KB")
-        print(f"   Type: {file_ext}")
-        print(f"{'='*70}")
+        logger.debug("📥 Received image: %s (%.2f KB, %s)", file.filename, file_size / 1024, file_ext)
         
         # ✅ Read image bytes
         image_bytes = file.read()
+        metrics.record_stage("upload_read", time.perf_counter() - upload_started)
         
         # ✅ Validate image bytes
         if len(image_bytes) == 0:
@@ -113,11 +365,14 @@ def classify():
                 "message": "The uploaded file appears to be empty"
             }), 400
         
-        print(f"✅ Image loaded: {len(image_bytes)} bytes")
+        # ✅ Validate the image header (format, dimensions, mode) before decoding anything
+        error = check_image_header(image_bytes)
+        if error is not None:
+            return jsonify({"success": False, **error}), 400
         
-        # ✅ Get prediction with uncertainty (30 MC iterations)
-        print("🔄 Starting prediction...")
-        result = predict_with_uncertainty(image_bytes, n_iterations=30)
+        # ✅ Get prediction with uncertainty (30 MC iterations, or adaptive)
+        result = _predict(image_bytes, adaptive, seed, tta, cascade, model)
+        _tag_result(result, model)
         
         # ✅ Add explanation
         explanation = get_prediction_explanation(result)
@@ -128,18 +383,17 @@ def classify():
         result["filename"] = file.filename
         result["file_size_kb"] = round(file_size / 1024, 2)
         
-        print(f"\n✅ Prediction completed!")
-        print(f"   Result: {result['class_name']}")
-        print(f"   Confidence: {result['confidence']:.2%}")
-        print(f"   Uncertainty: {result['uncertainty']:.4f}")
-        print(f"{'='*70}\n")
+        logger.debug("✅ Prediction completed: %s (confidence %.2f%%, uncertainty %.4f)",
+                     result["class_name"], result["confidence"] * 100, result["uncertainty"])
         
-        return jsonify(result), 200
+        with metrics.span("serialize"):
+            response = jsonify(result)
+        return response, 200
     
     except ValueError as e:
         # ❌ Preprocessing or validation errors
         error_msg = str(e)
-        print(f"\n❌ ValueError: {error_msg}")
+        logger.info("❌ Invalid image (request %s): %s", g.trace.request_id, error_msg)
         
         return jsonify({
             "success": False,
@@ -148,13 +402,187 @@ def classify():
             "details": "The image could not be processed. Please check the file format."
         }), 400
     
+    except ModelNotLoaded as e:
+        # ❌ The requested version was unloaded before the request ran
+        return jsonify({"success": False, "error": "Model version not loaded", "message": str(e)}), 409
+    
     except Exception as e:
         # ❌ Unexpected errors
         error_msg = str(e)
-        error_trace = traceback.format_exc()
+        logger.exception("❌ PREDICTION ERROR (request %s)", g.trace.request_id)
         
-        print(f"\n❌ PREDICTION ERROR:")
-        print(error_trace)
+        return jsonify({
+            "success": False,
+            "error": "Prediction failed",
+            "message": error_msg,
+            "details": "An unexpected error occurred during prediction. Check server logs."
+        }), 500
+
+def _iter_batch_results(files, n_iterations=30, adaptive=None, seed=None, tta=None, cascade=None, model=None):
+    """
+    Yield (index, result) for every image in a batch upload as soon as its
+    mini-batch finishes. Files that fail validation are yielded with their error.
+    
+    Raises:
+        ValueError: If an archive is unreadable or the batch is too large
+    """
+    # Files rejected before inference, emitted alongside the next mini-batch
+    rejected = deque()
+    
+    def valid_images():
+        for index, (filename, image_bytes, error) in enumerate(iter_batch_files(files)):
+            if error is None:
+                yield (index, filename, len(image_bytes)), image_bytes
+            else:
+                rejected.append((index, {"success": False, "filename": filename, **error}))
+    
+    if USE_WORKER_POOL:
+        predictions = get_pool().map_predictions(valid_images(), n_iterations, adaptive, seed=seed, tta=tta,
+                                                 cascade=cascade, model=model)
+    else:
+        predictions = iter_batch_predictions(valid_images(), n_iterations, adaptive=adaptive, seed=seed, tta=tta,
+                                             cascade=cascade, model=model)
+    
+    for (index, filename, size), result, exc in predictions:
+        while rejected:
+            yield rejected.popleft()
+        
+        if exc is not None:
+            yield index, {
+                "success": False,
+                "filename": filename,
+                "error": "Invalid image" if isinstance(exc, ValueError) else "Prediction failed",
+                "message": str(exc)
+            }
+            continue
+        
+        _tag_result(result, model)
+        result["explanation"] = get_prediction_explanation(result)
+        result["success"] = True
+        result["filename"] = filename
+        result["file_size_kb"] = round(size / 1024, 2)
+        yield index, result
+    
+    while rejected:
+        yield rejected.popleft()
+
+def _stream_batch_results(files, adaptive=None, seed=None, tta=None, cascade=None, model=None):
+    """Serialize batch results as NDJSON lines, ending with a summary line."""
+    count = 0
+    succeeded = 0
+    try:
+        for _, result in _iter_batch_results(files, adaptive=adaptive, seed=seed, tta=tta, cascade=cascade,
+                                             model=model):
+            count += 1
+            succeeded += int(result["success"])
+            yield json.dumps(result) + "\n"
+    except ValueError as e:
+        yield json.dumps({"success": False, "error": "Invalid batch", "message": str(e)}) + "\n"
+    except ModelNotLoaded as e:
+        yield json.dumps({"success": False, "error": "Model version not loaded", "message": str(e)}) + "\n"
+    except Exception as e:
+        logger.exception("❌ BATCH STREAM ERROR")
+        yield json.dumps({"success": False, "error": "Prediction failed", "message": str(e)}) + "\n"
+    finally:
+        for file in files:
+            file.close()
+    
+    logger.debug("✅ Batch stream completed: %d/%d images classified", succeeded, count)
+    yield json.dumps({"done": True, "count": count, "succeeded": succeeded, "failed": count - succeeded}) + "\n"
+
+@app.route("/api/classify/batch", methods=["POST"])
+def classify_batch():
+    """
+    Classify many fundus images in one request.
+    
+    Expects: multipart/form-data with one or more 'image' files, each either
+             an image or a zip/tar archive of images
+    Query:   stream=1 (or Accept: application/x-ndjson) to stream one JSON line
+             per image as soon as its mini-batch finishes, then a summary line;
+             adaptive=1 for adaptive MC Dropout, seed, tta, cascade and model (see
+             /api/classify); all images of a batch use the same model version
+    Returns: JSON with one result per image; failed images carry their own error
+    """
+    try:
+        with metrics.span("upload_read"):
+            files = request.files.getlist("image")
+        if not files or all(file.filename == "" for file in files):
+            return jsonify({
+                "success": False,
+                "error": "No images uploaded",
+                "message": "Please upload image files or an archive in 'image' fields"
+            }), 400
+        
+        try:
+            adaptive, seed, tta, cascade = _mc_settings_from_request()
+            model = _model_from_request()
+            if cascade is not None:
+                cascade.check_runtime(get_registry().version(model).runtime)
+        except ModelNotLoaded as e:
+            return jsonify({
+                "success": False,
+                "error": "Model version not loaded",
+                "message": str(e)
+            }), 409
+        except ValueError as e:
+            return jsonify({
+                "success": False,
+                "error": "Invalid parameters",
+                "message": str(e)
+            }), 400
+        
+        logger.debug("📥 Received batch: %d uploaded files", len(files))
+        
+        # ✅ Streaming mode: constant server memory, first results arrive early
+        stream = request.args.get("stream", "0") in ("1", "true") or \
+            request.accept_mimetypes.best == "application/x-ndjson"
+        if stream:
+            return Response(
+                stream_with_context(_stream_batch_results(detach_uploads(files), adaptive, seed, tta, cascade, model)),
+                mimetype="application/x-ndjson"
+            )
+        
+        try:
+            indexed = sorted(_iter_batch_results(files, adaptive=adaptive, seed=seed, tta=tta, cascade=cascade,
+                                                 model=model),
+                             key=lambda entry: entry[0])
+        except ValueError as e:
+            return jsonify({
+                "success": False,
+                "error": "Invalid batch",
+                "message": str(e)
+            }), 400
+        
+        results = [result for _, result in indexed]
+        if not results:
+            return jsonify({
+                "success": False,
+                "error": "No images found",
+                "message": "The upload did not contain any image files"
+            }), 400
+        
+        succeeded = sum(1 for result in results if result["success"])
+        
+        logger.debug("✅ Batch completed: %d/%d images classified", succeeded, len(results))
+        
+        with metrics.span("serialize"):
+            response = jsonify({
+                "success": True,
+                "count": len(results),
+                "succeeded": succeeded,
+                "failed": len(results) - succeeded,
+                "results": results
+            })
+        return response, 200
+    
+    except ModelNotLoaded as e:
+        # ❌ The requested version was unloaded before the batch ran
+        return jsonify({"success": False, "error": "Model version not loaded", "message": str(e)}), 409
+    
+    except Exception as e:
+        # ❌ Unexpected errors
+        error_msg = str(e)
+        logger.exception("❌ BATCH PREDICTION ERROR (request %s)", g.trace.request_id)
         
         return jsonify({
             "success": False,
@@ -172,7 +600,10 @@ def not_found(e):
         "message": "The requested endpoint does not exist",
         "available_endpoints": {
             "health": "/ or /api/health (GET)",
-            "classify": "/api/classify (POST)"
+            "classify": "/api/classify (POST)",
+            "classify_batch": "/api/classify/batch (POST)",
+            "models": "/api/models (GET)",
+            "metrics": "/api/metrics (GET)"
         }
     }), 404
 
@@ -189,26 +620,37 @@ if __name__ == "__main__":
     print("\n" + "="*70)
     print("🚀 Starting BayesDR API Server")
     print("="*70)
-    print(f"   API URL: http://localhost:5500")
+    print(f"   API URL: http://localhost:{PORT}")
     print(f"   Frontend: http://localhost:3000")
     print(f"   Endpoints:")
     print(f"      GET  /              - Health check")
     print(f"      GET  /api/health    - Detailed health check")
     print(f"      POST /api/classify  - Image classification")
+    print(f"      POST /api/classify/batch - Batch classification")
+    print(f"      GET  /api/models    - Model versions (POST .../<name>/activate to hot-swap)")
+    print(f"      GET  /api/metrics   - Prometheus metrics")
     print("="*70 + "\n")
     
-    # ✅ Pre-load model before starting server
-    try:
-        from classify import load_model
-        print("🔄 Pre-loading model...")
-        model = load_model()
-        print(f"✅ Model loaded successfully!")
-        print(f"   Input: {model.input_shape}")
-        print(f"   Output: {model.output_shape}")
-        print("="*70 + "\n")
-    except Exception as e:
-        print(f"⚠️  WARNING: Could not pre-load model: {e}")
-        print("   Model will be loaded on first request")
-        print("="*70 + "\n")
+    # ✅ Debug mode (and its reloader, which loads the model twice) is opt-in
+    debug = os.environ.get("FLASK_DEBUG", "0") == "1"
     
-    app.run(host="0.0.0.0", port=5500, debug=True)
\ No newline at end of file
+    if USE_WORKER_POOL:
+        # ✅ Production mode: model lives in the worker processes only
+        logger.info("🔄 Starting %d inference workers...", NUM_WORKERS)
+        get_pool()
+        app.run(host="0.0.0.0", port=PORT, debug=debug, use_reloader=False, threaded=True)
+    else:
+        # ✅ Pre-load model before starting server
+        try:
+            from classify import get_model_info
+            logger.info("🔄 Pre-loading model...")
+            info = get_model_info()
+            logger.info("   Input: %s, output: %s", info["input_shape"], info["output_shape"])
+            registry = get_registry()
+            if registry.candidate is not None:
+                logger.info("🔄 Pre-loading candidate model %s...", registry.candidate)
+                registry.acquire(registry.candidate)
+        except Exception as e:
+            logger.warning("⚠️  Could not pre-load model: %s (it will be loaded on first request)", e)
+        
+        app.run(host="0.0.0.0", port=PORT, debug=debug, threaded=True)
\ No newline at end of file
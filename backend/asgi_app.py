@@ -0,0 +1,461 @@
+"""
+Asynchronous (ASGI) serving entry point.
+
+Exposes the same `/`, `/api/health`, `/api/classify` and `/api/models`
+contract as app.py,
+but uploads are parsed incrementally as they arrive: oversized requests are
+rejected from the Content-Length header or as soon as the image part passes
+the size limit, without buffering the whole body first. Slow uploads only
+cost a coroutine, not a thread; decoding and inference are handed to the
+micro-batcher, the worker pool or a thread executor.
+
+Run with:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5500
+"""
+
+import asyncio
+import contextvars
+import functools
+import hmac
+import logging
+import os
+
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import metrics
+from classify import (CASCADE_BY_DEFAULT, AdaptiveSampling, Cascade, ModelNotLoaded, ModelVersion,
+                      TestTimeAugmentation, mc_config_tag, predict_with_uncertainty, get_prediction_explanation,
+                      get_registry, seed_from_params)
+from batching import USE_MICRO_BATCHING, get_batcher
+from cache import get_cache
+from uploads import ALLOWED_EXTENSIONS, MAX_FILE_SIZE, check_image_header, get_extension
+from workers import NUM_WORKERS, get_pool
+
+ADAPTIVE_BY_DEFAULT = os.environ.get("BAYESDR_ADAPTIVE_MC", "0") == "1"
+USE_WORKER_POOL = NUM_WORKERS > 0
+REQUEST_TIMEOUT = 120  # seconds
+ADMIN_TOKEN = os.environ.get("BAYESDR_ADMIN_TOKEN", "")  # Model admin endpoints; unset = disabled
+
+# Slack for multipart boundaries and part headers on top of the image itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+metrics.configure_logging()
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """Upload rejected before inference; carries the HTTP status and JSON body."""
+
+    def __init__(self, status, payload):
+        super().__init__(payload.get("message", ""))
+        self.status = status
+        self.payload = {"success": False, **payload}
+
+
+def _too_large(size=None):
+    message = "Maximum file size is 10MB."
+    if size is not None:
+        message += f" Your file: {size / (1024*1024):.2f}MB"
+    return UploadError(400, {"error": "File too large", "message": message})
+
+
+async def read_image_upload(request, field="image", max_size=MAX_FILE_SIZE):
+    """
+    Stream a multipart/form-data body and return the first `field` file part.
+
+    Other parts are skipped without being stored. Reading stops as soon as
+    the image part is complete or exceeds max_size.
+
+    Returns:
+        Tuple of (filename, image_bytes)
+
+    Raises:
+        UploadError: For missing, empty or oversized uploads
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadError(400, {
+            "error": "No image uploaded",
+            "message": "Please upload an image file in 'image' field"
+        })
+
+    # ✅ Early cutoff: reject from the header without reading the body
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_size + MULTIPART_OVERHEAD:
+        raise _too_large(int(content_length))
+
+    state = {"header_field": b"", "header_value": b"", "headers": {}, "target": False, "done": False}
+    image = {"filename": None, "data": bytearray()}
+
+    def on_part_begin():
+        state["headers"] = {}
+
+    def on_header_field(data, start, end):
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["header_value"] += data[start:end]
+
+    def on_header_end():
+        state["headers"][state["header_field"].lower()] = state["header_value"]
+        state["header_field"] = state["header_value"] = b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        state["target"] = (
+            not state["done"]
+            and disposition.get(b"name") == field.encode()
+            and b"filename" in disposition
+        )
+        if state["target"]:
+            image["filename"] = disposition[b"filename"].decode("utf-8", "replace")
+
+    def on_part_data(data, start, end):
+        if state["target"]:
+            image["data"] += data[start:end]
+            if len(image["data"]) > max_size:
+                raise _too_large()
+
+    def on_part_end():
+        if state["target"]:
+            state["done"] = True
+            state["target"] = False
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end
+    })
+
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if state["done"]:
+                break
+    except MultipartParseError as e:
+        raise UploadError(400, {"error": "Invalid upload", "message": f"Malformed multipart body: {str(e)}"})
+
+    if image["filename"] is None:
+        raise UploadError(400, {
+            "error": "No image uploaded",
+            "message": "Please upload an image file in 'image' field"
+        })
+    if image["filename"] == "":
+        raise UploadError(400, {
+            "error": "Empty filename",
+            "message": "Please select a valid image file"
+        })
+    if len(image["data"]) == 0:
+        raise UploadError(400, {
+            "error": "Empty file",
+            "message": "The uploaded file appears to be empty"
+        })
+
+    return image["filename"], bytes(image["data"])
+
+
+class TracingMiddleware:
+    """Per-request trace: X-Request-ID and Server-Timing headers, request metrics."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        trace, token = metrics.begin_request(request_id)
+
+        async def send_traced(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", trace.request_id.encode()))
+                if trace.stages:
+                    headers.append((b"server-timing", trace.server_timing().encode()))
+                message = {**message, "headers": headers}
+                route = scope.get("route")
+                metrics.finish_request(trace, route.path if route is not None else "unmatched", message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            metrics.release_request(token)
+
+
+def _in_thread(function, *args, **kwargs):
+    """Run a blocking call in the default executor, keeping the request's trace."""
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(context.run, function, *args, **kwargs)
+    )
+
+
+async def _predict(image_bytes, adaptive=None, seed=None, tta=None, cascade=None, model=None):
+    """Hand inference to the worker pool, the micro-batcher or a thread."""
+    if USE_WORKER_POOL:
+        # submit() preprocesses in the calling thread, so keep it off the event loop
+        future = await _in_thread(get_pool().submit, image_bytes, 30, adaptive, seed, tta, cascade, model)
+    elif USE_MICRO_BATCHING:
+        future = get_batcher().submit(image_bytes, n_iterations=30, adaptive=adaptive, seed=seed, tta=tta,
+                                      cascade=cascade, model=model)
+    else:
+        return await _in_thread(predict_with_uncertainty, image_bytes, n_iterations=30, adaptive=adaptive, seed=seed,
+                                tta=tta, cascade=cascade, model=model)
+    return await asyncio.wait_for(asyncio.wrap_future(future), REQUEST_TIMEOUT)
+
+
+async def index(request):
+    """Health check endpoint."""
+    return JSONResponse({
+        "status": "ok",
+        "message": "BayesDR API is running",
+        "version": "1.0.0",
+        "endpoints": {
+            "health": "/ (GET)",
+            "classify": "/api/classify (POST)",
+            "models": "/api/models (GET)",
+            "metrics": "/api/metrics (GET)"
+        }
+    })
+
+
+async def prometheus_metrics(request):
+    """Request, stage and image counters/histograms in the Prometheus text format."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+async def health(request):
+    """Detailed health check with model status."""
+    try:
+        if USE_WORKER_POOL:
+            pool = get_pool()
+            return JSONResponse({
+                "status": "healthy" if pool.ready else "starting",
+                "model_loaded": pool.ready,
+                "model_version": get_registry().active,
+                "models": get_registry().stats(),
+                "workers": pool.stats(),
+                "cache": get_cache().stats()
+            }, status_code=200 if pool.ready else 503)
+
+        from classify import get_model_info, get_startup_timings
+        info = await asyncio.get_running_loop().run_in_executor(None, get_model_info)
+
+        return JSONResponse({
+            "status": "healthy",
+            "model_loaded": True,
+            "model_version": info["model_version"],
+            "model_input_shape": info["input_shape"],
+            "model_output_shape": info["output_shape"],
+            "backbone_runtime": info["backbone_runtime"],
+            "models": get_registry().stats(),
+            "startup": get_startup_timings(),
+            "batching": get_batcher().stats() if USE_MICRO_BATCHING else None,
+            "cache": get_cache().stats()
+        })
+    except Exception as e:
+        return JSONResponse({"status": "unhealthy", "error": str(e)}, status_code=500)
+
+
+def _admin_denied(request):
+    """An error response unless the request carries BAYESDR_ADMIN_TOKEN, else None."""
+    if not ADMIN_TOKEN:
+        return JSONResponse({
+            "success": False,
+            "error": "Forbidden",
+            "message": "Model admin endpoints are disabled; set BAYESDR_ADMIN_TOKEN to enable them"
+        }, status_code=403)
+    supplied = request.headers.get("Authorization", "").encode()
+    if not hmac.compare_digest(supplied, f"Bearer {ADMIN_TOKEN}".encode()):
+        return JSONResponse({
+            "success": False,
+            "error": "Unauthorized",
+            "message": "Missing or wrong admin token"
+        }, status_code=401)
+    return None
+
+
+def _preload():
+    """How a version is loaded before it gets traffic: here, or in every pool worker."""
+    return get_pool().follow if USE_WORKER_POOL else True
+
+
+async def _register_from_body(request, name):
+    """Register `name` from an optional JSON {"path": ...} body (see app.py)."""
+    try:
+        body = await request.json()
+    except ValueError:
+        body = {}
+    body = body if isinstance(body, dict) else {}
+    if body.get("path"):
+        get_registry().register(ModelVersion.from_path(name, body["path"]), replace=True)
+    return body
+
+
+async def list_models(request):
+    """Registered model versions with their state, the active one and the candidate."""
+    return JSONResponse(get_registry().stats())
+
+
+async def activate_model(request):
+    """Hot-swap the active model version (see app.py); 202 while it loads in the background."""
+    denied = _admin_denied(request)
+    if denied is not None:
+        return denied
+
+    name = request.path_params["name"]
+    try:
+        await _register_from_body(request, name)
+        get_registry().activate(name, preload=_preload())
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": "Invalid model version", "message": str(e)}, status_code=400)
+
+    logger.info("🔄 Activating model version %s", name)
+    return JSONResponse({"success": True, "activating": name, "models": get_registry().stats()}, status_code=202)
+
+
+async def candidate_model(request):
+    """POST: send {"percent": N} of the traffic to a candidate version (see app.py); DELETE: stop."""
+    denied = _admin_denied(request)
+    if denied is not None:
+        return denied
+
+    if request.method == "DELETE":
+        get_registry().set_candidate(None, preload=_preload())
+        return JSONResponse({"success": True, "models": get_registry().stats()})
+
+    name = request.path_params["name"]
+    try:
+        body = await _register_from_body(request, name)
+        get_registry().set_candidate(name, body.get("percent", 0), preload=_preload())
+    except (TypeError, ValueError) as e:
+        return JSONResponse({"success": False, "error": "Invalid candidate", "message": str(e)}, status_code=400)
+
+    return JSONResponse({"success": True, "candidate": name, "models": get_registry().stats()}, status_code=202)
+
+
+async def classify(request):
+    """
+    Classify a fundus image for Diabetic Retinopathy.
+
+    Expects: multipart/form-data with 'image' file
+    Query:   adaptive=1 to draw MC samples until mean/std/entropy converge;
+             seed=image|<int>|random; tta=1 for test-time augmentation; cascade=1|0
+             for the uncertainty-gated cascade; model=<version> (see app.py)
+    Returns: JSON with prediction, confidence, uncertainty, and probabilities
+    """
+    try:
+        try:
+            tta = TestTimeAugmentation.from_params(request.query_params)
+            adaptive = AdaptiveSampling.from_params(request.query_params, default=ADAPTIVE_BY_DEFAULT and tta is None)
+            cascade = Cascade.from_params(request.query_params, default=CASCADE_BY_DEFAULT)
+            mc_config_tag(30, adaptive, tta)  # Rejects unsupported combinations
+            seed = seed_from_params(request.query_params)
+            model = get_registry().route(request.query_params.get("model"))
+            if cascade is not None:
+                cascade.check_runtime(get_registry().version(model).runtime)
+        except ModelNotLoaded as e:
+            raise UploadError(409, {"error": "Model version not loaded", "message": str(e)})
+        except ValueError as e:
+            raise UploadError(400, {"error": "Invalid parameters", "message": str(e)})
+
+        with metrics.span("upload_read"):
+            filename, image_bytes = await read_image_upload(request)
+
+        file_ext = get_extension(filename)
+        if file_ext not in ALLOWED_EXTENSIONS:
+            raise UploadError(400, {
+                "error": "Invalid file type",
+                "message": f"Allowed types: {', '.join(ALLOWED_EXTENSIONS).upper()}",
+                "received": file_ext
+            })
+
+        # Header-only checks: nothing is decoded for non-images or decompression bombs
+        error = check_image_header(image_bytes)
+        if error is not None:
+            raise UploadError(400, error)
+
+        logger.debug("📥 Received image: %s (%.2f KB)", filename, len(image_bytes) / 1024)
+
+        result = await _predict(image_bytes, adaptive, seed, tta, cascade, model)
+
+        result["model_version"] = model
+        metrics.MODEL_PREDICTIONS.inc(version=model, class_name=result["class_name"])
+        result["explanation"] = get_prediction_explanation(result)
+        result["success"] = True
+        result["filename"] = filename
+        result["file_size_kb"] = round(len(image_bytes) / 1024, 2)
+
+        with metrics.span("serialize"):
+            response = JSONResponse(result)
+        return response
+
+    except UploadError as e:
+        return JSONResponse(e.payload, status_code=e.status)
+
+    except ValueError as e:
+        # ❌ Preprocessing or validation errors
+        return JSONResponse({
+            "success": False,
+            "error": "Invalid image",
+            "message": str(e),
+            "details": "The image could not be processed. Please check the file format."
+        }, status_code=400)
+
+    except ModelNotLoaded as e:
+        # ❌ The requested version was unloaded before the request ran
+        return JSONResponse({"success": False, "error": "Model version not loaded", "message": str(e)},
+                            status_code=409)
+
+    except Exception as e:
+        # ❌ Unexpected errors
+        logger.exception("❌ PREDICTION ERROR")
+        return JSONResponse({
+            "success": False,
+            "error": "Prediction failed",
+            "message": str(e),
+            "details": "An unexpected error occurred during prediction. Check server logs."
+        }, status_code=500)
+
+
+app = Starlette(
+    routes=[
+        Route("/", index, methods=["GET"]),
+        Route("/api/health", health, methods=["GET"]),
+        Route("/api/classify", classify, methods=["POST"]),
+        Route("/api/models", list_models, methods=["GET"]),
+        Route("/api/models/candidate", candidate_model, methods=["DELETE"]),
+        Route("/api/models/{name}/activate", activate_model, methods=["POST"]),
+        Route("/api/models/{name}/candidate", candidate_model, methods=["POST"]),
+        Route("/api/metrics", prometheus_metrics, methods=["GET"])
+    ],
+    middleware=[
+        Middleware(TracingMiddleware),
+        # ✅ Same CORS origins as app.py
+        Middleware(
+            CORSMiddleware,
+            allow_origins=["http://localhost:3000", "http://127.0.0.1:3000", "http://localhost:3001"],
+            allow_methods=["*"],
+            allow_headers=["*"]
+        )
+    ]
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=5500)
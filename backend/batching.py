@@ -0,0 +1,208 @@
+"""
+Dynamic micro-batching for classification requests.
+
+Concurrent requests are queued and processed together, so the DenseNet
+backbone runs once on a stacked batch instead of once per image.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+from classify import mc_config_tag, prepare_batch, infer_prepared_batch, use_model
+
+# ✅ Set BAYESDR_MICRO_BATCHING=0 to run each request on its own (batch size 1)
+USE_MICRO_BATCHING = os.environ.get("BAYESDR_MICRO_BATCHING", "1") == "1"
+
+# ✅ Batching limits (override with environment variables)
+MAX_BATCH_SIZE = int(os.environ.get("BAYESDR_MAX_BATCH_SIZE", "16"))
+MAX_WAIT_MS = float(os.environ.get("BAYESDR_MAX_WAIT_MS", "10"))
+# Images of a batch decoded in parallel (PIL releases the GIL); 1 = on the batcher thread
+DECODE_THREADS = int(os.environ.get("BAYESDR_BATCH_DECODE_THREADS", str(min(MAX_BATCH_SIZE, os.cpu_count() or 1))))
+
+
+class _PendingRequest:
+    """A queued classification request waiting for its batch."""
+
+    __slots__ = ("image_bytes", "n_iterations", "adaptive", "seed", "tta", "cascade", "model", "mc_config", "future",
+                 "enqueued_at", "traces")
+
+    def __init__(self, image_bytes, n_iterations, adaptive=None, seed=None, tta=None, cascade=None, model=None):
+        self.image_bytes = image_bytes
+        self.n_iterations = n_iterations
+        self.adaptive = adaptive
+        self.seed = seed
+        self.tta = tta
+        self.cascade = cascade
+        self.model = model
+        self.mc_config = mc_config_tag(n_iterations, adaptive, tta, cascade)
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+        self.traces = metrics.current_traces()  # Requests this item is served for
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests into batches of up to max_batch_size,
+    waiting at most max_wait_ms after the first request of a batch.
+
+    Each batch is decoded in parallel on decode_threads threads and run
+    through the backbone as one tensor, then the MC Dropout head is sampled
+    for every item and each caller gets its own result dict.
+    """
+
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, decode_threads=DECODE_THREADS):
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_ms = max(0.0, float(max_wait_ms))
+        self.decode_threads = max(1, int(decode_threads))
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._executor = None
+        self._start_lock = threading.Lock()
+
+        # Statistics
+        self._stats_lock = threading.Lock()
+        self._batch_size_histogram = {}
+        self._batches_processed = 0
+        self._requests_processed = 0
+        self._total_wait_ms = 0.0
+        self._max_observed_wait_ms = 0.0
+
+    def start(self):
+        """Start the background batching thread (idempotent)."""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._executor is None and self.decode_threads > 1:
+                    self._executor = ThreadPoolExecutor(max_workers=self.decode_threads,
+                                                        thread_name_prefix="bayesdr-batch-decode")
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name="bayesdr-micro-batcher",
+                    daemon=True
+                )
+                self._thread.start()
+        return self
+
+    def submit(self, image_bytes, n_iterations=30, adaptive=None, seed=None, tta=None, cascade=None, model=None):
+        """
+        Queue an image for classification.
+
+        Returns:
+            concurrent.futures.Future resolving to the predict_with_uncertainty() dict
+
+        Raises:
+            ValueError: For adaptive sampling combined with TTA
+        """
+        self.start()
+        pending = _PendingRequest(image_bytes, n_iterations, adaptive, seed, tta, cascade, model)
+        self._queue.put(pending)
+        return pending.future
+
+    def predict(self, image_bytes, n_iterations=30, adaptive=None, seed=None, tta=None, cascade=None, model=None,
+                timeout=None):
+        """Blocking convenience wrapper around submit()."""
+        return self.submit(image_bytes, n_iterations, adaptive, seed, tta, cascade, model).result(timeout=timeout)
+
+    def stats(self):
+        """Snapshot of queue depth, batch-size histogram and wait times."""
+        with self._stats_lock:
+            batches = self._batches_processed
+            requests = self._requests_processed
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_ms,
+                "decode_threads": self.decode_threads,
+                "queue_depth": self._queue.qsize(),
+                "batches_processed": batches,
+                "requests_processed": requests,
+                "avg_batch_size": round(requests / batches, 2) if batches else 0.0,
+                "batch_size_histogram": {
+                    str(size): count for size, count in sorted(self._batch_size_histogram.items())
+                },
+                "avg_wait_ms": round(self._total_wait_ms / requests, 3) if requests else 0.0,
+                "max_observed_wait_ms": round(self._max_observed_wait_ms, 3)
+            }
+
+    def _collect_batch(self):
+        """Block for the first request, then gather more until full or the deadline passes."""
+        first = self._queue.get()
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait_ms / 1000.0
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # Deadline passed: still drain whatever is already waiting
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _record_batch(self, batch, started_at):
+        waits_ms = [(started_at - item.enqueued_at) * 1000.0 for item in batch]
+        for item, wait_ms in zip(batch, waits_ms):
+            metrics.record_stage("queue", wait_ms / 1000.0, item.traces)
+        with self._stats_lock:
+            size = len(batch)
+            self._batch_size_histogram[size] = self._batch_size_histogram.get(size, 0) + 1
+            self._batches_processed += 1
+            self._requests_processed += size
+            self._total_wait_ms += sum(waits_ms)
+            self._max_observed_wait_ms = max(self._max_observed_wait_ms, max(waits_ms))
+
+    def _process_batch(self, batch):
+        # Group items that share a model version and MC settings (and seed mode) so each group
+        # is one backbone pass and one MC head call; a bad image only fails its own request
+        groups = {}
+        for item in batch:
+            if item.future.set_running_or_notify_cancel():
+                groups.setdefault((item.model, item.mc_config, item.seed), []).append(item)
+
+        for items in groups.values():
+            first = items[0]
+            n_iterations, adaptive, seed, tta, cascade = (first.n_iterations, first.adaptive, first.seed, first.tta,
+                                                          first.cascade)
+            try:
+                # Every request in the group waits for the whole group's stages, on one model version
+                with metrics.tracing(trace for item in items for trace in item.traces), use_model(first.model):
+                    prepared = prepare_batch(
+                        ((item, item.image_bytes) for item in items), n_iterations, adaptive, seed,
+                        executor=self._executor, tta=tta, cascade=cascade
+                    )
+                    predictions = infer_prepared_batch(prepared, n_iterations, adaptive, seed, tta, cascade)
+                    for item, result, error in predictions:
+                        if error is not None:
+                            item.future.set_exception(error)
+                        else:
+                            item.future.set_result(result)
+            except Exception as e:
+                for item in items:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            self._record_batch(batch, time.perf_counter())
+            self._process_batch(batch)
+
+
+# Global batcher instance
+_batcher = None
+_batcher_lock = threading.Lock()
+
+def get_batcher():
+    """Get the shared MicroBatcher, starting it on first use."""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = MicroBatcher().start()
+    return _batcher
@@ -0,0 +1,534 @@
+"""
+Benchmarks for the BayesDR inference pipeline.
+
+Usage:
+    python benchmark.py preprocess [--images DIR] [--synthetic 8] [--size 3000x2000]
+    python benchmark.py pipeline [--images DIR] [--batch-sizes 1 8 32] [--threads 1 4]
+                                 [--n-iterations 10 30 100] [--output results.json]
+    python benchmark.py compare baseline.json results.json [--tolerance 0.15]
+    python benchmark.py cascade --images VALIDATION_DIR [--batch-size 32] [--max-entropy 0.5]
+
+The preprocess benchmark times the original preprocessing path (PIL full
+decode + LANCZOS + float copies) against the current preprocess_image()
+options and checks numerical parity against the original output.
+
+The pipeline benchmark times every serving stage on its own (decode,
+preprocess, backbone, MC head per n_iterations, statistics, explanation,
+JSON) plus end to end, for each batch size and TF thread count. It reports
+p50/p95/p99 latency, throughput and peak RSS. Each thread count runs in a
+fresh process, because TF fixes its thread pools at initialization.
+
+`compare` exits non-zero when a stage got slower than the baseline by more
+than the tolerance, so it can gate CI or a deploy.
+
+`cascade` runs a labelled validation set (class folders, as score_archive.py
+reads them) through full MC Dropout and through the cascade with the given
+gate. It reports how many images the first stage answered, how often the
+cascade agrees with full MC Dropout (overall and on the accepted images),
+both accuracies and the ms per image of each, to pick thresholds that
+trade little accuracy for the speedup.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+import classify
+from classify import (
+    IMAGE_SIZE, RESAMPLING_FILTERS, extract_features, get_prediction_explanation,
+    preprocess_image, sample_mc_predictions, summarize_batch
+)
+from uncertainty import compute_statistics
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tiff")
+
+
+def legacy_preprocess(image_bytes):
+    """The original preprocessing path, kept as the parity reference."""
+    img = Image.open(io.BytesIO(image_bytes))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img = img.resize(IMAGE_SIZE, Image.Resampling.LANCZOS)
+    img_array = np.array(img, dtype=np.float32)
+    img_array = img_array / 255.0
+    img_array = np.expand_dims(img_array, axis=0)
+    _ = (img_array.min(), img_array.max(), img_array.mean())
+    return img_array
+
+
+def synthetic_fundus(width, height, seed=0, fmt="JPEG"):
+    """
+    Encode a synthetic fundus-like photo: a bright disc with smooth vessels-like
+    texture on a black background, so JPEG sizes resemble real uploads.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    cx, cy, radius = width / 2, height / 2, min(width, height) * 0.45
+    r = np.sqrt((x - cx) ** 2 + (y - cy) ** 2) / radius
+    disc = np.clip(1.0 - r ** 4, 0.0, 1.0)
+    texture = 0.15 * np.sin(x / rng.uniform(20, 60)) * np.cos(y / rng.uniform(20, 60))
+    base = np.stack([0.85, 0.45, 0.2]) * (disc + texture * disc)[..., None]
+    noise = rng.normal(0.0, 0.02, size=base.shape)
+    pixels = (np.clip(base + noise, 0.0, 1.0) * 255).astype(np.uint8)
+
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format=fmt, quality=92)
+    return buffer.getvalue()
+
+
+def load_images(images_dir=None, synthetic=8, size="3000x2000"):
+    """Return a list of (name, image_bytes) from a directory or synthetic images."""
+    if images_dir:
+        images = []
+        for root, _, files in os.walk(images_dir):
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    with open(os.path.join(root, name), "rb") as f:
+                        images.append((name, f.read()))
+        if not images:
+            raise SystemExit(f"No images found in {images_dir}")
+        return images
+
+    width, height = (int(v) for v in size.lower().split("x"))
+    return [(f"synthetic_{i}.jpg", synthetic_fundus(width, height, seed=i)) for i in range(synthetic)]
+
+
+def time_per_image(fn, images, repeat):
+    """Best-of-repeat mean milliseconds per image."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _, image_bytes in images:
+            fn(image_bytes)
+        best = min(best, (time.perf_counter() - start) * 1000.0 / len(images))
+    return best
+
+
+def bench_preprocess(args):
+    images = load_images(args.images, args.synthetic, args.size)
+    reference = [legacy_preprocess(image_bytes) for _, image_bytes in images]
+
+    variants = [("legacy", legacy_preprocess)]
+    for draft in (False, True):
+        for resample in args.filters:
+            variants.append((
+                f"{resample}{'+draft' if draft else ''}",
+                lambda b, r=resample, d=draft: preprocess_image(b, resample=r, draft=d, debug=False)
+            ))
+
+    # Preallocated batch buffer: the serving path writes rows in place
+    batch = np.empty((len(images), IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.float32)
+    rows = iter(range(10 ** 9))
+    variants.append((
+        "lanczos+draft+buffer",
+        lambda b: preprocess_image(b, out=batch[next(rows) % len(images)], resample="lanczos", draft=True, debug=False)
+    ))
+
+    results = []
+    legacy_ms = None
+    for name, fn in variants:
+        ms = time_per_image(fn, images, args.repeat)
+        legacy_ms = ms if legacy_ms is None else legacy_ms
+
+        diffs = [np.abs(fn(image_bytes).reshape(ref.shape) - ref) for (_, image_bytes), ref in zip(images, reference)]
+        results.append({
+            "variant": name,
+            "ms_per_image": round(ms, 3),
+            "speedup": round(legacy_ms / ms, 2),
+            "max_abs_diff": float(max(d.max() for d in diffs)),
+            "mean_abs_diff": float(np.mean([d.mean() for d in diffs]))
+        })
+
+    print(f"\nPreprocessing benchmark: {len(images)} images, best of {args.repeat}")
+    print(f"{'variant':24s} {'ms/img':>9s} {'speedup':>8s} {'max|diff|':>10s} {'mean|diff|':>11s}")
+    for r in results:
+        print(f"{r['variant']:24s} {r['ms_per_image']:9.2f} {r['speedup']:7.2f}x "
+              f"{r['max_abs_diff']:10.4f} {r['mean_abs_diff']:11.5f}")
+
+    return {"benchmark": "preprocess", "n_images": len(images), "results": results}
+
+
+def latency_summary(timings_s, images_per_call):
+    """p50/p95/p99/mean latency (ms) and throughput for a list of call durations."""
+    timings_ms = np.asarray(timings_s) * 1000.0
+    return {
+        "calls": len(timings_ms),
+        "p50_ms": round(float(np.percentile(timings_ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(timings_ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(timings_ms, 99)), 3),
+        "mean_ms": round(float(timings_ms.mean()), 3),
+        "images_per_s": round(images_per_call * 1000.0 / float(timings_ms.mean()), 2)
+    }
+
+
+def time_calls(fn, repeat, warmup):
+    """Durations (s) of `repeat` calls of fn() after `warmup` untimed calls."""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process (ru_maxrss is KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+def decode_only(image_bytes):
+    """PIL decode to RGB, as preprocess_image() does before resizing."""
+    img = Image.open(io.BytesIO(image_bytes))
+    if classify.USE_JPEG_DRAFT and img.format == "JPEG":
+        img.draft("RGB", IMAGE_SIZE)
+    return img.convert("RGB")
+
+
+def run_pipeline(config):
+    """
+    Time every stage for each batch size, in the current process.
+
+    Args:
+        config: Dict with images, batch_sizes, n_iterations, repeat, warmup,
+                threads and model_path (picklable, for spawned processes)
+
+    Returns:
+        Dict with the environment, per-stage results and peak RSS
+    """
+    if config["threads"]:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(config["threads"])
+        tf.config.threading.set_inter_op_parallelism_threads(config["threads"])
+    if config["model_path"]:
+        classify.MODEL_PATH = config["model_path"]
+
+    import tensorflow as tf
+    classify.load_model()
+
+    images = [image_bytes for _, image_bytes in config["images"]]
+    repeat, warmup = config["repeat"], config["warmup"]
+    results = []
+
+    def record(stage, batch_size, timings, n_iterations=None):
+        results.append({
+            "threads": config["threads"] or "default",
+            "stage": stage,
+            "batch_size": batch_size,
+            "n_iterations": n_iterations,
+            **latency_summary(timings, batch_size)
+        })
+
+    for batch_size in config["batch_sizes"]:
+        batch_images = [images[i % len(images)] for i in range(batch_size)]
+        img_batch = np.empty((batch_size, IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.float32)
+
+        def preprocess_batch():
+            for row, image_bytes in enumerate(batch_images):
+                preprocess_image(image_bytes, out=img_batch[row])
+
+        record("decode", batch_size, time_calls(lambda: [decode_only(b) for b in batch_images], repeat, warmup))
+        record("preprocess", batch_size, time_calls(preprocess_batch, repeat, warmup))
+        record("backbone", batch_size, time_calls(lambda: extract_features(img_batch), repeat, warmup))
+
+        features = extract_features(img_batch)
+        for n_iterations in config["n_iterations"]:
+            record("mc_head", batch_size, time_calls(
+                lambda: sample_mc_predictions(features, n_iterations), repeat, warmup
+            ), n_iterations)
+
+        n_default = config["n_iterations"][0]
+        samples = sample_mc_predictions(features, n_default)
+        record("stats", batch_size, time_calls(
+            lambda: summarize_batch(compute_statistics(samples), verbose=False), repeat, warmup
+        ), n_default)
+
+        results_batch = summarize_batch(compute_statistics(samples), verbose=False)
+        record("explanation", batch_size, time_calls(
+            lambda: [get_prediction_explanation(r) for r in results_batch], repeat, warmup
+        ))
+        record("json", batch_size, time_calls(lambda: [json.dumps(r) for r in results_batch], repeat, warmup))
+
+        def end_to_end():
+            preprocess_batch()
+            batch_results = summarize_batch(compute_statistics(
+                sample_mc_predictions(extract_features(img_batch), n_default)
+            ), verbose=False)
+            for r in batch_results:
+                r["explanation"] = get_prediction_explanation(r)
+                json.dumps(r)
+
+        record("end_to_end", batch_size, time_calls(end_to_end, repeat, warmup), n_default)
+
+    return {
+        "threads": config["threads"] or "default",
+        "tensorflow": tf.__version__,
+        "backbone_runtime": classify.BACKBONE_RUNTIME,
+        "peak_rss_mb": peak_rss_mb(),
+        "results": results
+    }
+
+
+def bench_pipeline(args):
+    images = load_images(args.images, args.synthetic, args.size)
+    base_config = {
+        "images": images,
+        "batch_sizes": args.batch_sizes,
+        "n_iterations": args.n_iterations,
+        "repeat": args.repeat,
+        "warmup": args.warmup,
+        "model_path": args.model
+    }
+
+    runs = []
+    for threads in args.threads:
+        config = {**base_config, "threads": threads}
+        print(f"🔄 Pipeline benchmark: threads={threads or 'default'}, batch sizes {args.batch_sizes}...")
+        if len(args.threads) == 1 and not args.isolate:
+            runs.append(run_pipeline(config))
+        else:
+            # Fresh process per thread count: TF thread pools can't be resized
+            with mp.get_context("spawn").Pool(1) as pool:
+                runs.append(pool.apply(run_pipeline, (config,)))
+
+    print(f"\nPipeline benchmark: {len(images)} source images, {args.repeat} timed calls per stage")
+    print(f"{'threads':>7s} {'stage':12s} {'batch':>5s} {'n':>4s} {'p50 ms':>9s} {'p95 ms':>9s} "
+          f"{'p99 ms':>9s} {'img/s':>9s}")
+    for run in runs:
+        for r in run["results"]:
+            n = str(r["n_iterations"]) if r["n_iterations"] is not None else "-"
+            print(f"{str(r['threads']):>7s} {r['stage']:12s} {r['batch_size']:5d} {n:>4s} {r['p50_ms']:9.2f} "
+                  f"{r['p95_ms']:9.2f} {r['p99_ms']:9.2f} {r['images_per_s']:9.1f}")
+        print(f"{str(run['threads']):>7s} peak RSS: {run['peak_rss_mb']} MB")
+
+    return {
+        "benchmark": "pipeline",
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "tensorflow": runs[0]["tensorflow"] if runs else None,
+            "backbone_runtime": runs[0]["backbone_runtime"] if runs else None
+        },
+        "config": {
+            "n_images": len(images),
+            "batch_sizes": args.batch_sizes,
+            "threads": args.threads,
+            "n_iterations": args.n_iterations,
+            "repeat": args.repeat,
+            "warmup": args.warmup
+        },
+        "peak_rss_mb": {str(run["threads"]): run["peak_rss_mb"] for run in runs},
+        "results": [r for run in runs for r in run["results"]]
+    }
+
+
+def _result_key(r):
+    return (str(r["threads"]), r["stage"], r["batch_size"], r["n_iterations"])
+
+
+def compare_results(baseline, current, metric="p50_ms", tolerance=0.15):
+    """
+    Match pipeline results by (threads, stage, batch_size, n_iterations).
+
+    Returns:
+        List of dicts with baseline, current and relative change; `regressed`
+        is set when current exceeds baseline by more than tolerance
+    """
+    baseline_by_key = {_result_key(r): r for r in baseline["results"]}
+    rows = []
+    for r in current["results"]:
+        before = baseline_by_key.get(_result_key(r))
+        if before is None or not before[metric]:
+            continue
+        change = r[metric] / before[metric] - 1.0
+        rows.append({
+            "key": _result_key(r),
+            "baseline": before[metric],
+            "current": r[metric],
+            "change": round(change, 4),
+            "regressed": change > tolerance
+        })
+    return rows
+
+
+def bench_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    rows = compare_results(baseline, current, args.metric, args.tolerance)
+    print(f"\n{args.metric}: {args.current} vs {args.baseline} (tolerance {args.tolerance:.0%})")
+    for row in rows:
+        threads, stage, batch_size, n = row["key"]
+        flag = "❌ REGRESSION" if row["regressed"] else ""
+        print(f"{threads:>7s} {stage:12s} {batch_size:5d} {str(n or '-'):>4s} "
+              f"{row['baseline']:9.2f} -> {row['current']:9.2f} ({row['change']:+.1%}) {flag}")
+
+    regressions = [row for row in rows if row["regressed"]]
+    print(f"\n{len(regressions)} regression(s) in {len(rows)} comparable results")
+    args.exit_code = 1 if regressions else 0
+    return {"benchmark": "compare", "metric": args.metric, "tolerance": args.tolerance, "rows": rows}
+
+
+def bench_cascade(args):
+    from cache import hash_bytes
+    from score_archive import iter_labelled_dir
+
+    items = list(iter_labelled_dir(args.images))[:args.limit or None]
+    if not items:
+        raise SystemExit(f"No images found in {args.images}")
+    cascade = classify.Cascade(args.confidence, args.uncertainty, args.max_entropy, args.fast_iterations)
+    try:
+        cascade.check_runtime(classify.get_registry().version().runtime)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    seed = classify.SEED_FROM_IMAGE  # Same dropout masks in both runs, so only the gate differs
+
+    full, cascaded, labels, failed = {}, {}, {}, {}
+    elapsed = {"full": 0.0, "cascade": 0.0}
+    warmed_up = False
+    for start in range(0, len(items), args.batch_size):
+        chunk = items[start:start + args.batch_size]
+        rows, decoded = [], []
+        for image_id, path, label in chunk:
+            try:
+                with open(path, "rb") as f:
+                    image_bytes = f.read()
+                rows.append(preprocess_image(image_bytes, debug=False)[0])
+            except Exception as e:
+                failed[image_id] = str(e)
+                continue
+            decoded.append((image_id, hash_bytes(image_bytes)))
+            labels[image_id] = label
+        if not rows:
+            continue
+        img_batch = np.stack(rows)
+
+        for name, settings, results in (("full", None, full), ("cascade", cascade, cascaded)):
+            # Built by hand so nothing is answered from the result cache
+            prepared = classify.PreparedBatch()
+            prepared.decoded, prepared.img_batch = decoded, img_batch
+            if not warmed_up:
+                list(classify.infer_prepared_batch(prepared, args.n_iterations, seed=seed, cascade=settings))
+            started = time.perf_counter()
+            for image_id, result, error in classify.infer_prepared_batch(
+                prepared, args.n_iterations, seed=seed, cascade=settings
+            ):
+                if error is None:
+                    results[image_id] = result
+            elapsed[name] += time.perf_counter() - started
+        warmed_up = True
+
+    if failed:
+        print(f"⚠️  Skipped {len(failed)} image(s) that could not be decoded")
+    image_ids = [image_id for image_id in full if image_id in cascaded]
+    accepted = [image_id for image_id in image_ids if cascaded[image_id]["cascade"]["stage"] == "fast"]
+    labelled = [image_id for image_id in image_ids if labels[image_id] is not None]
+
+    def rate(ids, predicate):
+        return round(sum(1 for image_id in ids if predicate(image_id)) / len(ids), 4) if ids else None
+
+    def agrees(image_id):
+        return cascaded[image_id]["class_name"] == full[image_id]["class_name"]
+
+    report = {
+        "benchmark": "cascade",
+        "n_images": len(image_ids),
+        "n_failed": len(failed),
+        "failed": failed,
+        "n_iterations": args.n_iterations,
+        "cascade": cascade.cache_tag,
+        "accepted_rate": rate(image_ids, lambda image_id: image_id in accepted),
+        "agreement": rate(image_ids, agrees),
+        "agreement_accepted": rate(accepted, agrees),
+        "accuracy_full": rate(labelled, lambda image_id: full[image_id]["class_name"] == labels[image_id]),
+        "accuracy_cascade": rate(labelled, lambda image_id: cascaded[image_id]["class_name"] == labels[image_id]),
+        "full_ms_per_image": round(elapsed["full"] * 1000.0 / max(len(image_ids), 1), 3),
+        "cascade_ms_per_image": round(elapsed["cascade"] * 1000.0 / max(len(image_ids), 1), 3)
+    }
+    report["speedup"] = round(elapsed["full"] / elapsed["cascade"], 2) if elapsed["cascade"] else None
+
+    print(f"\nCascade benchmark: {report['n_images']} images, {report['cascade']}")
+    for name, value in report.items():
+        if name not in ("benchmark", "cascade", "failed"):
+            print(f"{name:22s} {value}")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BayesDR inference benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pre = subparsers.add_parser("preprocess", help="Decode/resize speed and parity vs the original path")
+    pre.add_argument("--images", help="Directory of sample images (default: synthetic fundus photos)")
+    pre.add_argument("--synthetic", type=int, default=8, help="Number of synthetic images")
+    pre.add_argument("--size", default="3000x2000", help="Synthetic image size WxH")
+    pre.add_argument("--repeat", type=int, default=3, help="Timing repeats (best is reported)")
+    pre.add_argument("--filters", nargs="+", default=list(RESAMPLING_FILTERS), choices=list(RESAMPLING_FILTERS))
+    pre.add_argument("--output", help="Write results as JSON to this file")
+    pre.set_defaults(run=bench_preprocess)
+
+    pipe = subparsers.add_parser("pipeline", help="Per-stage latency, throughput and peak RSS")
+    pipe.add_argument("--images", help="Directory of sample images (default: synthetic fundus photos)")
+    pipe.add_argument("--synthetic", type=int, default=8, help="Number of synthetic images")
+    pipe.add_argument("--size", default="3000x2000", help="Synthetic image size WxH")
+    pipe.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    pipe.add_argument("--threads", type=int, nargs="+", default=[0],
+                      help="TF intra/inter-op thread counts to test (0 = TF default)")
+    pipe.add_argument("--n-iterations", type=int, nargs="+", default=[30, 10, 100],
+                      help="MC head sample counts; the first is used for stats and end to end")
+    pipe.add_argument("--repeat", type=int, default=10, help="Timed calls per stage")
+    pipe.add_argument("--warmup", type=int, default=2, help="Untimed calls per stage")
+    pipe.add_argument("--model", help="Model .h5 path (default: classify.MODEL_PATH)")
+    pipe.add_argument("--isolate", action="store_true",
+                      help="Run in a fresh process even for a single thread count (clean peak RSS)")
+    pipe.add_argument("--output", help="Write results as JSON to this file")
+    pipe.set_defaults(run=bench_pipeline)
+
+    cmp = subparsers.add_parser("compare", help="Fail on regressions against a baseline pipeline run")
+    cmp.add_argument("baseline", help="Baseline results JSON")
+    cmp.add_argument("current", help="New results JSON")
+    cmp.add_argument("--metric", default="p50_ms", choices=["p50_ms", "p95_ms", "p99_ms", "mean_ms"])
+    cmp.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative slowdown")
+    cmp.add_argument("--output", help="Write the comparison as JSON to this file")
+    cmp.set_defaults(run=bench_compare)
+
+    cas = subparsers.add_parser("cascade", help="Accuracy, agreement and speed of the cascade vs full MC Dropout")
+    cas.add_argument("--images", required=True, help="Validation images in class folders (No_DR, Mild, ... or 0-4)")
+    cas.add_argument("--limit", type=int, help="Use only the first N images")
+    cas.add_argument("--batch-size", type=int, default=32)
+    cas.add_argument("--n-iterations", type=int, default=30, help="MC samples of the full stage")
+    cas.add_argument("--confidence", help="Accepted confidence levels (default: BAYESDR_CASCADE_CONFIDENCE)")
+    cas.add_argument("--uncertainty", help="Accepted uncertainty levels (default: BAYESDR_CASCADE_UNCERTAINTY)")
+    cas.add_argument("--max-entropy", type=float, help="Largest accepted predictive entropy")
+    cas.add_argument("--fast-iterations", type=int, help="MC samples of the first stage (0 = dropout off)")
+    cas.add_argument("--output", help="Write results as JSON to this file")
+    cas.set_defaults(run=bench_cascade)
+
+    args = parser.parse_args(argv)
+    report = args.run(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    return getattr(args, "exit_code", 0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
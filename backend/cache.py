@@ -0,0 +1,261 @@
+"""
+Content-addressed cache for predictions and backbone features.
+
+Entries are keyed on the SHA-256 of the raw image bytes plus the model
+file fingerprint, so a re-submitted image skips decoding and the backbone.
+Two kinds of entries are stored:
+    - "result":   the final prediction dict (also keyed on n_iterations/seed)
+    - "features": the bn_1 feature vector, so a different n_iterations
+                  only reruns the cheap MC head
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# ✅ Cache configuration (override with environment variables)
+# The memory tier is per process: up to BAYESDR_CACHE_MB in every server process
+CACHE_MAX_BYTES = int(float(os.environ.get("BAYESDR_CACHE_MB", "256")) * 1024 * 1024)
+CACHE_DB_PATH = os.environ.get("BAYESDR_CACHE_DB", "")
+
+KINDS = ("result", "features")
+
+# Bump when the result dict changes, so stale cached results are not served
+RESULT_SCHEMA_VERSION = 5
+
+
+def hash_bytes(data):
+    """SHA-256 hex digest of raw bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_fingerprint(path, chunk_size=1024 * 1024):
+    """
+    SHA-256 hex digest of a file's contents, read in chunks.
+
+    For a directory (e.g. a SavedModel) every file is hashed, in sorted
+    order, together with its relative path.
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(root, name) for root, _, names in os.walk(path) for name in names
+        )
+    else:
+        files = [path]
+
+    for file_path in files:
+        if file_path != path:
+            digest.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def result_key(image_hash, model_fingerprint, n_iterations, seed=None):
+    """Cache key for a final prediction dict."""
+    return f"{model_fingerprint}:{image_hash}:n={n_iterations}:seed={seed}:v={RESULT_SCHEMA_VERSION}"
+
+
+def features_key(image_hash, model_fingerprint, batch_invariant=False):
+    """
+    Cache key for an image's bn_1 feature vector.
+
+    batch_invariant marks features computed in a way that does not depend on
+    the rest of the batch (see classify.extract_features()), as needed for
+    seeded, reproducible results.
+    """
+    key = f"{model_fingerprint}:{image_hash}"
+    return f"{key}:invariant" if batch_invariant else key
+
+
+class LRUCache:
+    """Thread-safe LRU of bytes values, bounded by total value size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+
+class SQLiteStore:
+    """On-disk cache tier that survives restarts."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for kind in KINDS:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {kind} (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        self._conn.commit()
+
+    def get(self, kind, key):
+        with self._lock:
+            row = self._conn.execute(f"SELECT value FROM {kind} WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, kind, key, value):
+        with self._lock:
+            self._conn.execute(f"INSERT OR REPLACE INTO {kind} (key, value) VALUES (?, ?)", (key, value))
+            self._conn.commit()
+
+    def count(self, kind):
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {kind}").fetchone()[0]
+
+
+class PredictionCache:
+    """
+    Two-tier cache: an in-memory LRU bounded by bytes, optionally backed by SQLite.
+
+    Results are stored as JSON and features as raw float32 bytes, so every
+    get() returns a fresh object that the caller is free to modify.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, db_path=CACHE_DB_PATH):
+        self.memory = LRUCache(max_bytes)
+        self.disk = SQLiteStore(db_path) if db_path else None
+        self._lock = threading.Lock()
+        self._counters = {kind: {"hits": 0, "disk_hits": 0, "misses": 0} for kind in KINDS}
+
+    @property
+    def enabled(self):
+        return self.memory.max_bytes > 0 or self.disk is not None
+
+    def _count(self, kind, counter):
+        with self._lock:
+            self._counters[kind][counter] += 1
+
+    def _get(self, kind, key):
+        if not self.enabled:
+            return None
+
+        value = self.memory.get(f"{kind}:{key}")
+        if value is not None:
+            self._count(kind, "hits")
+            return value
+
+        if self.disk is not None:
+            value = self.disk.get(kind, key)
+            if value is not None:
+                # Promote to the memory tier
+                self.memory.put(f"{kind}:{key}", value)
+                self._count(kind, "disk_hits")
+                return value
+
+        self._count(kind, "misses")
+        return None
+
+    def _put(self, kind, key, value):
+        if not self.enabled:
+            return
+        self.memory.put(f"{kind}:{key}", value)
+        if self.disk is not None:
+            self.disk.put(kind, key, value)
+
+    def get_result(self, key):
+        value = self._get("result", key)
+        return json.loads(value) if value is not None else None
+
+    def put_result(self, key, result):
+        self._put("result", key, json.dumps(result).encode("utf-8"))
+
+    def get_features(self, key):
+        value = self._get("features", key)
+        return np.frombuffer(value, dtype=np.float32).copy() if value is not None else None
+
+    def put_features(self, key, features):
+        self._put("features", key, np.asarray(features, dtype=np.float32).tobytes())
+
+    def clear(self):
+        """Drop the in-memory tier (the disk tier is kept)."""
+        self.memory.clear()
+
+    def stats(self):
+        """Hit/miss counters and memory usage."""
+        with self._lock:
+            counters = {kind: dict(values) for kind, values in self._counters.items()}
+
+        for values in counters.values():
+            lookups = values["hits"] + values["disk_hits"] + values["misses"]
+            values["hit_rate"] = round((values["hits"] + values["disk_hits"]) / lookups, 4) if lookups else 0.0
+
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.memory),
+            "size_bytes": self.memory.size_bytes,
+            "max_bytes": self.memory.max_bytes,
+            "evictions": self.memory.evictions,
+            "disk_path": self.disk.path if self.disk else None,
+            **counters
+        }
+
+
+# Global cache instance
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Get the shared PredictionCache, creating it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PredictionCache()
+    return _cache
+
+
+def configure(max_bytes=CACHE_MAX_BYTES, db_path=CACHE_DB_PATH):
+    """
+    Replace the shared PredictionCache, e.g. configure(0, "") to turn it off.
+
+    For processes where cached entries would never be read again (bulk
+    CLIs, pool workers whose results the front process caches).
+    """
+    global _cache
+    with _cache_lock:
+        _cache = PredictionCache(max_bytes, db_path)
+    return _cache
@@ -1,8 +1,22 @@
 import os
 import numpy as np
-from tensorflow import keras
 from PIL import Image
+import contextvars
 import io
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import metrics
+from cache import get_cache, hash_bytes, file_fingerprint, result_key, features_key
+from registry import ModelNotLoaded, ModelRegistry
+from runtimes import RUNTIMES, KerasBackbone, load_backbone, load_head_layers
+from uncertainty import MCStatistics, compute_statistics
+
+logger = logging.getLogger(__name__)
 
 # Path to the trained model
 MODEL_PATH = os.path.join(
@@ -21,190 +35,1892 @@ labels = {
     "Proliferate_DR": "Proliferative Diabetic Retinopathy"
 }
 
-# Global model variable
-_model = None
+# ✅ Decision thresholds used to label results (tune by re-scoring stored
+# features, see feature_store.py)
+THRESHOLDS = {
+    "confidence_high": 0.8,       # confidence >= this: "High"
+    "confidence_medium": 0.6,     # confidence >= this: "Medium", else "Low"
+    "uncertainty_low": 0.05,      # uncertainty <= this: "Low"
+    "uncertainty_medium": 0.10,   # uncertainty <= this: "Medium", else "High"
+    "reliable_confidence": 0.7,   # reliable_prediction needs confidence >= this
+    "reliable_uncertainty": 0.10, # ... and uncertainty <= this
+    "cascade_max_entropy": 0.5    # cascade: first-stage results need predictive entropy <= this
+}
 
-def load_model():
-    """Load the trained BCNN model with proper compilation."""
-    global _model
-    if _model is None:
+# Layer where the deterministic backbone ends and the MC Dropout head begins
+FEATURE_LAYER = "bn_1"
+
+# Head layers (in order) of the MC Dropout head; everything from the first
+# dropout on is re-run for every Monte Carlo sample, dense_1 once per image
+HEAD_LAYERS = [
+    "dense_1",
+    "bayesian_dropout_1",
+    "dense_2",
+    "bayesian_dropout_2",
+    "dense_3",
+    "bayesian_dropout_3",
+    "output"
+]
+
+# ✅ Set BAYESDR_XLA=1 to JIT-compile the MC head with XLA
+USE_XLA = os.environ.get("BAYESDR_XLA", "0") == "1"
+
+# TensorFlow is imported lazily (inside load_model and friends), so importing
+# this module and starting the web server stay fast
+_IMPORTED_AT = time.time()
+
+# ✅ Backbone runtime: keras (reference), tflite, onnx or savedmodel (files from export_model.py)
+BACKBONE_RUNTIME = os.environ.get("BAYESDR_BACKBONE_RUNTIME", "keras").lower()
+BACKBONE_PATH = os.environ.get("BAYESDR_BACKBONE_PATH", "")
+# Head weights for exported backbones; default: head.npz next to BACKBONE_PATH
+HEAD_PATH = os.environ.get("BAYESDR_HEAD_PATH", "")
+RUNTIME_THREADS = int(os.environ.get("BAYESDR_RUNTIME_THREADS", "0"))  # 0 = runtime default
+
+# ✅ Set BAYESDR_STAND_IN=tiny|densenet to serve a randomly initialized model with
+# the same layers instead of MODEL_PATH (load tests and CI, see stand_in.py)
+STAND_IN = os.environ.get("BAYESDR_STAND_IN", "").lower()
+STAND_IN_SEED = int(os.environ.get("BAYESDR_STAND_IN_SEED", "0"))
+
+# ✅ Dummy batch run after loading so the first request doesn't pay warm-up costs (0 = off)
+WARMUP_BATCH_SIZE = int(os.environ.get("BAYESDR_WARMUP_BATCH", "1"))
+
+# Model input size (width, height)
+IMAGE_SIZE = (224, 224)
+
+# ✅ Decompression-bomb limit (width x height); uploads are checked against it from
+# their headers, and PIL refuses to decode anything over twice as large
+MAX_IMAGE_PIXELS = int(os.environ.get("BAYESDR_MAX_IMAGE_PIXELS", str(40_000_000)))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Resampling filters for the 224x224 resize, cheapest first.
+# Training images were already 224x224, so Keras never resized them.
+RESAMPLING_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS
+}
+
+# ✅ Preprocessing options (override with environment variables)
+RESAMPLE_FILTER = os.environ.get("BAYESDR_RESAMPLE", "lanczos")
+USE_JPEG_DRAFT = os.environ.get("BAYESDR_JPEG_DRAFT", "1") == "1"
+DEBUG_PREPROCESS = os.environ.get("BAYESDR_DEBUG_PREPROCESS", "0") == "1"
+
+# ✅ Adaptive MC Dropout defaults (override with environment variables)
+ADAPTIVE_TOLERANCE = float(os.environ.get("BAYESDR_ADAPTIVE_TOLERANCE", "0.005"))
+ADAPTIVE_MIN_ITERATIONS = int(os.environ.get("BAYESDR_ADAPTIVE_MIN_ITERATIONS", "10"))
+ADAPTIVE_MAX_ITERATIONS = int(os.environ.get("BAYESDR_ADAPTIVE_MAX_ITERATIONS", "100"))
+ADAPTIVE_CHUNK_SIZE = int(os.environ.get("BAYESDR_ADAPTIVE_CHUNK_SIZE", "10"))
+ADAPTIVE_ITERATIONS_LIMIT = 500  # Upper bound for client-supplied max_iterations
+
+# ✅ Deterministic MC Dropout: BAYESDR_MC_SEED=image seeds every request's dropout
+# masks from the image hash, an integer seeds them with that value; requests can
+# override it with ?seed=image|<int>|random. Empty = TF's global RNG (stochastic)
+SEED_FROM_IMAGE = "image"
+DEFAULT_MC_SEED = os.environ.get("BAYESDR_MC_SEED", "").lower()
+SEED_LIMIT = 2**63  # Seeds are 64-bit, split into a stateless RNG seed pair
+
+# ✅ Test-time augmentation (?tta=1): views of each image, as a comma-separated
+# list of identity, hflip, vflip and rot<degrees> (e.g. rot10, rot-10)
+TTA_VIEWS = os.environ.get("BAYESDR_TTA_VIEWS", "identity,hflip,vflip,rot10,rot-10")
+TTA_MAX_VIEWS = 16  # Upper bound for client-supplied tta_views
+TTA_MAX_ROTATION = 45  # degrees
+# Per-view fields reported under result["tta"]["per_view"]
+TTA_VIEW_FIELDS = ("predicted_class", "class_name", "confidence", "uncertainty", "predictive_entropy",
+                   "mutual_information", "probabilities", "n_iterations")
+
+# ✅ Uncertainty-gated cascade (BAYESDR_CASCADE=1 or ?cascade=1): a cheap first stage
+# answers confident images, the rest escalate to the full backbone + MC Dropout.
+# A first-stage result is kept when its confidence_level and uncertainty_level
+# (same THRESHOLDS as every result) are among the accepted ones and its entropy
+# is at most THRESHOLDS["cascade_max_entropy"]
+CASCADE_BY_DEFAULT = os.environ.get("BAYESDR_CASCADE", "0") == "1"
+CASCADE_ACCEPT_CONFIDENCE = os.environ.get("BAYESDR_CASCADE_CONFIDENCE", "High")
+CASCADE_ACCEPT_UNCERTAINTY = os.environ.get("BAYESDR_CASCADE_UNCERTAINTY", "Low")
+# MC samples in the first stage; 0 = one deterministic pass with dropout off
+CASCADE_FAST_ITERATIONS = int(os.environ.get("BAYESDR_CASCADE_FAST_ITERATIONS", "0"))
+# Cheaper first-stage backbone (tflite/onnx from export_model.py, e.g. int8). Empty =
+# share the main backbone, so escalated images reuse their features
+CASCADE_BACKBONE_RUNTIME = os.environ.get("BAYESDR_CASCADE_BACKBONE_RUNTIME", "").lower()
+CASCADE_BACKBONE_PATH = os.environ.get("BAYESDR_CASCADE_BACKBONE_PATH", "")
+LEVELS = ("High", "Medium", "Low")
+
+# ✅ Model versions (see registry.py). The configured model is registered as
+# BAYESDR_MODEL_NAME; BAYESDR_MODELS="v2=path/to/bayesian_densenet_final_v2.h5,..." adds
+# more, with the runtime taken from the path (.h5/.keras, .tflite, .onnx, or a
+# SavedModel artifact directory). BAYESDR_CANDIDATE_MODEL gets
+# BAYESDR_CANDIDATE_PERCENT of the requests that do not ask for a version
+DEFAULT_MODEL_NAME = os.environ.get("BAYESDR_MODEL_NAME", "default")
+MODEL_VERSIONS = os.environ.get("BAYESDR_MODELS", "")
+ACTIVE_MODEL = os.environ.get("BAYESDR_ACTIVE_MODEL", "")  # Empty = DEFAULT_MODEL_NAME
+CANDIDATE_MODEL = os.environ.get("BAYESDR_CANDIDATE_MODEL", "")
+CANDIDATE_PERCENT = float(os.environ.get("BAYESDR_CANDIDATE_PERCENT", "0"))
+
+# Global model variables
+_registry = None
+_registry_lock = threading.Lock()
+_pinned_model = contextvars.ContextVar("bayesdr_model", default=None)
+_cascade_backbone = None
+_cascade_fingerprint = None
+_startup_timings = {}
+
+def _build_mc_head(layers, feature_dim):
+    """Chain the head layers into a Keras model with dropout always active."""
+    from tensorflow import keras
+    
+    head_input = keras.Input(shape=(feature_dim,), name="features")
+    x = head_input
+    for layer in layers:
+        if "dropout" in layer.name:
+            # Enable dropout permanently for MC sampling
+            x = layer(x, training=True)
+        else:
+            x = layer(x)
+    
+    return keras.Model(inputs=head_input, outputs=x, name="mc_head")
+
+def _build_split_models(model):
+    """
+    Split the trained model into a backbone and an MC Dropout head.
+    
+    The backbone (DenseNet + bn_1) always runs in inference mode, the head
+    always runs with dropout active. Both share weights with `model`.
+    
+    Returns:
+        Tuple of (feature_extractor, mc_head) Keras models
+    """
+    from tensorflow import keras
+    
+    feature_extractor = keras.Model(
+        inputs=model.input,
+        outputs=model.get_layer(FEATURE_LAYER).output,
+        name="backbone"
+    )
+    
+    mc_head = _build_mc_head(
+        [model.get_layer(layer_name) for layer_name in HEAD_LAYERS],
+        feature_extractor.output_shape[-1]
+    )
+    
+    return feature_extractor, mc_head
+
+def _split_head(mc_head):
+    """
+    Split the MC head at its first dropout layer.
+    
+    Returns:
+        Tuple of (prefix, stochastic) layer lists: the prefix (dense_1) is
+        deterministic and only needs to run once per image, not once per sample
+    """
+    from tensorflow import keras
+    
+    layers = [layer for layer in mc_head.layers if not isinstance(layer, keras.layers.InputLayer)]
+    first_dropout = next((i for i, layer in enumerate(layers) if "dropout" in layer.name), len(layers))
+    return layers[:first_dropout], layers[first_dropout:]
+
+def _keep_mask(rows, units, rate, seed):
+    """
+    Boolean dropout keep mask of shape (rows, units) from a stateless seed.
+    
+    For rate 0.5 (as trained) every random 32-bit word is unpacked into 32
+    exact Bernoulli(0.5) draws, 32x fewer RNG calls than one uniform float per
+    unit. Other rates fall back to comparing uniform floats with the rate.
+    Both generators are prefix-stable in `rows`. Philox is pinned so XLA
+    (which would pick its own algorithm) produces the same masks.
+    """
+    import tensorflow as tf
+    
+    if rate != 0.5:
+        return tf.random.stateless_uniform([rows, units], seed=seed, alg="philox") >= rate
+    
+    n_words = (units + 31) // 32
+    words = tf.random.stateless_uniform(
+        [rows, n_words], seed=seed, minval=None, maxval=None, dtype=tf.uint32, alg="philox"
+    )
+    bits = tf.bitwise.bitwise_and(words[..., tf.newaxis], tf.constant([1 << i for i in range(32)], dtype=tf.uint32))
+    return tf.reshape(bits != 0, [rows, n_words * 32])[:, :units]
+
+def _apply_dropout(x, keep, rate):
+    import tensorflow as tf
+    return tf.where(keep, x * (1.0 / (1.0 - rate)), tf.zeros_like(x))
+
+def _build_mc_sampler(mc_head, feature_dim, jit_compile=False):
+    """
+    Wrap the MC head into a single graph-compiled sampling function.
+    
+    The returned function takes features of shape (N, feature_dim) and a
+    scalar n_iterations, and returns MC samples of shape (N, n_iterations, 5).
+    The fixed input signature means it is traced once, for any N and n_iterations.
+    
+    The deterministic prefix (dense_1) runs once per image; only the layers
+    from the first dropout on run once per sample, with masks drawn as in
+    _keep_mask() from a fresh random seed per call.
+    """
+    import tensorflow as tf
+    
+    prefix, stochastic = _split_head(mc_head)
+    
+    @tf.function(
+        input_signature=[
+            tf.TensorSpec(shape=[None, feature_dim], dtype=tf.float32),
+            tf.TensorSpec(shape=[], dtype=tf.int32)
+        ],
+        jit_compile=jit_compile
+    )
+    def mc_sampler(features, n_iterations):
+        n_images = tf.shape(features)[0]
+        x = features
+        for layer in prefix:
+            x = layer(x)
+        
+        # (N, 512) -> (N*T, 512): rows [i*T, (i+1)*T) belong to image i
+        x = tf.repeat(x, repeats=n_iterations, axis=0)
+        rows = tf.shape(x)[0]
+        call_seed = tf.random.uniform([2], maxval=tf.int64.max, dtype=tf.int64)
+        for layer_index, layer in enumerate(stochastic):
+            if "dropout" in layer.name:
+                seed = tf.random.experimental.stateless_fold_in(call_seed, layer_index)
+                x = _apply_dropout(x, _keep_mask(rows, tf.shape(x)[-1], layer.rate, seed), layer.rate)
+            else:
+                x = layer(x)
+        return tf.reshape(x, [n_images, n_iterations, -1])
+    
+    return mc_sampler
+
+def _seeded_dropout(x, rate, seeds, layer_index, n_iterations, offset):
+    """
+    Dropout on (N*T, units) rows whose masks depend only on each image's seed.
+    
+    Image i draws one mask stream per layer from (seeds[i], layer_index);
+    sample t uses row offset + t of it. A sample's mask therefore does not
+    depend on which other images share the batch, nor on how the samples are
+    chunked (stateless Philox streams are prefix-stable).
+    """
+    import tensorflow as tf
+    
+    units = tf.shape(x)[-1]
+    
+    def draw(seed):
+        seed = tf.random.experimental.stateless_fold_in(seed, layer_index)
+        return _keep_mask(offset + n_iterations, units, rate, seed)[offset:]
+    
+    keep = tf.map_fn(draw, seeds, fn_output_signature=tf.bool) # Shape: (N, T, units)
+    return _apply_dropout(x, tf.reshape(keep, [-1, units]), rate)
+
+def _build_seeded_mc_sampler(mc_head, feature_dim, jit_compile=False):
+    """
+    Like _build_mc_sampler(), but with per-image stateless dropout masks.
+    
+    The returned function takes features (N, feature_dim), a scalar
+    n_iterations, int64 seed pairs (N, 2) and the scalar index of the first
+    sample (for drawing more samples later), and returns (N, n_iterations, 5).
+    Dense layers are shared with mc_head; its Dropout layers are replaced by
+    _seeded_dropout() with the same rates.
+    """
+    import tensorflow as tf
+    
+    prefix, stochastic = _split_head(mc_head)
+    
+    @tf.function(
+        input_signature=[
+            tf.TensorSpec(shape=[None, feature_dim], dtype=tf.float32),
+            tf.TensorSpec(shape=[], dtype=tf.int32),
+            tf.TensorSpec(shape=[None, 2], dtype=tf.int64),
+            tf.TensorSpec(shape=[], dtype=tf.int32)
+        ],
+        jit_compile=jit_compile
+    )
+    def seeded_mc_sampler(features, n_iterations, seeds, offset):
+        n_images = tf.shape(features)[0]
+        
+        # A single-row matmul takes a different CPU kernel path (last-bit
+        # differences), so the prefix always sees at least two rows
+        x = tf.concat([features, features[:1]], axis=0)
+        for layer in prefix:
+            x = layer(x)
+        
+        x = tf.repeat(x[:n_images], repeats=n_iterations, axis=0)
+        for layer_index, layer in enumerate(stochastic, start=len(prefix)):
+            if "dropout" in layer.name:
+                x = _seeded_dropout(x, layer.rate, seeds, layer_index, n_iterations, offset)
+            else:
+                x = layer(x)
+        return tf.reshape(x, [n_images, n_iterations, -1])
+    
+    return seeded_mc_sampler
+
+def _build_deterministic_head(mc_head, feature_dim, jit_compile=False):
+    """
+    The head as one deterministic pass (dropout off, as in model.predict()).
+    
+    The returned function maps features (N, feature_dim) to probabilities (N, 5).
+    """
+    import tensorflow as tf
+    
+    prefix, stochastic = _split_head(mc_head)
+    layers = [layer for layer in prefix + stochastic if "dropout" not in layer.name]
+    
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, feature_dim], dtype=tf.float32)], jit_compile=jit_compile)
+    def deterministic_head(features):
+        x = features
+        for layer in layers:
+            x = layer(x)
+        return x
+    
+    return deterministic_head
+
+def _head_path():
+    return HEAD_PATH or os.path.join(os.path.dirname(BACKBONE_PATH), "head.npz")
+
+def _load_keras_model(model_path=None, stand_in=None):
+    """Load the full .h5 model (inference only, no optimizer state)."""
+    from tensorflow import keras
+    
+    model_path = MODEL_PATH if model_path is None else model_path
+    stand_in = STAND_IN if stand_in is None else stand_in
+    if stand_in:
+        from stand_in import build_stand_in_model
+        logger.warning("⚠️  Using the '%s' stand-in model (random weights), not %s", stand_in, model_path)
+        model = build_stand_in_model(stand_in, STAND_IN_SEED)
+    else:
+        logger.info("Loading model from: %s", model_path)
+        model = keras.models.load_model(model_path, compile=False)
+    logger.info("   Input shape: %s, output shape: %s", model.input_shape, model.output_shape)
+    return model
+
+class ModelVersion:
+    """
+    A registered model version: a name and where its weights come from.
+    
+    Args:
+        name: Version name, as in ?model= and the responses' model_version
+        runtime: Backbone runtime (see runtimes.RUNTIMES)
+        path: The .h5 model for keras, else the exported backbone file/artifact
+        head_path: head.npz for tflite/onnx (default: next to the backbone)
+        model_path: .h5 model the tflite/onnx head falls back to without head.npz
+        stand_in: Stand-in model name (keras only, see stand_in.py)
+    """
+    
+    def __init__(self, name, runtime, path, head_path=None, model_path=None, stand_in=""):
+        if runtime not in RUNTIMES:
+            raise ValueError(f"Unknown backbone runtime '{runtime}'. Use one of: {', '.join(RUNTIMES)}")
+        self.name = name
+        self.runtime = runtime
+        self.path = path
+        self.head_path = head_path or os.path.join(os.path.dirname(path), "head.npz")
+        self.model_path = model_path or MODEL_PATH
+        self.stand_in = stand_in
+        self._fingerprint = None
+    
+    @classmethod
+    def from_path(cls, name, path):
+        """
+        A version from a model file, with the runtime its extension implies.
+        
+        Raises:
+            ValueError: If the path does not exist
+        """
+        if not os.path.exists(path):
+            raise ValueError(f"Model file for version '{name}' not found: {path}")
+        if os.path.isdir(path):
+            runtime = "savedmodel"
+        else:
+            runtime = {".tflite": "tflite", ".onnx": "onnx"}.get(os.path.splitext(path)[1].lower(), "keras")
+        return cls(name, runtime, path)
+    
+    def __eq__(self, other):
+        return isinstance(other, ModelVersion) and self._spec() == other._spec()
+    
+    def _spec(self):
+        return (self.name, self.runtime, self.path, self.head_path, self.model_path, self.stand_in)
+    
+    @property
+    def fingerprint(self):
+        """
+        SHA-256 of the version's weights (hashed once; does not load the model).
+        
+        Exported backbones change the features slightly, so they get their own
+        fingerprint and never share cache entries with the Keras model.
+        """
+        if self._fingerprint is None:
+            if self.stand_in and self.runtime == "keras":
+                self._fingerprint = hash_bytes(f"stand-in:{self.stand_in}:{STAND_IN_SEED}".encode())
+            elif self.runtime == "keras":
+                self._fingerprint = file_fingerprint(self.path)
+            elif self.runtime == "savedmodel":
+                # The artifact directory holds both the backbone and the head
+                self._fingerprint = hash_bytes(f"{self.runtime}:{file_fingerprint(self.path)}".encode())
+            else:
+                head_path = self.head_path if os.path.exists(self.head_path) else self.model_path
+                parts = [self.runtime, file_fingerprint(self.path), file_fingerprint(head_path)]
+                self._fingerprint = hash_bytes(":".join(parts).encode())
+        return self._fingerprint
+    
+    def describe(self):
+        """Name, runtime, path and fingerprint, for health checks."""
         try:
-            print(f"Loading model from: {MODEL_PATH}")
-            
-            # Load model without compilation first
-            _model = keras.models.load_model(MODEL_PATH, compile=False)
+            fingerprint = self.fingerprint[:16]
+        except OSError:
+            fingerprint = None  # Weights file missing; loading will say so
+        return {
+            "name": self.name,
+            "runtime": self.runtime,
+            "path": f"stand-in:{self.stand_in}" if self.stand_in else self.path,
+            "fingerprint": fingerprint
+        }
+
+class LoadedModel:
+    """The backbone, MC head and compiled samplers of a loaded ModelVersion."""
+    
+    def __init__(self, version):
+        self.version = version
+        self.model = None               # Full Keras model (keras runtime, or the .h5 head fallback)
+        self.backbone = None            # Callable images -> bn_1 features (see runtimes.py)
+        self.mc_head = None             # MC head Keras model (None for savedmodel)
+        self.mc_sampler = None
+        self.seeded_mc_sampler = None
+        self.deterministic_head = None
+        self.timings = {}
+    
+    @property
+    def name(self):
+        return self.version.name
+    
+    @property
+    def fingerprint(self):
+        return self.version.fingerprint
+
+def _load_version(version):
+    """
+    Load and warm up a model version (the registry's loader).
+    
+    With the keras runtime the full .h5 model is loaded and split. With
+    tflite/onnx the exported backbone is loaded instead, and the head comes
+    from head.npz (falling back to the .h5 model when there is none). With
+    savedmodel, both come pre-traced from the serving artifact.
+    
+    Returns:
+        LoadedModel
+        
+    Raises:
+        ValueError: When the cascade is on by default and its first stage
+                    cannot run on this version's runtime
+    """
+    if CASCADE_BY_DEFAULT:
+        # ✅ Fail at load time, not on every cascaded batch
+        Cascade().check_runtime(version.runtime)
+    
+    try:
+        started = time.perf_counter()
+        import tensorflow  # noqa: F401  (timed separately from loading)
+        if not _startup_timings:
+            _startup_timings["tensorflow_import_s"] = round(time.perf_counter() - started, 3)
+        started = time.perf_counter()
+        
+        loaded = LoadedModel(version)
+        if version.runtime == "keras":
+            loaded.model = _load_keras_model(version.path, version.stand_in)
             
-            # ✅ PENTING: Compile ulang dengan optimizer yang sama seperti training
-            _model.compile(
-                optimizer=keras.optimizers.Adam(learning_rate=1e-4),
-                loss='categorical_crossentropy',
-                metrics=['accuracy']
-            )
+            # ✅ Build backbone/head split once, not on every request
+            feature_extractor, loaded.mc_head = _build_split_models(loaded.model)
+            loaded.backbone = KerasBackbone(feature_extractor)
+        elif version.runtime == "savedmodel":
+            # ✅ Prebuilt artifact: no .h5 parsing, no graph rebuild, no re-tracing
+            logger.info("Loading serving artifact from: %s", version.path)
+            loaded.backbone = load_backbone(version.runtime, version.path)
+        else:
+            logger.info("Loading %s backbone from: %s", version.runtime, version.path)
+            loaded.backbone = load_backbone(version.runtime, version.path, RUNTIME_THREADS)
             
-            print("✅ Model loaded and compiled successfully!")
-            print(f"   Input shape: {_model.input_shape}")
-            print(f"   Output shape: {_model.output_shape}")
+            if os.path.exists(version.head_path):
+                layers, feature_dim = load_head_layers(version.head_path)
+            else:
+                loaded.model = _load_keras_model(version.model_path, stand_in="")
+                layers = [loaded.model.get_layer(layer_name) for layer_name in HEAD_LAYERS]
+                feature_dim = loaded.model.get_layer(FEATURE_LAYER).output.shape[-1]
             
-        except Exception as e:
-            print(f"❌ Error loading model: {str(e)}")
-            raise
+            if feature_dim != loaded.backbone.feature_dim:
+                raise ValueError(f"Head expects {feature_dim} features, backbone returns {loaded.backbone.feature_dim}")
+            loaded.mc_head = _build_mc_head(layers, feature_dim)
+        
+        if version.runtime == "savedmodel":
+            loaded.mc_sampler = loaded.backbone.mc_sampler
+            loaded.seeded_mc_sampler = loaded.backbone.seeded_mc_sampler
+        else:
+            loaded.mc_sampler = _build_mc_sampler(
+                loaded.mc_head,
+                feature_dim=loaded.backbone.feature_dim,
+                jit_compile=USE_XLA
+            )
+            loaded.seeded_mc_sampler = _build_seeded_mc_sampler(
+                loaded.mc_head,
+                feature_dim=loaded.backbone.feature_dim,
+                jit_compile=USE_XLA
+            )
+            loaded.deterministic_head = _build_deterministic_head(
+                loaded.mc_head,
+                feature_dim=loaded.backbone.feature_dim,
+                jit_compile=USE_XLA
+            )
+        
+        # Fingerprint of the weights file(s), part of every cache key
+        _ = version.fingerprint
+        loaded.timings["model_load_s"] = round(time.perf_counter() - started, 3)
+        
+        logger.info("✅ Model version '%s' loaded successfully! (backbone runtime: %s)", version.name, version.runtime)
+        
+        if WARMUP_BATCH_SIZE > 0:
+            started = time.perf_counter()
+            with use_model(loaded):
+                warm_up(WARMUP_BATCH_SIZE)
+            loaded.timings["warmup_s"] = round(time.perf_counter() - started, 3)
+        
+        if "time_to_ready_s" not in _startup_timings:
+            _startup_timings.update(loaded.timings)
+            _startup_timings["time_to_ready_s"] = round(time.time() - _IMPORTED_AT, 3)
+            logger.info("⏱️  Ready %.2fs after start (TF import %.2fs, load %.2fs, warm-up %.2fs)",
+                        _startup_timings["time_to_ready_s"], _startup_timings["tensorflow_import_s"],
+                        _startup_timings["model_load_s"], _startup_timings.get("warmup_s", 0.0))
+        
+        return loaded
     
-    return _model
+    except Exception as e:
+        logger.error("❌ Error loading model version '%s': %s", version.name, e)
+        raise
 
-def preprocess_image(image_bytes):
+def _default_version():
+    """The model configured by BAYESDR_BACKBONE_RUNTIME/PATH, MODEL_PATH and BAYESDR_STAND_IN."""
+    if BACKBONE_RUNTIME == "keras":
+        return ModelVersion(DEFAULT_MODEL_NAME, "keras", MODEL_PATH, stand_in=STAND_IN)
+    return ModelVersion(DEFAULT_MODEL_NAME, BACKBONE_RUNTIME, BACKBONE_PATH, head_path=_head_path(),
+                        model_path=MODEL_PATH)
+
+def get_registry():
     """
-    Preprocess the uploaded image for model prediction.
-    Using DenseNet specific preprocessing.
+    The model registry, built on first use from the configuration (loads nothing).
+    
+    Raises:
+        ValueError: For a malformed BAYESDR_MODELS or unknown version names
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            registry = ModelRegistry(_load_version)
+            registry.register(_default_version())
+            for entry in filter(None, (entry.strip() for entry in MODEL_VERSIONS.split(","))):
+                name, sep, path = entry.partition("=")
+                if not sep or not name.strip() or not path.strip():
+                    raise ValueError(f"BAYESDR_MODELS entries must look like name=path, got '{entry}'")
+                registry.register(ModelVersion.from_path(name.strip(), path.strip()))
+            if ACTIVE_MODEL:
+                registry.version(ACTIVE_MODEL)
+                registry.active = ACTIVE_MODEL
+            if CANDIDATE_MODEL:
+                registry.set_candidate(CANDIDATE_MODEL, CANDIDATE_PERCENT, preload=False)
+            _registry = registry
+        return _registry
+
+def resolve_model(model=None):
+    """
+    The LoadedModel for a version name, a ModelVersion (as the front process
+    routed it to a worker), a LoadedModel, or None for the active version.
+    
+    Raises:
+        ModelNotLoaded: For a name that is not in memory and is neither the
+                        active version nor the candidate (see ModelRegistry.acquire),
+                        or a ModelVersion that is not loaded as routed (a worker
+                        loads versions when it follows the front process, never
+                        for a request)
+    """
+    if isinstance(model, LoadedModel):
+        return model
+    registry = get_registry()
+    if isinstance(model, ModelVersion):
+        if registry.version(model.name) != model:
+            raise ModelNotLoaded(f"Model version '{model.name}' is not loaded as routed in this process")
+        return registry.acquire(model.name, load=False)
+    return registry.acquire(model)
+
+@contextmanager
+def use_model(model=None):
+    """
+    Run the block on one model version, loading it if needed.
+    
+    Everything in the block (backbone, samplers, cache keys) uses the pinned
+    version, even if another one is activated meanwhile.
+    
+    Args:
+        model: Anything resolve_model() takes
+        
+    Yields:
+        The LoadedModel
     """
+    loaded = resolve_model(model)
+    token = _pinned_model.set(loaded)
     try:
-        from tensorflow.keras.applications.densenet import preprocess_input
+        yield loaded
+    finally:
+        _pinned_model.reset(token)
+
+def current_model():
+    """The LoadedModel pinned by use_model(), else the active one (loaded if needed)."""
+    loaded = _pinned_model.get()
+    return loaded if loaded is not None else get_registry().acquire()
+
+def load_model():
+    """
+    Load the active model version if it is not loaded yet (see _load_version()).
+    
+    Returns:
+        The full Keras model, or None when running an exported backbone
+    """
+    return current_model().model
+
+def warm_up(batch_size=1, n_iterations=30):
+    """
+    Run a dummy batch through the backbone and the MC sampler.
+    
+    The first call of each pays one-off costs (graph building, kernel
+    selection, buffer allocation); this moves them out of the first request.
+    """
+    dummy = np.zeros((batch_size, IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.float32)
+    features = extract_features(dummy)
+    sample_mc_predictions(features, n_iterations)
+    if DEFAULT_MC_SEED and current_model().seeded_mc_sampler is not None:
+        sample_mc_predictions(features, n_iterations, seeds=np.zeros((batch_size, 2), dtype=np.int64))
+
+def get_startup_timings():
+    """
+    Cold-start breakdown in seconds: TensorFlow import, model load, warm-up
+    and time_to_ready_s (from this module's import to ready to serve).
+    Empty until the model has been loaded.
+    """
+    return dict(_startup_timings)
+
+def get_model_info():
+    """Active version, its runtime and tensor shapes, for health checks."""
+    loaded = current_model()
+    return {
+        "model_version": loaded.name,
+        "backbone_runtime": loaded.version.runtime,
+        "backbone_path": loaded.version.path,
+        "input_shape": str((None, IMAGE_SIZE[1], IMAGE_SIZE[0], 3)),
+        "feature_dim": int(loaded.backbone.feature_dim),
+        "output_shape": str((None, len(CLASS_NAMES)))
+    }
+
+def get_split_models():
+    """
+    Get the prebuilt backbone and MC Dropout head, loading the model if needed.
+    
+    Returns:
+        Tuple of (backbone, mc_head): a callable mapping images to bn_1
+        features (see runtimes.py) and the MC head Keras model (None for
+        the savedmodel runtime, whose head is only available traced)
+    """
+    loaded = current_model()
+    return loaded.backbone, loaded.mc_head
+
+def get_model_fingerprint(model=None):
+    """
+    SHA-256 of the weights in use (see ModelVersion.fingerprint; does not load the model).
+    
+    Args:
+        model: Version name; default the version pinned by use_model(), else the active one
+    """
+    pinned = _pinned_model.get()
+    if model is None and pinned is not None:
+        return pinned.fingerprint
+    return get_registry().version(model).fingerprint
+
+def get_cascade_backbone():
+    """
+    The cascade's first-stage backbone, loading it on first use.
+    
+    Returns:
+        A runtimes.py backbone, or None when the first stage shares the main one
+    """
+    global _cascade_backbone
+    # The exported first-stage backbone belongs to the configured model, not to other versions
+    if not CASCADE_BACKBONE_RUNTIME or current_model().name != DEFAULT_MODEL_NAME:
+        return None
+    if _cascade_backbone is None:
+        backbone, _ = get_split_models()
+        logger.info("Loading %s cascade backbone from: %s", CASCADE_BACKBONE_RUNTIME, CASCADE_BACKBONE_PATH)
+        fast_backbone = load_backbone(CASCADE_BACKBONE_RUNTIME, CASCADE_BACKBONE_PATH, RUNTIME_THREADS)
+        if fast_backbone.feature_dim != backbone.feature_dim:
+            raise ValueError(f"Cascade backbone returns {fast_backbone.feature_dim} features, "
+                             f"the head expects {backbone.feature_dim}")
+        _cascade_backbone = fast_backbone
+    return _cascade_backbone
+
+def get_cascade_fingerprint():
+    """Identifies the first-stage backbone in cache keys ("shared" for the main one)."""
+    global _cascade_fingerprint
+    if _cascade_fingerprint is None:
+        if CASCADE_BACKBONE_RUNTIME:
+            _cascade_fingerprint = f"{CASCADE_BACKBONE_RUNTIME}-{file_fingerprint(CASCADE_BACKBONE_PATH)[:16]}"
+        else:
+            _cascade_fingerprint = "shared"
+    return _cascade_fingerprint
+
+def deterministic_predictions(features):
+    """
+    One pass of the head with dropout off.
+    
+    Args:
+        features: bn_1 features, shape (N, 1024)
         
-        # Open image from bytes
-        img = Image.open(io.BytesIO(image_bytes))
+    Returns:
+        Numpy array of probabilities, shape (N, 5)
+    """
+    import tensorflow as tf
+    
+    loaded = current_model()
+    if loaded.deterministic_head is None:
+        raise RuntimeError("This serving artifact has no deterministic head; "
+                           "set BAYESDR_CASCADE_FAST_ITERATIONS to sample the first stage instead")
+    return loaded.deterministic_head(tf.constant(np.asarray(features, dtype=np.float32))).numpy()
+
+def sample_mc_predictions(features, n_iterations=30, seeds=None, offset=0):
+    """
+    Run the MC Dropout head n_iterations times on backbone features.
+    
+    Args:
+        features: bn_1 features, shape (1024,) for one image or (N, 1024) for a batch
+        n_iterations: Number of MC samples per image
+        seeds: Optional int64 seed pairs, shape (2,) or (N, 2) (see mc_seeds());
+               dropout masks then come from a stateless RNG instead of TF's global one
+        offset: With seeds, index of the first sample to draw (samples
+                offset .. offset + n_iterations - 1 of each image's sequence)
         
-        # Convert to RGB if necessary
-        if img.mode != "RGB":
-            img = img.convert("RGB")
+    Returns:
+        Numpy array of shape (n_iterations, 5) for one image, or (N, n_iterations, 5)
+    """
+    import tensorflow as tf
+    
+    loaded = current_model()
+    
+    features = np.asarray(features, dtype=np.float32)
+    single = features.ndim == 1
+    if single:
+        features = features[np.newaxis, :]
+    
+    if seeds is None:
+        samples = loaded.mc_sampler(tf.constant(features), tf.constant(n_iterations, dtype=tf.int32)).numpy()
+    else:
+        if loaded.seeded_mc_sampler is None:
+            raise RuntimeError("This serving artifact has no seeded MC sampler; re-export it with export_model.py")
+        samples = loaded.seeded_mc_sampler(
+            tf.constant(features),
+            tf.constant(n_iterations, dtype=tf.int32),
+            tf.constant(np.asarray(seeds, dtype=np.int64).reshape(-1, 2)),
+            tf.constant(offset, dtype=tf.int32)
+        ).numpy()
+    
+    return samples[0] if single else samples
+
+def parse_seed(value):
+    """
+    Parse a seed setting: 'image', a non-negative integer, or ''/'random'/'none'.
+    
+    Returns:
+        SEED_FROM_IMAGE, an int, or None for stochastic sampling
         
-        # Resize to 224x224
-        img = img.resize((224, 224), Image.Resampling.LANCZOS)
+    Raises:
+        ValueError: For anything else
+    """
+    value = str(value).strip().lower()
+    if value in ("", "random", "none"):
+        return None
+    if value == SEED_FROM_IMAGE:
+        return SEED_FROM_IMAGE
+    try:
+        seed = int(value)
+    except ValueError:
+        raise ValueError("seed must be 'image', 'random' or an integer")
+    if not 0 <= seed < SEED_LIMIT:
+        raise ValueError(f"seed must be between 0 and {SEED_LIMIT - 1}")
+    return seed
+
+def seed_from_params(params):
+    """
+    Read the MC Dropout seed from request query parameters (?seed=...).
+    
+    Returns:
+        SEED_FROM_IMAGE, an int, or None; BAYESDR_MC_SEED when absent
+        
+    Raises:
+        ValueError: For malformed seeds
+    """
+    return parse_seed(params.get("seed", DEFAULT_MC_SEED))
+
+def mc_seeds(image_hashes, seed):
+    """
+    Per-image stateless RNG seed pairs for deterministic MC Dropout.
+    
+    Args:
+        image_hashes: SHA-256 hex digests of the images
+        seed: SEED_FROM_IMAGE (seed each image from its own hash), an int
+              (same seed for every image), or None
+        
+    Returns:
+        int64 array of shape (N, 2), or None for stochastic sampling
+    """
+    if seed is None:
+        return None
+    if seed == SEED_FROM_IMAGE:
+        values = [int(image_hash[:16], 16) for image_hash in image_hashes]
+    else:
+        values = [int(seed)] * len(image_hashes)
+    return np.array([(value >> 32, value & 0xFFFFFFFF) for value in values], dtype=np.int64)
+
+class AdaptiveSampling:
+    """
+    Settings for adaptive MC Dropout.
+    
+    Samples are drawn in chunks of chunk_size until the running mean, std and
+    predictive entropy all move less than tolerance between chunks, bounded by
+    min_iterations and max_iterations.
+    """
+    
+    def __init__(self, tolerance=None, min_iterations=None, max_iterations=None, chunk_size=None):
+        self.tolerance = ADAPTIVE_TOLERANCE if tolerance is None else float(tolerance)
+        self.min_iterations = ADAPTIVE_MIN_ITERATIONS if min_iterations is None else int(min_iterations)
+        self.max_iterations = ADAPTIVE_MAX_ITERATIONS if max_iterations is None else int(max_iterations)
+        self.chunk_size = ADAPTIVE_CHUNK_SIZE if chunk_size is None else int(chunk_size)
         
-        # Convert to numpy array
-        img_array = np.array(img, dtype=np.float32)
+        if self.chunk_size < 1 or self.min_iterations < 1 or self.max_iterations < self.min_iterations:
+            raise ValueError("Adaptive sampling needs chunk_size >= 1 and 1 <= min_iterations <= max_iterations")
+    
+    @classmethod
+    def from_params(cls, params, default=False):
+        """
+        Build settings from request query parameters.
         
-        # ✅ Normalize to [0, 1] (Match training: rescale=1./255)
-        img_array = img_array / 255.0
+        Args:
+            params: Mapping of strings: adaptive=1, plus optional tolerance,
+                    min_iterations, max_iterations
+            default: Whether adaptive mode is on when `adaptive` is absent
+            
+        Returns:
+            AdaptiveSampling, or None for the fixed n_iterations mode
+            
+        Raises:
+            ValueError: For malformed or out-of-range settings
+        """
+        enabled = params.get("adaptive", "1" if default else "0")
+        if str(enabled).lower() not in ("1", "true"):
+            return None
         
-        # Add batch dimension
-        img_array = np.expand_dims(img_array, axis=0)
+        def number(name, cast):
+            value = params.get(name)
+            if value in (None, ""):
+                return None
+            try:
+                return cast(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{name} must be a number")
         
-        # 🔍 Debug: Print image stats
-        print(f"   Image stats: min={img_array.min():.4f}, max={img_array.max():.4f}, mean={img_array.mean():.4f}")
+        adaptive = cls(
+            tolerance=number("tolerance", float),
+            min_iterations=number("min_iterations", int),
+            max_iterations=number("max_iterations", int)
+        )
+        if adaptive.max_iterations > ADAPTIVE_ITERATIONS_LIMIT:
+            raise ValueError(f"max_iterations must be at most {ADAPTIVE_ITERATIONS_LIMIT}")
         
-        return img_array
+        return adaptive
     
-    except Exception as e:
-        raise ValueError(f"Error preprocessing image: {str(e)}")
+    @property
+    def cache_tag(self):
+        """Stands in for n_iterations in cache keys and batch grouping."""
+        return f"adaptive:{self.min_iterations}-{self.max_iterations}/{self.chunk_size}@{self.tolerance}"
 
-def predict_with_uncertainty(image_bytes, n_iterations=30):
+class TestTimeAugmentation:
+    """
+    Settings for test-time augmentation (TTA) combined with MC Dropout.
+    
+    Every image is expanded into len(views) augmented views (flips and small
+    rotations about the centre), the backbone runs once on all views and the
+    MC head samples every view, so each image's statistics cover the
+    views x n_iterations grid.
     """
-    Make prediction with Monte Carlo Dropout for uncertainty estimation.
+    
+    def __init__(self, views=None):
+        views = TTA_VIEWS if views is None else views
+        if isinstance(views, str):
+            views = [view.strip().lower() for view in views.split(",") if view.strip()]
+        self.views = list(views)
+        
+        if not 1 <= len(self.views) <= TTA_MAX_VIEWS:
+            raise ValueError(f"TTA needs between 1 and {TTA_MAX_VIEWS} views")
+        if len(set(self.views)) != len(self.views):
+            raise ValueError("TTA views must not repeat")
+        for view in self.views:
+            _view_transform(view, *IMAGE_SIZE)  # Validates the name
+    
+    @classmethod
+    def from_params(cls, params):
+        """
+        Build settings from request query parameters.
+        
+        Args:
+            params: Mapping of strings: tta=1, plus optional tta_views
+                    (comma-separated, default TTA_VIEWS)
+            
+        Returns:
+            TestTimeAugmentation, or None when TTA is off
+            
+        Raises:
+            ValueError: For unknown or too many views
+        """
+        if str(params.get("tta", "0")).lower() not in ("1", "true"):
+            return None
+        return cls(params.get("tta_views") or None)
+    
+    @property
+    def cache_tag(self):
+        """Part of the MC config in cache keys and batch grouping."""
+        return "tta:" + ",".join(self.views)
+    
+    def transforms(self, width, height):
+        """Projective transforms (output pixel -> input pixel) of the views, shape (K, 8)."""
+        return np.array([_view_transform(view, width, height) for view in self.views], dtype=np.float32)
+
+def _view_transform(view, width, height):
+    """
+    The 8 projective transform coefficients of a TTA view.
+    
+    Raises:
+        ValueError: For an unknown view name or a rotation beyond TTA_MAX_ROTATION
+    """
+    if view == "identity":
+        return [1, 0, 0, 0, 1, 0, 0, 0]
+    if view == "hflip":
+        return [-1, 0, width - 1, 0, 1, 0, 0, 0]
+    if view == "vflip":
+        return [1, 0, 0, 0, -1, height - 1, 0, 0]
+    if view.startswith("rot"):
+        try:
+            degrees = float(view[3:])
+        except ValueError:
+            degrees = None
+        if degrees is not None and abs(degrees) <= TTA_MAX_ROTATION:
+            # Rotate about the image centre
+            cos, sin = np.cos(np.radians(degrees)), np.sin(np.radians(degrees))
+            cx, cy = (width - 1) / 2, (height - 1) / 2
+            return [cos, -sin, cx - cos * cx + sin * cy, sin, cos, cy - sin * cx - cos * cy, 0, 0]
+    raise ValueError(f"Unknown TTA view '{view}'. Use identity, hflip, vflip or rot<degrees> "
+                     f"(at most {TTA_MAX_ROTATION})")
+
+class Cascade:
+    """
+    Settings for the uncertainty-gated inference cascade.
+    
+    The first stage runs the cascade backbone (or the main one) and the head
+    with dropout off, or with fast_iterations MC samples. Its result is kept
+    when its confidence_level is in accept_confidence, its uncertainty_level in
+    accept_uncertainty and its predictive entropy is at most max_entropy;
+    otherwise the image escalates to the full backbone + MC Dropout. With a
+    deterministic first stage the uncertainty is 0, so only confidence and
+    entropy gate.
+    """
+    
+    def __init__(self, accept_confidence=None, accept_uncertainty=None, max_entropy=None, fast_iterations=None):
+        self.accept_confidence = _parse_levels(
+            CASCADE_ACCEPT_CONFIDENCE if accept_confidence is None else accept_confidence
+        )
+        self.accept_uncertainty = _parse_levels(
+            CASCADE_ACCEPT_UNCERTAINTY if accept_uncertainty is None else accept_uncertainty
+        )
+        self.max_entropy = THRESHOLDS["cascade_max_entropy"] if max_entropy is None else float(max_entropy)
+        self.fast_iterations = CASCADE_FAST_ITERATIONS if fast_iterations is None else int(fast_iterations)
+        
+        if self.fast_iterations < 0 or self.fast_iterations > ADAPTIVE_ITERATIONS_LIMIT:
+            raise ValueError(f"Cascade fast_iterations must be between 0 and {ADAPTIVE_ITERATIONS_LIMIT}")
+    
+    @classmethod
+    def from_params(cls, params, default=False):
+        """
+        Build settings from request query parameters.
+        
+        Args:
+            params: Mapping of strings: cascade=1, plus optional cascade_confidence
+                    and cascade_uncertainty (comma-separated levels) and
+                    cascade_max_entropy
+            default: Whether the cascade is on when `cascade` is absent
+            
+        Returns:
+            Cascade, or None for the full pipeline only
+            
+        Raises:
+            ValueError: For malformed settings
+        """
+        enabled = params.get("cascade", "1" if default else "0")
+        if str(enabled).lower() not in ("1", "true"):
+            return None
+        
+        max_entropy = params.get("cascade_max_entropy")
+        try:
+            max_entropy = float(max_entropy) if max_entropy not in (None, "") else None
+        except ValueError:
+            raise ValueError("cascade_max_entropy must be a number")
+        
+        return cls(
+            accept_confidence=params.get("cascade_confidence") or None,
+            accept_uncertainty=params.get("cascade_uncertainty") or None,
+            max_entropy=max_entropy
+        )
+    
+    def check_runtime(self, runtime):
+        """
+        Reject a first stage that the backbone runtime cannot run.
+        
+        Args:
+            runtime: Backbone runtime of the model version (ModelVersion.runtime)
+            
+        Raises:
+            ValueError: For a deterministic first stage (fast_iterations=0) on the
+                        savedmodel runtime, whose artifact has no deterministic head
+        """
+        if self.fast_iterations == 0 and runtime == "savedmodel":
+            raise ValueError("The savedmodel runtime has no deterministic head for the cascade's first stage; "
+                             "set BAYESDR_CASCADE_FAST_ITERATIONS to sample it instead")
+    
+    @property
+    def cache_tag(self):
+        """Part of the MC config in cache keys and batch grouping."""
+        return (f"cascade:{get_cascade_fingerprint()}:{self.fast_iterations}:{','.join(self.accept_confidence)}"
+                f":{','.join(self.accept_uncertainty)}@{self.max_entropy}")
+    
+    def accepts(self, results):
+        """Boolean array: which first-stage result dicts are kept."""
+        return np.array([
+            result["confidence_level"] in self.accept_confidence
+            and result["uncertainty_level"] in self.accept_uncertainty
+            and result["predictive_entropy"] <= self.max_entropy
+            for result in results
+        ], dtype=bool)
+
+def _parse_levels(levels):
+    if isinstance(levels, str):
+        levels = [level.strip().capitalize() for level in levels.split(",") if level.strip()]
+    unknown = [level for level in levels if level not in LEVELS]
+    if unknown or not levels:
+        raise ValueError(f"Cascade levels must be among: {', '.join(LEVELS)}")
+    return tuple(sorted(set(levels), key=LEVELS.index))
+
+def mc_config_tag(n_iterations=30, adaptive=None, tta=None, cascade=None):
+    """
+    The MC settings as one value, for cache keys and grouping requests.
+    
+    Raises:
+        ValueError: For adaptive sampling combined with TTA (not supported)
+    """
+    if adaptive is not None and tta is not None:
+        raise ValueError("Adaptive sampling cannot be combined with TTA")
+    if tta is not None:
+        tag = f"{n_iterations}/{tta.cache_tag}"
+    else:
+        tag = adaptive.cache_tag if adaptive is not None else n_iterations
+    return f"{tag}/{cascade.cache_tag}" if cascade is not None else tag
+
+def _convergence_estimates(statistics, rows):
+    """Mean, std and predictive entropy the adaptive stopping rule watches."""
+    return (
+        statistics.mean(rows),
+        statistics.std(rows),
+        statistics.predictive_entropy(rows)[:, np.newaxis]
+    )
+
+def sample_mc_predictions_adaptive(features, adaptive, seeds=None):
+    """
+    Draw MC Dropout samples in chunks until each image's estimates converge.
+    
+    All still-active images are sampled together in one head call per chunk;
+    images drop out of the batch as soon as they converge. Samples are folded
+    into running statistics and not kept.
     
     Args:
-        image_bytes: Raw bytes of the uploaded image
-        n_iterations: Number of forward passes for uncertainty estimation (default: 30)
+        features: bn_1 features, shape (N, 1024)
+        adaptive: AdaptiveSampling settings
+        seeds: Optional per-image seed pairs (N, 2) for deterministic sampling;
+               each chunk continues the image's own sample sequence
         
     Returns:
-        Dictionary containing prediction results with uncertainty metrics
+        Tuple of (statistics, converged): an uncertainty.MCStatistics over the
+        N images (statistics.count holds each image's number of samples) and a
+        boolean array telling which images converged before max_iterations
     """
-    try:
-        # Load model
-        model = load_model()
-        
-        # Preprocess image
-        img_array = preprocess_image(image_bytes)
-        
-        # ✅ Perform Standard Prediction first
-        print(f"🔄 Running standard prediction (training=False)...")
-        standard_pred = model.predict(img_array, verbose=0)[0]
-        
-        # ✅ MC DROPOUT FIX: SPLIT INFERENCE
-        # The Backbone (DenseNet + BN) MUST run in inference mode (training=False).
-        # The Head (Dense + Dropout) MUST run in training mode (training=True).
-        # We manually feed features through the head layers.
-        
-        print(f"🔄 Running MC Dropout via Split Inference (n={n_iterations})...")
-        
-        # 1. Extract features using the backbone (up to bn_1)
-        # We create a temporary model or just get the layer output function
-        feature_extractor = keras.Model(inputs=model.input, outputs=model.get_layer('bn_1').output)
-        features = feature_extractor(img_array, training=False) # Shape: (1, 1024)
-        
-        # 2. Get Head Layers
-        head_layers = [
-            model.get_layer('dense_1'),
-            model.get_layer('bayesian_dropout_1'),
-            model.get_layer('dense_2'),
-            model.get_layer('bayesian_dropout_2'),
-            model.get_layer('dense_3'),
-            model.get_layer('bayesian_dropout_3'),
-            model.get_layer('output')
-        ]
-        
-        # 3. Replicate features for batch processing
-        # Features are constant for all iterations
-        batch_features = np.tile(features, (n_iterations, 1))
-        
-        # 4. Pass through head layers manually
-        x = batch_features
-        for layer in head_layers:
-            if 'dropout' in layer.name:
-                # Enable dropout!
-                x = layer(x, training=True)
-            else:
-                x = layer(x)
-                
-        mc_predictions = x.numpy()
+    n_images = len(features)
+    statistics = MCStatistics(n_images, len(CLASS_NAMES))
+    previous = None
+    converged = np.zeros(n_images, dtype=bool)
+    active = np.arange(n_images)
+    drawn = 0
+    
+    while len(active) and drawn < adaptive.max_iterations:
+        chunk = min(adaptive.chunk_size, adaptive.max_iterations - drawn)
+        chunk_seeds = None if seeds is None else seeds[active]
+        samples = sample_mc_predictions(features[active], chunk, seeds=chunk_seeds, offset=drawn)
+        statistics.update(samples, rows=active) # Chunk shape: (A, chunk, 5)
+        drawn += chunk
         
-        # Compute Bayesian statistics
-        mean_prediction = np.mean(mc_predictions, axis=0) # Shape: (5,)
-        std_prediction = np.std(mc_predictions, axis=0)   # Shape: (5,)
+        estimates = np.concatenate(_convergence_estimates(statistics, active), axis=1)
+        if drawn >= adaptive.min_iterations and previous is not None:
+            change = np.max(np.abs(estimates - previous[active]), axis=1)
+            done = change < adaptive.tolerance
+            converged[active[done]] = True
+        else:
+            done = np.zeros(len(active), dtype=bool)
         
-        # Get predicted class from Mean Prediction
-        predicted_class = int(np.argmax(mean_prediction))
-        predicted_class_name = CLASS_NAMES[predicted_class]
+        if previous is None:
+            previous = np.zeros((n_images, estimates.shape[1]))
+        previous[active] = estimates
+        active = active[~done]
+    
+    return statistics, converged
+
+def preprocess_image(image_bytes, out=None, resample=None, draft=None, debug=None):
+    """
+    Preprocess the uploaded image for model prediction.
+    
+    Matches training: RGB, 224x224, rescaled to [0, 1] (rescale=1./255).
+    
+    Args:
+        image_bytes: Raw bytes of the uploaded image
+        out: Optional float32 buffer of shape (224, 224, 3) or (1, 224, 224, 3)
+             to write into, e.g. one row of a preallocated batch
+        resample: Resampling filter name (see RESAMPLING_FILTERS), default RESAMPLE_FILTER
+        draft: Use JPEG draft (DCT-scaled) decoding, default USE_JPEG_DRAFT
+        debug: Log image stats at DEBUG level, default DEBUG_PREPROCESS
         
-        # Get confidence (probability of predicted class)
-        confidence = float(mean_prediction[predicted_class])
+    Returns:
+        Image array of shape (1, 224, 224, 3), or `out` when given
+    """
+    resample = RESAMPLE_FILTER if resample is None else resample
+    draft = USE_JPEG_DRAFT if draft is None else draft
+    debug = DEBUG_PREPROCESS if debug is None else debug
+    
+    try:
+        if resample not in RESAMPLING_FILTERS:
+            raise ValueError(f"Unknown resampling filter '{resample}'. Use one of: {', '.join(RESAMPLING_FILTERS)}")
         
-        # ✅ Compute uncertainty metrics
-        # 1. Class-specific uncertainty
-        class_uncertainty = float(std_prediction[predicted_class])
+        with metrics.span("decode"):
+            # Open image from bytes
+            img = Image.open(io.BytesIO(image_bytes))
+            
+            # ✅ JPEG: let libjpeg decode at 1/2, 1/4 or 1/8 scale, still >= 224px
+            if draft and img.format == "JPEG":
+                img.draft("RGB", IMAGE_SIZE)
+            
+            # Decode now, so the time is not charged to the resize
+            img.load()
+            
+            # Convert to RGB if necessary
+            if img.mode != "RGB":
+                img = img.convert("RGB")
         
-        # 2. Overall prediction uncertainty (mean std across all classes)
-        overall_uncertainty = float(np.mean(std_prediction))
+        with metrics.span("resize"):
+            # Resize to 224x224
+            if img.size != IMAGE_SIZE:
+                img = img.resize(IMAGE_SIZE, RESAMPLING_FILTERS[resample])
+            
+            pixels = np.asarray(img, dtype=np.uint8)
+            
+            if out is None:
+                out = np.empty((1, IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.float32)
+            
+            # ✅ Normalize to [0, 1] in place (Match training: rescale=1./255)
+            np.divide(pixels, np.float32(255.0), out=out.reshape(pixels.shape), dtype=np.float32)
         
-        # 3. Predictive entropy (measure of total uncertainty)
-        predictive_entropy = float(-np.sum(mean_prediction * np.log(mean_prediction + 1e-10)))
+        # 🔍 Debug: Log image stats (three extra reductions, so only when asked for)
+        if debug and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("   Image stats: min=%.4f, max=%.4f, mean=%.4f", out.min(), out.max(), out.mean())
         
-        # ✅ Confidence interpretation
-        confidence_level = "High" if confidence >= 0.8 else "Medium" if confidence >= 0.6 else "Low"
-        uncertainty_level = "Low" if overall_uncertainty <= 0.05 else "Medium" if overall_uncertainty <= 0.10 else "High"
+        return out
+    
+    except Exception as e:
+        raise ValueError(f"Error preprocessing image: {str(e)}")
+
+def extract_features(img_batch, batch_invariant=False):
+    """
+    Run the backbone (up to bn_1) in inference mode on a batch of images.
+    
+    Args:
+        img_batch: Preprocessed images, shape (N, 224, 224, 3)
+        batch_invariant: Return features bit-identical to those the image
+                         gets in any other batch. CPU kernels take a different
+                         path for a single image (last-bit differences), so a
+                         batch of one is padded to two.
         
-        print(f"\n📊 Prediction Results:")
-        print(f"   Class: {predicted_class_name}")
-        print(f"   Confidence: {confidence:.2%}")
-        print(f"   Uncertainty: {overall_uncertainty:.4f}")
-        print(f"   Entropy: {predictive_entropy:.4f}")
+    Returns:
+        Numpy array of bn_1 features, shape (N, 1024)
+    """
+    backbone, _ = get_split_models()
+    if batch_invariant and len(img_batch) == 1:
+        return backbone(np.concatenate([img_batch, img_batch]))[:1]
+    return backbone(img_batch)
+
+def summarize_batch(statistics, thresholds=None, verbose=True):
+    """
+    Build the response dicts for a batch of images from their MC statistics.
+    
+    All metrics and threshold labels are computed as arrays; only the final
+    per-image dicts are assembled in Python.
+    
+    Args:
+        statistics: Dict of arrays from uncertainty.compute_statistics() or
+                    MCStatistics.summary()
+        thresholds: Optional overrides for THRESHOLDS (same keys)
+        verbose: Log each result summary at DEBUG level
         
-        return {
+    Returns:
+        List of dictionaries containing prediction results with uncertainty metrics
+    """
+    thresholds = THRESHOLDS if thresholds is None else {**THRESHOLDS, **thresholds}
+    
+    mean_prediction = statistics["mean"] # Shape: (N, 5)
+    std_prediction = statistics["std"]   # Shape: (N, 5)
+    rows = np.arange(len(mean_prediction))
+    
+    # Get predicted class from Mean Prediction
+    predicted_class = np.argmax(mean_prediction, axis=1)
+    
+    # Get confidence (probability of predicted class)
+    confidence = mean_prediction[rows, predicted_class]
+    
+    # ✅ Compute uncertainty metrics
+    # 1. Class-specific uncertainty
+    class_uncertainty = std_prediction[rows, predicted_class]
+    
+    # 2. Overall prediction uncertainty (mean std across all classes)
+    overall_uncertainty = np.mean(std_prediction, axis=1)
+    
+    # ✅ Confidence interpretation
+    confidence_level = np.where(
+        confidence >= thresholds["confidence_high"], "High",
+        np.where(confidence >= thresholds["confidence_medium"], "Medium", "Low")
+    )
+    uncertainty_level = np.where(
+        overall_uncertainty <= thresholds["uncertainty_low"], "Low",
+        np.where(overall_uncertainty <= thresholds["uncertainty_medium"], "Medium", "High")
+    )
+    reliable = (
+        (confidence >= thresholds["reliable_confidence"])
+        & (overall_uncertainty <= thresholds["reliable_uncertainty"])
+    )
+    
+    verbose = verbose and logger.isEnabledFor(logging.DEBUG)
+    results = []
+    for i in rows:
+        class_name = CLASS_NAMES[predicted_class[i]]
+        result = {
             # Primary results
-            "predicted_class": predicted_class,
-            "class_name": predicted_class_name,
-            "class_label": labels[predicted_class_name],
-            "confidence": confidence,
-            "confidence_level": confidence_level,
+            "predicted_class": int(predicted_class[i]),
+            "class_name": class_name,
+            "class_label": labels[class_name],
+            "confidence": float(confidence[i]),
+            "confidence_level": str(confidence_level[i]),
             
             # Uncertainty metrics
-            "uncertainty": overall_uncertainty,
-            "class_uncertainty": class_uncertainty,
-            "predictive_entropy": predictive_entropy,
-            "uncertainty_level": uncertainty_level,
+            "uncertainty": float(overall_uncertainty[i]),
+            "class_uncertainty": float(class_uncertainty[i]),
+            "predictive_entropy": float(statistics["predictive_entropy"][i]),
+            "uncertainty_level": str(uncertainty_level[i]),
+            
+            # Bayesian decomposition of the predictive entropy
+            "expected_entropy": float(statistics["expected_entropy"][i]),
+            "mutual_information": float(statistics["mutual_information"][i]),
+            "variation_ratio": float(statistics["variation_ratio"][i]),
             
             # Detailed probabilities
-            "probabilities": [float(p) for p in mean_prediction],
-            "std_deviations": [float(s) for s in std_prediction],
+            "probabilities": mean_prediction[i].astype(float).tolist(),
+            "std_deviations": std_prediction[i].astype(float).tolist(),
             "class_names": CLASS_NAMES,
             
             # Metadata
-            "n_iterations": n_iterations,
-            "reliable_prediction": confidence >= 0.7 and overall_uncertainty <= 0.10
+            "n_iterations": int(statistics["n_samples"][i]),
+            "reliable_prediction": bool(reliable[i])
+        }
+        results.append(result)
+        
+        if verbose:
+            logger.debug("📊 Prediction: %s, confidence %.2f%%, uncertainty %.4f, entropy %.4f (MI: %.4f)",
+                         class_name, result["confidence"] * 100, result["uncertainty"],
+                         result["predictive_entropy"], result["mutual_information"])
+    
+    return results
+
+def summarize_predictions(mc_predictions, n_iterations=None, thresholds=None, verbose=True):
+    """
+    Compute Bayesian statistics and the response dict from MC samples of one image.
+    
+    Args:
+        mc_predictions: MC Dropout samples, shape (n_iterations, 5)
+        n_iterations: Optional number of samples that were drawn, checked
+                      against mc_predictions
+        thresholds: Optional overrides for THRESHOLDS (same keys)
+        verbose: Log the result summary at DEBUG level
+        
+    Returns:
+        Dictionary containing prediction results with uncertainty metrics
+        
+    Raises:
+        ValueError: If mc_predictions does not hold n_iterations samples of one image
+    """
+    mc_predictions = np.asarray(mc_predictions)
+    if mc_predictions.ndim != 2 or (n_iterations is not None and len(mc_predictions) != n_iterations):
+        raise ValueError(f"Expected MC samples of shape ({n_iterations or 'n_iterations'}, {len(CLASS_NAMES)}), "
+                         f"got {mc_predictions.shape}")
+    return summarize_batch(compute_statistics(mc_predictions), thresholds, verbose)[0]
+
+def augment_views(img_batch, tta):
+    """
+    Expand a batch of images into their TTA views with one projective-transform op.
+    
+    Args:
+        img_batch: Preprocessed images, shape (N, 224, 224, 3)
+        tta: TestTimeAugmentation settings
+        
+    Returns:
+        Numpy array of shape (N * K, 224, 224, 3); rows [i*K, (i+1)*K) are
+        image i's views, in tta.views order. Pixels rotated in from outside
+        the image are black, like the fundus background.
+    """
+    import tensorflow as tf
+    
+    n_views = len(tta.views)
+    height, width = img_batch.shape[1:3]
+    transforms = np.tile(tta.transforms(width, height), (len(img_batch), 1))
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=tf.repeat(tf.constant(img_batch, dtype=tf.float32), n_views, axis=0),
+        transforms=tf.constant(transforms),
+        output_shape=tf.constant([height, width], dtype=tf.int32),
+        fill_value=tf.constant(0.0),
+        interpolation="BILINEAR",
+        fill_mode="CONSTANT"
+    ).numpy()
+
+def view_seeds(seeds, n_views):
+    """
+    Per-view seed pairs for seeded TTA: (N, 2) -> (N * K, 2).
+    
+    View 0 keeps the image's own seed; the others get it mixed with the view
+    index, so every view draws its own dropout masks.
+    """
+    if seeds is None:
+        return None
+    seeds = np.repeat(seeds, n_views, axis=0)
+    seeds[:, 1] ^= np.tile(np.arange(n_views, dtype=np.int64) * 0x9E3779B9 & 0xFFFFFFFF, len(seeds) // n_views)
+    return seeds
+
+def summarize_tta_batch(samples, tta, thresholds=None, verbose=True):
+    """
+    Build the response dicts for TTA samples.
+    
+    Args:
+        samples: MC samples of all views, shape (N * K, T, 5) as laid out by augment_views()
+        tta: TestTimeAugmentation settings
+        
+    Returns:
+        Tuple of (statistics, results): statistics over each image's K x T
+        grid, and the summarize_batch() dicts with an extra "tta" entry holding
+        the per-view breakdown, augmentation_uncertainty (mean std of the
+        per-view mean probabilities) and view_agreement (share of views
+        predicting the final class). n_iterations stays the MC passes per
+        view (T), as without TTA; n_augmentations is K.
+    """
+    n_views = len(tta.views)
+    n_samples = samples.shape[1]
+    grid = samples.reshape(-1, n_views * n_samples, samples.shape[2]) # Shape: (N, K*T, 5)
+    statistics = compute_statistics(grid)
+    results = summarize_batch(statistics, thresholds, verbose)
+    
+    view_statistics = compute_statistics(samples)
+    view_results = summarize_batch(view_statistics, thresholds, verbose=False)
+    view_means = view_statistics["mean"].reshape(-1, n_views, samples.shape[2]) # Shape: (N, K, 5)
+    augmentation_uncertainty = view_means.std(axis=1).mean(axis=1)
+    
+    for i, result in enumerate(results):
+        result["n_iterations"] = n_samples
+        result["n_augmentations"] = n_views
+        per_view = view_results[i * n_views:(i + 1) * n_views]
+        agreeing = sum(view["predicted_class"] == result["predicted_class"] for view in per_view)
+        result["tta"] = {
+            "views": tta.views,
+            "augmentation_uncertainty": float(augmentation_uncertainty[i]),
+            "view_agreement": agreeing / n_views,
+            "per_view": [
+                {"view": name, **{field: view[field] for field in TTA_VIEW_FIELDS}}
+                for name, view in zip(tta.views, per_view)
+            ]
         }
     
+    return statistics, results
+
+class PreparedBatch:
+    """A mini-batch after cache lookup and decoding, ready for the backbone."""
+    
+    def __init__(self):
+        self.cached = []     # (key, result) served from the result cache
+        self.failures = []   # (key, exception) for images that failed to decode
+        self.known = []      # (key, image_hash, features) with cached bn_1 features
+        self.decoded = []    # (key, image_hash) for the rows of img_batch
+        self.img_batch = None
+
+def prepare_batch(items, n_iterations=30, adaptive=None, seed=None, executor=None, tta=None, cascade=None):
+    """
+    Look up the cache and preprocess a mini-batch of images.
+    
+    Only images with neither a cached result nor cached features are decoded.
+    
+    Args:
+        items: Iterable of (key, image_bytes); keys are passed through untouched
+        n_iterations: Number of MC Dropout samples per image
+        adaptive: Optional AdaptiveSampling settings (replaces n_iterations)
+        seed: Optional MC Dropout seed (see mc_seeds()); None = stochastic
+        executor: Optional concurrent.futures executor to decode the images in
+                  parallel (PIL releases the GIL while decoding and resizing)
+        tta: Optional TestTimeAugmentation settings; the views need the pixels,
+             so cached features are not used
+        cascade: Optional Cascade settings
+        
+    Returns:
+        PreparedBatch for infer_prepared_batch()
+        
+    Raises:
+        ValueError: For adaptive sampling combined with TTA
+    """
+    cache = get_cache()
+    fingerprint = get_model_fingerprint()
+    mc_config = mc_config_tag(n_iterations, adaptive, tta, cascade)
+    prepared = PreparedBatch()
+    pending = []  # (key, image_hash, future) for images decoding on the executor
+    
+    # ✅ Decode straight into one preallocated batch buffer
+    items = list(items)
+    img_batch = np.empty((len(items), IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.float32)
+    
+    for key, image_bytes in items:
+        try:
+            image_hash = hash_bytes(image_bytes)
+            
+            result = cache.get_result(result_key(image_hash, fingerprint, mc_config, seed))
+            if result is not None:
+                prepared.cached.append((key, result))
+                continue
+            
+            # Seeded results must not depend on the batch the features came from
+            features = None
+            if tta is None:
+                features = cache.get_features(features_key(image_hash, fingerprint, batch_invariant=seed is not None))
+            if features is not None:
+                prepared.known.append((key, image_hash, features))
+                continue
+            
+            if executor is not None:
+                future = executor.submit(
+                    contextvars.copy_context().run, preprocess_image, image_bytes, out=img_batch[len(pending)]
+                )
+                pending.append((key, image_hash, future))
+                continue
+            
+            preprocess_image(image_bytes, out=img_batch[len(prepared.decoded)])
+            prepared.decoded.append((key, image_hash))
+        except Exception as e:
+            prepared.failures.append((key, e))
+    
+    # Parallel decodes fill rows in submission order; drop the rows that failed
+    rows = []
+    for row, (key, image_hash, future) in enumerate(pending):
+        try:
+            future.result()
+            prepared.decoded.append((key, image_hash))
+            rows.append(row)
+        except Exception as e:
+            prepared.failures.append((key, e))
+    if len(rows) < len(pending):
+        img_batch = img_batch[rows]
+    
+    if prepared.decoded:
+        prepared.img_batch = img_batch[:len(prepared.decoded)]
+    
+    return prepared
+
+def _extract_decoded_features(prepared, seed):
+    """
+    Run the backbone on prepared.img_batch and cache the features.
+    
+    Returns:
+        List of (key, image_hash, features) for prepared.decoded
+    """
+    cache = get_cache()
+    fingerprint = get_model_fingerprint()
+    batch_invariant = seed is not None
+    with metrics.span("backbone"):
+        features = extract_features(prepared.img_batch, batch_invariant) # Shape: (B, 1024)
+    entries = []
+    for (key, image_hash), vector in zip(prepared.decoded, features):
+        cache.put_features(features_key(image_hash, fingerprint), vector)
+        if batch_invariant:
+            cache.put_features(features_key(image_hash, fingerprint, batch_invariant=True), vector)
+        entries.append((key, image_hash, vector))
+    return entries
+
+def first_stage_results(features, cascade, seeds=None):
+    """
+    The cascade's first-stage result dicts for a batch of features.
+    
+    Args:
+        features: Features from the cascade (or main) backbone, shape (N, 1024)
+        cascade: Cascade settings
+        seeds: Optional seed pairs (N, 2) for a sampled first stage
+        
+    Returns:
+        List of summarize_batch() dicts (n_iterations = first-stage samples)
+    """
+    if cascade.fast_iterations:
+        samples = sample_mc_predictions(features, cascade.fast_iterations, seeds)
+    else:
+        samples = deterministic_predictions(features)[:, np.newaxis, :] # One "sample" per image
+    return summarize_batch(compute_statistics(samples), verbose=False)
+
+def _infer_cascade(prepared, n_iterations, adaptive, seed, tta, cascade):
+    """
+    Cascade over a PreparedBatch: the first stage for every image, then
+    infer_prepared_batch() without the cascade for the images it does not accept.
+    """
+    cache = get_cache()
+    fingerprint = get_model_fingerprint()
+    mc_config = mc_config_tag(n_iterations, adaptive, tta, cascade)
+    
+    # Cached results and failures pass straight through the full stage
+    escalated = PreparedBatch()
+    escalated.cached, escalated.failures = prepared.cached, prepared.failures
+    first_stage = {}  # key -> (image_hash, first-stage result) of escalated images
+    
+    entries = list(prepared.known)
+    if entries or prepared.decoded:
+        fast_backbone = None
+        try:
+            fast_backbone = get_cascade_backbone()
+            if fast_backbone is None and prepared.decoded:
+                # Shared backbone: escalated images reuse these features
+                entries += _extract_decoded_features(prepared, seed)
+            elif prepared.decoded:
+                with metrics.span("fast_backbone"):
+                    features = fast_backbone(prepared.img_batch)
+                entries += [(key, image_hash, vector) for (key, image_hash), vector in zip(prepared.decoded, features)]
+            
+            seeds = mc_seeds([image_hash for _, image_hash, _ in entries], seed)
+            with metrics.span("fast_head"):
+                results = first_stage_results(np.stack([vector for _, _, vector in entries]), cascade, seeds)
+            accepted = cascade.accepts(results)
+        except Exception as e:
+            logger.warning("⚠️  Cascade first stage failed, running the full pipeline: %s", e)
+            entries = list(prepared.known) + [(key, image_hash, None) for key, image_hash in prepared.decoded]
+            results = [None] * len(entries)
+            accepted = np.zeros(len(entries), dtype=bool)
+        
+        decoded_rows = {key_hash: row for row, key_hash in enumerate(prepared.decoded)}
+        rows = []
+        for (key, image_hash, vector), result, accept in zip(entries, results, accepted):
+            if accept:
+                result["mc_seed"] = seed if cascade.fast_iterations else None
+                result["cascade"] = {"stage": "fast"}
+                cache.put_result(result_key(image_hash, fingerprint, mc_config, seed), result)
+                yield key, result, None
+                continue
+            
+            first_stage[key] = (image_hash, result)
+            row = decoded_rows.get((key, image_hash))
+            if row is None or (vector is not None and fast_backbone is None and tta is None):
+                escalated.known.append((key, image_hash, vector))
+            else:
+                escalated.decoded.append((key, image_hash))
+                rows.append(row)
+        if rows:
+            escalated.img_batch = prepared.img_batch[rows]
+        
+        n_accepted = int(np.sum(accepted))
+        metrics.IMAGES.inc(n_accepted, outcome="computed")
+        metrics.CASCADE_ROUTES.inc(n_accepted, stage="fast")
+        metrics.CASCADE_ROUTES.inc(len(first_stage), stage="full")
+    
+    for key, result, error in infer_prepared_batch(escalated, n_iterations, adaptive, seed, tta):
+        if result is not None and key in first_stage:
+            image_hash, fast_result = first_stage[key]
+            result = dict(result, cascade={"stage": "full"})
+            if fast_result is not None:
+                result["cascade"]["first_stage"] = {
+                    name: fast_result[name] for name in ("class_name", "confidence", "predictive_entropy")
+                }
+            cache.put_result(result_key(image_hash, fingerprint, mc_config, seed), result)
+        yield key, result, error
+
+def _infer_tta(prepared, n_iterations, seed, tta):
+    """Backbone and MC head over every TTA view of prepared.img_batch (see summarize_tta_batch())."""
+    with metrics.span("augment"):
+        views = augment_views(prepared.img_batch, tta) # Shape: (N*K, 224, 224, 3)
+    with metrics.span("backbone"):
+        features = extract_features(views, batch_invariant=seed is not None) # Shape: (N*K, 1024)
+    seeds = view_seeds(mc_seeds([image_hash for _, image_hash in prepared.decoded], seed), len(tta.views))
+    with metrics.span("mc_head"):
+        samples = sample_mc_predictions(features, n_iterations, seeds) # Shape: (N*K, T, 5)
+    with metrics.span("stats"):
+        return summarize_tta_batch(samples, tta)
+
+def infer_prepared_batch(prepared, n_iterations=30, adaptive=None, seed=None, tta=None, cascade=None):
+    """
+    Run the backbone and MC head on a PreparedBatch, filling the cache.
+    
+    With adaptive settings, each image gets as many MC samples as it needs
+    to converge and its result reports the iterations actually used. With a
+    seed, every image's result is bit-identical however it is batched. With
+    TTA, all views of all images go through the backbone as one batch and
+    through the MC head in one call. With a cascade, only the images the
+    cheap first stage is unsure about get the full pipeline; results say
+    which stage produced them in result["cascade"]["stage"].
+    
+    Yields:
+        (key, result, error) for every image; exactly one of result or error is set
+    """
+    if cascade is not None:
+        yield from _infer_cascade(prepared, n_iterations, adaptive, seed, tta, cascade)
+        return
+    
+    cache = get_cache()
+    fingerprint = get_model_fingerprint()
+    mc_config = mc_config_tag(n_iterations, adaptive, tta)
+    
+    if prepared.cached:
+        logger.debug("⚡ Cache hit for %d image(s)", len(prepared.cached))
+        metrics.IMAGES.inc(len(prepared.cached), outcome="cached")
+    for key, result in prepared.cached:
+        yield key, result, None
+    
+    if prepared.failures:
+        metrics.IMAGES.inc(len(prepared.failures), outcome="failed")
+    for key, error in prepared.failures:
+        yield key, None, error
+    
+    entries = list(prepared.known)
+    if not entries and not prepared.decoded:
+        return
+    
+    # ✅ MC DROPOUT: SPLIT INFERENCE
+    # The Backbone (DenseNet + BN) runs once in inference mode (training=False).
+    # The Head (Dense + Dropout) runs n_iterations times with dropout active.
+    logger.debug("🔄 Running MC Dropout via Split Inference on %d image(s) (n=%s)...",
+                 len(entries) + len(prepared.decoded), mc_config)
+    
+    try:
+        if tta is not None:
+            # TTA: all views through the backbone as one batch, one MC head call
+            statistics, results = _infer_tta(prepared, n_iterations, seed, tta)
+            entries = [(key, image_hash, None) for key, image_hash in prepared.decoded]
+        else:
+            # 1. Extract features using the backbone (up to bn_1), skipped on feature cache hits
+            if prepared.decoded:
+                entries += _extract_decoded_features(prepared, seed)
+            
+            # 2. Sample the compiled MC head (dropout always active)
+            batch_features = np.stack([vector for _, _, vector in entries])
+            seeds = mc_seeds([image_hash for _, image_hash, _ in entries], seed)
+            if adaptive is not None:
+                with metrics.span("mc_head"):
+                    statistics, converged = sample_mc_predictions_adaptive(batch_features, adaptive, seeds)
+                with metrics.span("stats"):
+                    statistics = statistics.summary()
+                    results = summarize_batch(statistics)
+            else:
+                with metrics.span("mc_head"):
+                    samples = sample_mc_predictions(batch_features, n_iterations, seeds) # Shape: (B, T, 5)
+                
+                # 3. Compute Bayesian statistics for the whole batch at once
+                with metrics.span("stats"):
+                    statistics = compute_statistics(samples)
+                    results = summarize_batch(statistics)
     except Exception as e:
-        print(f"❌ Prediction error: {str(e)}")
+        keys = [key for key, _, _ in prepared.known] + [key for key, _ in prepared.decoded]
+        metrics.IMAGES.inc(len(keys), outcome="failed")
+        for key in keys:
+            yield key, None, e
+        return
+    
+    metrics.IMAGES.inc(len(results), outcome="computed")
+    for n_samples in statistics["n_samples"]:
+        metrics.MC_SAMPLES.observe(int(n_samples))
+    
+    for index, ((key, image_hash, _), result) in enumerate(zip(entries, results)):
+        if adaptive is not None:
+            result["adaptive"] = True
+            result["converged"] = bool(converged[index])
+        result["mc_seed"] = seed
+        cache.put_result(result_key(image_hash, fingerprint, mc_config, seed), result)
+        yield key, result, None
+
+def predict_with_uncertainty(image_bytes, n_iterations=30, adaptive=None, seed=None, tta=None, cascade=None,
+                             model=None):
+    """
+    Make prediction with Monte Carlo Dropout for uncertainty estimation.
+    
+    Repeated images are served from the prediction cache; with only the
+    features cached, just the MC head is rerun.
+    
+    Args:
+        image_bytes: Raw bytes of the uploaded image
+        n_iterations: Number of forward passes for uncertainty estimation (default: 30)
+        adaptive: Optional AdaptiveSampling settings; sample until the estimates
+                  converge instead of a fixed n_iterations
+        seed: Optional MC Dropout seed: SEED_FROM_IMAGE or an int for
+              reproducible results (see mc_seeds()), None for stochastic
+        tta: Optional TestTimeAugmentation settings; n_iterations samples are
+             drawn for each view and the result gets a per-view breakdown
+        cascade: Optional Cascade settings; confident images are answered by
+                 the cheap first stage, the rest get the full pipeline
+        model: Model version name (see get_registry()), None for the active one
+        
+    Returns:
+        Dictionary containing prediction results with uncertainty metrics
+    """
+    try:
+        with use_model(model):
+            prepared = prepare_batch([(None, image_bytes)], n_iterations, adaptive, seed, tta=tta, cascade=cascade)
+            for _, result, error in infer_prepared_batch(prepared, n_iterations, adaptive, seed, tta, cascade):
+                if error is not None:
+                    raise error
+                return result
+    
+    except Exception as e:
+        logger.debug("❌ Prediction error: %s", e)
         raise
 
+def iter_batch_predictions(items, n_iterations=30, batch_size=32, prefetch=2, adaptive=None, seed=None,
+                           decode_threads=1, tta=None, cascade=None, model=None):
+    """
+    Stream predictions for an iterable of images, one mini-batch at a time.
+    
+    Decoding runs in a background thread up to `prefetch` mini-batches ahead,
+    so it overlaps with backbone inference. At most (prefetch + 1) mini-batches
+    are in memory at once, regardless of how many images are streamed.
+    
+    Args:
+        items: Iterable of (key, image_bytes); keys are passed through untouched
+        n_iterations: Number of MC Dropout samples per image (default: 30)
+        batch_size: Number of images per backbone pass (default: 32)
+        prefetch: Number of decoded mini-batches to keep ready (default: 2)
+        adaptive: Optional AdaptiveSampling settings (replaces n_iterations)
+        seed: Optional MC Dropout seed (see predict_with_uncertainty())
+        decode_threads: Images of a mini-batch decoded in parallel (default: 1)
+        tta: Optional TestTimeAugmentation settings (see predict_with_uncertainty())
+        cascade: Optional Cascade settings (see predict_with_uncertainty())
+        model: Model version name, None for the active one; all mini-batches
+               use the version that was active when iteration started
+        
+    Yields:
+        (key, result, error) for every image, in mini-batch order. Exactly one
+        of result (the predict_with_uncertainty() dict) or error is set.
+        
+    Raises:
+        Any exception raised while iterating `items` itself.
+    """
+    loaded = resolve_model(model)
+    done = object()
+    decoded = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+    
+    def put(entry):
+        # Bounded put that gives up once the consumer has gone away
+        while not stop.is_set():
+            try:
+                decoded.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def producer():
+        executor = None
+        if decode_threads > 1:
+            executor = ThreadPoolExecutor(max_workers=decode_threads, thread_name_prefix="bayesdr-batch-decode")
+        try:
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) == batch_size:
+                    with use_model(loaded):
+                        prepared = prepare_batch(chunk, n_iterations, adaptive, seed, executor, tta, cascade)
+                    if not put(prepared):
+                        return
+                    chunk = []
+            if chunk:
+                with use_model(loaded):
+                    prepared = prepare_batch(chunk, n_iterations, adaptive, seed, executor, tta, cascade)
+                put(prepared)
+        except Exception as e:
+            put(e)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+            put(done)
+    
+    # Decode spans count towards the request being served
+    worker = threading.Thread(
+        target=contextvars.copy_context().run, args=(producer,), name="bayesdr-batch-decoder", daemon=True
+    )
+    worker.start()
+    
+    try:
+        while True:
+            entry = decoded.get()
+            if entry is done:
+                break
+            if isinstance(entry, Exception):
+                raise entry
+            
+            # Pinned per mini-batch: the context must not stay switched across yields
+            with use_model(loaded):
+                results = list(infer_prepared_batch(entry, n_iterations, adaptive, seed, tta, cascade))
+            yield from results
+    finally:
+        stop.set()
+        worker.join(timeout=1.0)
+
+def predict_batch_with_uncertainty(images, n_iterations=30, batch_size=32, adaptive=None, seed=None, tta=None,
+                                   cascade=None, model=None):
+    """
+    Batched variant of predict_with_uncertainty() for many images.
+    
+    Images are preprocessed and stacked into mini-batches of batch_size, so the
+    backbone runs once per mini-batch and the MC head once per mini-batch.
+    
+    Args:
+        images: List of raw image bytes
+        n_iterations: Number of MC Dropout samples per image (default: 30)
+        batch_size: Number of images per backbone pass (default: 32)
+        adaptive: Optional AdaptiveSampling settings (replaces n_iterations)
+        seed: Optional MC Dropout seed (see predict_with_uncertainty())
+        tta: Optional TestTimeAugmentation settings (see predict_with_uncertainty())
+        cascade: Optional Cascade settings (see predict_with_uncertainty())
+        model: Model version name, None for the active one
+        
+    Returns:
+        List of (result, error) tuples in input order. For each image exactly
+        one of them is set: the result dict, or the exception it raised.
+    """
+    outputs = [(None, None)] * len(images)
+    
+    for index, result, error in iter_batch_predictions(enumerate(images), n_iterations, batch_size,
+                                                       adaptive=adaptive, seed=seed, tta=tta, cascade=cascade,
+                                                       model=model):
+        outputs[index] = (result, error)
+    
+    return outputs
+
 def get_prediction_explanation(result):
     """
     Generate human-readable explanation of the prediction.
@@ -223,11 +1939,13 @@ def get_prediction_explanation(result):
         explanation += "✅ This is a reliable prediction (high confidence, low uncertainty).\n"
     else:
         explanation += "⚠️ This prediction has "
-        if result['confidence'] < 0.7:
+        low_confidence = result['confidence'] < THRESHOLDS["reliable_confidence"]
+        high_uncertainty = result['uncertainty'] > THRESHOLDS["reliable_uncertainty"]
+        if low_confidence:
             explanation += "low confidence"
-        if result['confidence'] < 0.7 and result['uncertainty'] > 0.10:
+        if low_confidence and high_uncertainty:
             explanation += " and "
-        if result['uncertainty'] > 0.10:
+        if high_uncertainty:
             explanation += "high uncertainty"
         explanation += ". Consider additional medical evaluation.\n"
     
@@ -0,0 +1,45 @@
+"""
+Shared pytest setup: the tiny stand-in model, no result cache, synthetic images.
+
+Inference tests run on the tiny stand-in model (BAYESDR_STAND_IN=tiny, see
+stand_in.py) with the result cache off, so every result is computed. Tests
+that need TensorFlow are skipped where it is not installed.
+"""
+
+import io
+import os
+
+# Before classify/cache read their configuration
+os.environ["BAYESDR_STAND_IN"] = "tiny"
+os.environ["BAYESDR_CACHE_MB"] = "0"
+os.environ["BAYESDR_MC_SEED"] = ""
+os.environ["BAYESDR_MAX_LOADED_MODELS"] = "2"
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def png():
+    """Build PNG bytes of random pixels: png(width=64, height=48, mode="RGB", seed=0)."""
+    np = pytest.importorskip("numpy")
+    Image = pytest.importorskip("PIL.Image")
+
+    def build(width=64, height=48, mode="RGB", seed=0):
+        rng = np.random.default_rng(seed)
+        if mode == "I;16":
+            img = Image.fromarray(rng.integers(0, 65536, (height, width), dtype=np.uint16))
+        else:
+            img = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8)).convert(mode)
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    return build
+
+
+@pytest.fixture(scope="session")
+def tiny_model():
+    """The active (tiny stand-in) model, loaded once."""
+    pytest.importorskip("tensorflow")
+    import classify
+    return classify.current_model()
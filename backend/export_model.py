@@ -0,0 +1,309 @@
+"""
+Export the BayesDR backbone to optimized CPU formats and check their accuracy.
+
+Usage:
+    python export_model.py export --output-dir exported [--formats savedmodel tflite-int8 onnx ...]
+                                  [--calibration DIR] [--model model.h5]
+    python export_model.py report --export-dir exported --images DIR [--output report.json]
+
+Only the deterministic backbone (input -> bn_1) is converted. The MC Dropout
+head is saved as head.npz (layer configs + weights) and stays a Keras model,
+so dropout sampling works the same with every backbone format.
+
+The `savedmodel` format is the fast cold-start serving artifact: backbone
+and MC sampler saved as traced concrete functions, loaded without parsing
+the .h5 model, rebuilding the Keras graph or re-tracing.
+
+Serve an exported backbone with:
+    BAYESDR_BACKBONE_RUNTIME=tflite BAYESDR_BACKBONE_PATH=exported/backbone_int8.tflite python app.py
+    BAYESDR_BACKBONE_RUNTIME=savedmodel BAYESDR_BACKBONE_PATH=exported/serving python app.py
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import classify
+from benchmark import load_images
+from runtimes import KerasBackbone, load_backbone, save_head
+
+# Export formats: name -> (file name, runtime)
+FORMATS = {
+    "savedmodel": ("serving", "savedmodel"),
+    "tflite-float32": ("backbone_float32.tflite", "tflite"),
+    "tflite-float16": ("backbone_float16.tflite", "tflite"),
+    "tflite-dynamic": ("backbone_dynamic.tflite", "tflite"),
+    "tflite-int8": ("backbone_int8.tflite", "tflite"),
+    "onnx": ("backbone.onnx", "onnx")
+}
+
+SAVED_MODEL_DIR = "backbone_savedmodel"
+HEAD_FILE = "head.npz"
+MANIFEST_FILE = "manifest.json"
+ONNX_OPSET = 17
+
+
+def _load_reference_model(model_path):
+    """The full Keras model and its backbone, regardless of BAYESDR_BACKBONE_RUNTIME."""
+    classify.MODEL_PATH = model_path
+    model = classify._load_keras_model()
+    feature_extractor, _ = classify._build_split_models(model)
+    return model, feature_extractor
+
+
+def calibration_batches(calibration_dir, samples):
+    """Yield preprocessed single-image batches for int8 calibration."""
+    images = load_images(calibration_dir, synthetic=samples, size="1024x1024")[:samples]
+    for _, image_bytes in images:
+        yield [classify.preprocess_image(image_bytes)]
+
+
+def convert_tflite(saved_model_dir, quantization, calibration_dir=None, calibration_samples=100):
+    """
+    Convert the backbone SavedModel to TFLite.
+
+    Args:
+        saved_model_dir: Directory written by keras.Model.export()
+        quantization: 'float32', 'float16', 'dynamic' (int8 weights) or
+                      'int8' (int8 weights and activations, calibrated)
+        calibration_dir: Images for int8 calibration (default: synthetic fundus photos)
+        calibration_samples: Number of calibration images
+
+    Returns:
+        The serialized TFLite model (bytes)
+    """
+    import tensorflow as tf
+
+    # Converting from the SavedModel (not a concrete function) freezes the
+    # variables; the concrete-function path leaves resource reads unresolved
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    if quantization != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        converter.representative_dataset = lambda: calibration_batches(calibration_dir, calibration_samples)
+
+    return converter.convert()
+
+
+def convert_onnx(saved_model_dir, output_path):
+    """Convert the backbone SavedModel to ONNX with tf2onnx (optional dependency)."""
+    try:
+        import tf2onnx  # noqa: F401
+    except ImportError:
+        raise RuntimeError("ONNX export needs tf2onnx: pip install tf2onnx onnxruntime")
+
+    subprocess.run([
+        sys.executable, "-m", "tf2onnx.convert",
+        "--saved-model", saved_model_dir,
+        "--output", output_path,
+        "--opset", str(ONNX_OPSET)
+    ], check=True)
+
+
+def export_serving_artifact(model, output_path, jit_compile=False):
+    """
+    Save the split model as a SavedModel serving artifact (see runtimes.SavedModelArtifact).
+
+    Signatures: features(images) -> (N, 1024),
+    mc_sample(features, n_iterations) -> (N, n_iterations, 5) and
+    mc_sample_seeded(features, n_iterations, seeds, offset) -> (N, n_iterations, 5).
+    """
+    import tensorflow as tf
+
+    feature_extractor, mc_head = classify._build_split_models(model)
+    feature_dim = int(feature_extractor.output_shape[-1])
+
+    # Track plain variables, not the Keras models: saving the models also
+    # serializes every layer's call functions and doubles the load time
+    module = tf.Module()
+    module.weights = list(feature_extractor.variables) + list(mc_head.variables)
+    # Keras keeps dropout RNG state outside the tracked variables; without
+    # it the traced sampler cannot be saved
+    module.seed_states = [layer.seed_generator.state for layer in mc_head.layers if hasattr(layer, "seed_generator")]
+    module.feature_dim = tf.Variable(feature_dim, trainable=False)
+    module.features = tf.function(
+        lambda images: feature_extractor(images, training=False),
+        input_signature=[tf.TensorSpec(shape=[None, classify.IMAGE_SIZE[1], classify.IMAGE_SIZE[0], 3], dtype=tf.float32)]
+    )
+    module.mc_sample = classify._build_mc_sampler(mc_head, feature_dim, jit_compile=jit_compile)
+    module.mc_sample_seeded = classify._build_seeded_mc_sampler(mc_head, feature_dim, jit_compile=jit_compile)
+
+    if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+    tf.saved_model.save(module, output_path)
+
+
+def _size_mb(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names) / 2**20
+    return os.path.getsize(path) / 2**20
+
+
+def export(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    model, feature_extractor = _load_reference_model(args.model)
+
+    saved_model_dir = os.path.join(args.output_dir, SAVED_MODEL_DIR)
+    if os.path.exists(saved_model_dir):
+        shutil.rmtree(saved_model_dir)
+    print(f"🔄 Exporting backbone SavedModel to {saved_model_dir}")
+    feature_extractor.export(saved_model_dir, format="tf_saved_model", verbose=False)
+
+    head_path = os.path.join(args.output_dir, HEAD_FILE)
+    save_head(model, classify.HEAD_LAYERS, head_path)
+    print(f"✅ Head weights saved to {head_path}")
+
+    exported = {}
+    for name in args.formats:
+        file_name, runtime = FORMATS[name]
+        path = os.path.join(args.output_dir, file_name)
+        print(f"🔄 Converting backbone to {name}...")
+        try:
+            if runtime == "savedmodel":
+                export_serving_artifact(model, path, jit_compile=classify.USE_XLA)
+            elif runtime == "tflite":
+                with open(path, "wb") as f:
+                    f.write(convert_tflite(
+                        saved_model_dir, name.split("-", 1)[1], args.calibration, args.calibration_samples
+                    ))
+            else:
+                convert_onnx(saved_model_dir, path)
+        except Exception as e:
+            print(f"❌ {name} export failed: {str(e)}")
+            continue
+
+        exported[name] = {"file": file_name, "runtime": runtime, "size_mb": round(_size_mb(path), 2)}
+        print(f"✅ {name}: {path} ({exported[name]['size_mb']} MB)")
+
+    manifest = {
+        "model_path": os.path.abspath(args.model),
+        "model_fingerprint": classify.file_fingerprint(args.model),
+        "feature_layer": classify.FEATURE_LAYER,
+        "feature_dim": int(feature_extractor.output_shape[-1]),
+        "head": HEAD_FILE,
+        "formats": exported,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+    with open(os.path.join(args.output_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+def _head_probabilities(model, features):
+    """Deterministic (dropout off) head output for a batch of features."""
+    x = features
+    for layer_name in classify.HEAD_LAYERS:
+        x = model.get_layer(layer_name)(x)
+    return np.asarray(x)
+
+
+def _time_backbone(backbone, img_batch, repeat):
+    """Best-of-repeat milliseconds per image, batch size 1 and the full batch."""
+    timings = {}
+    for label, batches in (("batch_1", [img_batch[i:i + 1] for i in range(len(img_batch))]), ("batch_all", [img_batch])):
+        backbone(batches[0])  # warm-up (allocations, resize_tensor_input)
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for batch in batches:
+                backbone(batch)
+            best = min(best, (time.perf_counter() - start) * 1000.0 / len(img_batch))
+        timings[f"ms_per_image_{label}"] = round(best, 3)
+    return timings
+
+
+def report(args):
+    with open(os.path.join(args.export_dir, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+
+    model, feature_extractor = _load_reference_model(args.model or manifest["model_path"])
+    images = load_images(args.images, args.synthetic, args.size)
+    img_batch = np.concatenate([classify.preprocess_image(image_bytes) for _, image_bytes in images])
+
+    reference = {"backbone": KerasBackbone(feature_extractor), "size_mb": None}
+    candidates = [("keras", reference)]
+    for name, entry in manifest["formats"].items():
+        try:
+            backbone = load_backbone(entry["runtime"], os.path.join(args.export_dir, entry["file"]), args.threads)
+        except Exception as e:
+            print(f"⚠️  Skipping {name}: {str(e)}")
+            continue
+        candidates.append((name, {"backbone": backbone, "size_mb": entry["size_mb"]}))
+
+    ref_features = reference["backbone"](img_batch)
+    ref_probs = _head_probabilities(model, ref_features)
+    ref_classes = np.argmax(ref_probs, axis=1)
+
+    results = []
+    for name, candidate in candidates:
+        features = candidate["backbone"](img_batch)
+        probs = _head_probabilities(model, features)
+
+        cosine = np.sum(features * ref_features, axis=1) / (
+            np.linalg.norm(features, axis=1) * np.linalg.norm(ref_features, axis=1) + 1e-12
+        )
+        result = {
+            "format": name,
+            "size_mb": candidate["size_mb"],
+            "top1_agreement": float(np.mean(np.argmax(probs, axis=1) == ref_classes)),
+            "max_abs_prob_diff": float(np.max(np.abs(probs - ref_probs))),
+            "mean_abs_prob_diff": float(np.mean(np.abs(probs - ref_probs))),
+            "max_abs_feature_diff": float(np.max(np.abs(features - ref_features))),
+            "min_feature_cosine": float(np.min(cosine))
+        }
+        result.update(_time_backbone(candidate["backbone"], img_batch, args.repeat))
+        results.append(result)
+
+    print(f"\nBackbone export report: {len(images)} images, reference = Keras model")
+    print(f"{'format':16s} {'MB':>7s} {'agree':>7s} {'max|dp|':>9s} {'min cos':>8s} {'ms/img@1':>9s} {'ms/img@N':>9s}")
+    for r in results:
+        size = f"{r['size_mb']:7.1f}" if r["size_mb"] is not None else f"{'-':>7s}"
+        print(f"{r['format']:16s} {size} {r['top1_agreement']:7.1%} {r['max_abs_prob_diff']:9.5f} "
+              f"{r['min_feature_cosine']:8.5f} {r['ms_per_image_batch_1']:9.2f} {r['ms_per_image_batch_all']:9.2f}")
+
+    return {"report": "export", "n_images": len(images), "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the BayesDR backbone to TFLite / ONNX")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    exp = subparsers.add_parser("export", help="Convert the backbone and save the MC Dropout head")
+    exp.add_argument("--model", default=classify.MODEL_PATH, help="Trained .h5 model")
+    exp.add_argument("--output-dir", default="exported", help="Where to write the exported files")
+    exp.add_argument("--formats", nargs="+", default=list(FORMATS), choices=list(FORMATS))
+    exp.add_argument("--calibration", help="Directory of calibration images for int8 (default: synthetic)")
+    exp.add_argument("--calibration-samples", type=int, default=100, help="Number of calibration images")
+    exp.set_defaults(run=export)
+
+    rep = subparsers.add_parser("report", help="Agreement and speed of each format vs the Keras model")
+    rep.add_argument("--export-dir", default="exported", help="Directory written by `export`")
+    rep.add_argument("--model", help="Reference .h5 model (default: the one in the manifest)")
+    rep.add_argument("--images", help="Held-out images directory (default: synthetic fundus photos)")
+    rep.add_argument("--synthetic", type=int, default=16, help="Number of synthetic images")
+    rep.add_argument("--size", default="1024x1024", help="Synthetic image size WxH")
+    rep.add_argument("--threads", type=int, default=0, help="Runtime threads (0 = runtime default)")
+    rep.add_argument("--repeat", type=int, default=3, help="Timing repeats (best is reported)")
+    rep.add_argument("--output", help="Write the report as JSON to this file")
+    rep.set_defaults(run=report)
+
+    args = parser.parse_args(argv)
+    result = args.run(args)
+
+    if getattr(args, "output", None):
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nReport written to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
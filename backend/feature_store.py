@@ -0,0 +1,483 @@
+"""
+Memory-mapped store of bn_1 features for bulk re-scoring.
+
+Build the store once (the expensive DenseNet pass), then re-run only the
+MC Dropout head over it whenever thresholds or MC settings change:
+
+    python feature_store.py build --images archive/ --store features/
+    python feature_store.py build --csv images.csv --path-column path --id-column id --store features/
+    python feature_store.py rescore --store features/ --n-iterations 30 --confidence-high 0.85 --output rescored.csv
+
+Store layout (append-only; `count` in meta.json is the commit point):
+    meta.json      dim, dtype, count, model fingerprint
+    features.bin   raw (count, dim) array, float16 or float32
+    ids.txt        one image ID per line, row order
+    errors.jsonl   images that could not be decoded (one row per image ID)
+
+From Python, any iterable of (image_id, path) works as input, e.g. a
+pandas DataFrame via df[["id", "path"]].itertuples(index=False).
+"""
+
+import argparse
+import csv
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import classify
+from classify import (
+    CLASS_NAMES, IMAGE_SIZE, THRESHOLDS, extract_features, get_model_fingerprint,
+    preprocess_image, sample_mc_predictions, sample_mc_predictions_adaptive, summarize_batch
+)
+from uncertainty import compute_statistics
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tiff")
+STORE_DTYPES = ("float16", "float32")
+
+META_FILE = "meta.json"
+FEATURES_FILE = "features.bin"
+IDS_FILE = "ids.txt"
+ERRORS_FILE = "errors.jsonl"
+
+
+class FeatureStore:
+    """
+    Append-only (N, dim) feature array on disk with an image-ID index.
+
+    Reads go through np.memmap, so slices are paged in on demand and the
+    store never has to fit in RAM. Rows past meta.json's count (left by an
+    interrupted append) are truncated when the store is reopened; fewer rows
+    or IDs than the count raise ValueError.
+    """
+
+    def __init__(self, path, dim=None, dtype="float16", create=False):
+        self.path = path
+        meta_path = os.path.join(path, META_FILE)
+
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        elif create:
+            if dtype not in STORE_DTYPES:
+                raise ValueError(f"Store dtype must be one of: {', '.join(STORE_DTYPES)}")
+            os.makedirs(path, exist_ok=True)
+            self.meta = {
+                "version": 1,
+                "dim": int(dim),
+                "dtype": dtype,
+                "count": 0,
+                "feature_layer": classify.FEATURE_LAYER,
+                "model_fingerprint": None,
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+            }
+            self._write_meta()
+        else:
+            raise FileNotFoundError(f"No feature store at {path}")
+
+        self.dim = self.meta["dim"]
+        self.dtype = np.dtype(self.meta["dtype"])
+        self._row_bytes = self.dim * self.dtype.itemsize
+        self._ids = None
+        self._index = None
+        self._errors = None
+        self._lock = threading.Lock()
+
+        self._truncate_uncommitted()
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _write_meta(self):
+        tmp_path = self._file(META_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp_path, self._file(META_FILE))
+
+    def _truncate_uncommitted(self):
+        count = self.meta["count"]
+        features_path = self._file(FEATURES_FILE)
+        size = os.path.getsize(features_path) if os.path.exists(features_path) else 0
+        if size < count * self._row_bytes:
+            raise ValueError(f"Feature store {self.path} is damaged: {FEATURES_FILE} has fewer than {count} rows")
+        if size > count * self._row_bytes:
+            with open(features_path, "r+b") as f:
+                f.truncate(count * self._row_bytes)
+
+        ids_path = self._file(IDS_FILE)
+        ids = []
+        if os.path.exists(ids_path):
+            with open(ids_path) as f:
+                ids = f.read().splitlines()
+        if len(ids) < count:
+            raise ValueError(f"Feature store {self.path} is damaged: {IDS_FILE} has {len(ids)} IDs for {count} rows")
+        if len(ids) > count:
+            with open(ids_path, "w") as f:
+                f.writelines(f"{image_id}\n" for image_id in ids[:count])
+
+    @property
+    def ids(self):
+        """Image IDs in row order."""
+        if self._ids is None:
+            ids_path = self._file(IDS_FILE)
+            if os.path.exists(ids_path):
+                with open(ids_path) as f:
+                    self._ids = f.read().splitlines()[:len(self)]
+            else:
+                self._ids = []
+        return self._ids
+
+    def index_of(self, image_id):
+        """Row of an image ID, or None if it is not in the store."""
+        if self._index is None:
+            self._index = {image_id: row for row, image_id in enumerate(self.ids)}
+        return self._index.get(image_id)
+
+    def __contains__(self, image_id):
+        return self.index_of(image_id) is not None
+
+    def features(self, start=0, stop=None):
+        """Read-only memory-mapped rows [start, stop) of the store."""
+        count = len(self)
+        if count == 0:
+            return np.empty((0, self.dim), dtype=self.dtype)
+        mapped = np.memmap(self._file(FEATURES_FILE), dtype=self.dtype, mode="r", shape=(count, self.dim))
+        return mapped[start:stop]
+
+    def iter_slices(self, batch_size=1024, start=0, stop=None):
+        """Yield (image_ids, features) slices, features converted to float32."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for offset in range(start, stop, batch_size):
+            end = min(offset + batch_size, stop)
+            yield self.ids[offset:end], np.asarray(self.features(offset, end), dtype=np.float32)
+
+    def append(self, image_ids, features):
+        """Append rows and commit them by bumping the count in meta.json."""
+        features = np.asarray(features, dtype=self.dtype)
+        if features.ndim != 2 or features.shape[1] != self.dim or len(features) != len(image_ids):
+            raise ValueError(f"Expected {len(image_ids)} feature rows of dimension {self.dim}")
+        if any("\n" in str(image_id) for image_id in image_ids):
+            raise ValueError("Image IDs must not contain newlines")
+
+        with self._lock:
+            with open(self._file(FEATURES_FILE), "ab") as f:
+                f.write(features.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self._file(IDS_FILE), "a") as f:
+                f.writelines(f"{image_id}\n" for image_id in image_ids)
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.meta["count"] += len(image_ids)
+            self._write_meta()
+
+            if self._ids is not None:
+                self._ids.extend(str(image_id) for image_id in image_ids)
+            if self._index is not None:
+                for image_id in image_ids:
+                    self._index[str(image_id)] = len(self._index)
+
+            # ✅ A retried image that now decodes is no longer an error
+            recovered = [str(image_id) for image_id in image_ids if str(image_id) in self.errors]
+            if recovered:
+                for image_id in recovered:
+                    del self._errors[image_id]
+                self._write_errors()
+
+    @property
+    def errors(self):
+        """Recorded decode failures, {image_id: message}."""
+        if self._errors is None:
+            self._errors = {}
+            errors_path = self._file(ERRORS_FILE)
+            if os.path.exists(errors_path):
+                with open(errors_path) as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            self._errors[entry["image_id"]] = entry["error"]
+        return self._errors
+
+    def _write_errors(self):
+        tmp_path = self._file(ERRORS_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            for image_id, message in self._errors.items():
+                f.write(json.dumps({"image_id": image_id, "error": message}) + "\n")
+        os.replace(tmp_path, self._file(ERRORS_FILE))
+
+    def record_errors(self, errors):
+        """
+        Record (image_id, message) decode failures in errors.jsonl.
+
+        Resumed builds retry failed images; one that fails again keeps a
+        single row, with the latest message.
+        """
+        if not errors:
+            return
+        with self._lock:
+            known = self.errors
+            retried = any(str(image_id) in known for image_id, _ in errors)
+            for image_id, message in errors:
+                known[str(image_id)] = message
+            if retried:
+                self._write_errors()
+            else:
+                with open(self._file(ERRORS_FILE), "a") as f:
+                    for image_id, message in errors:
+                        f.write(json.dumps({"image_id": str(image_id), "error": message}) + "\n")
+
+
+def iter_image_dir(images_dir):
+    """Yield (image_id, path) for every image under a directory; IDs are relative paths."""
+    for root, dirs, files in os.walk(images_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, images_dir), path
+
+
+def iter_csv_images(csv_path, path_column="path", id_column=None):
+    """Yield (image_id, path) from a CSV; relative paths are resolved against the CSV's folder."""
+    base_dir = os.path.dirname(os.path.abspath(csv_path))
+    with open(csv_path, newline="") as f:
+        for row in csv.DictReader(f):
+            path = row[path_column]
+            image_id = row[id_column] if id_column else path
+            yield image_id, path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+
+def build_store(store, items, batch_size=32, decode_threads=4, skip_existing=True):
+    """
+    Compute bn_1 features for (image_id, path) items and append them to the store.
+
+    Decoding runs in a thread pool one batch ahead of the backbone. Images
+    already in the store are skipped, so an interrupted build can be resumed.
+
+    Returns:
+        Tuple of (n_added, n_skipped, n_failed)
+    """
+    fingerprint = get_model_fingerprint()
+    if store.meta["model_fingerprint"] is None:
+        store.meta["model_fingerprint"] = fingerprint
+    elif store.meta["model_fingerprint"] != fingerprint:
+        raise ValueError("Feature store was built with a different model; use a new store path")
+
+    counts = {"added": 0, "skipped": 0, "failed": 0}
+    done = object()
+    decoded = queue.Queue(maxsize=2)
+
+    def decode_one(buffer, row, path):
+        with open(path, "rb") as f:
+            preprocess_image(f.read(), out=buffer[row])
+
+    def producer(executor):
+        chunk = []
+
+        def flush():
+            buffer = np.empty((len(chunk), IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.float32)
+            futures = [executor.submit(decode_one, buffer, row, path) for row, (_, path) in enumerate(chunk)]
+            ok_rows, ids, errors = [], [], []
+            for row, ((image_id, _), future) in enumerate(zip(chunk, futures)):
+                try:
+                    future.result()
+                    ok_rows.append(row)
+                    ids.append(image_id)
+                except Exception as e:
+                    errors.append((image_id, str(e)))
+            decoded.put((ids, buffer[ok_rows], errors))
+
+        seen = set()
+        for image_id, path in items:
+            image_id = str(image_id)
+            if (skip_existing and image_id in store) or image_id in seen:
+                counts["skipped"] += 1
+                continue
+            seen.add(image_id)
+            chunk.append((image_id, path))
+            if len(chunk) == batch_size:
+                flush()
+                chunk = []
+        if chunk:
+            flush()
+
+    with ThreadPoolExecutor(max_workers=max(1, decode_threads), thread_name_prefix="bayesdr-store-decode") as executor:
+        def run_producer():
+            try:
+                producer(executor)
+            except Exception as e:
+                decoded.put(e)
+            finally:
+                decoded.put(done)
+
+        worker = threading.Thread(target=run_producer, name="bayesdr-store-producer", daemon=True)
+        worker.start()
+
+        started = time.perf_counter()
+        while True:
+            entry = decoded.get()
+            if entry is done:
+                break
+            if isinstance(entry, Exception):
+                raise entry
+
+            ids, img_batch, errors = entry
+            store.record_errors(errors)
+            counts["failed"] += len(errors)
+            if ids:
+                store.append(ids, extract_features(img_batch))
+                counts["added"] += len(ids)
+
+            elapsed = time.perf_counter() - started
+            print(f"📦 {counts['added']} added, {counts['skipped']} skipped, {counts['failed']} failed "
+                  f"({counts['added'] / max(elapsed, 1e-9):.1f} img/s)")
+
+        worker.join()
+
+    return counts["added"], counts["skipped"], counts["failed"]
+
+
+def rescore(store, n_iterations=30, thresholds=None, batch_size=1024, start=0, stop=None, adaptive=None):
+    """
+    Run only the MC Dropout head over stored features.
+
+    Args:
+        store: FeatureStore
+        n_iterations: Number of MC samples per image
+        thresholds: Optional overrides for classify.THRESHOLDS
+        batch_size: Rows per MC head call
+        start, stop: Row range to re-score (default: the whole store)
+        adaptive: Optional AdaptiveSampling settings (replaces n_iterations)
+
+    Yields:
+        (image_id, result) with result in the predict_with_uncertainty() format
+    """
+    fingerprint = get_model_fingerprint()
+    if store.meta["model_fingerprint"] not in (None, fingerprint):
+        print("⚠️  Feature store was built with a different model than the one loaded; "
+              "the MC head may not match the stored features")
+
+    for ids, features in store.iter_slices(batch_size, start, stop):
+        if adaptive is not None:
+            statistics, converged = sample_mc_predictions_adaptive(features, adaptive)
+            statistics = statistics.summary()
+        else:
+            statistics = compute_statistics(sample_mc_predictions(features, n_iterations))
+
+        for row, (image_id, result) in enumerate(zip(ids, summarize_batch(statistics, thresholds, verbose=False))):
+            if adaptive is not None:
+                result["adaptive"] = True
+                result["converged"] = bool(converged[row])
+            yield image_id, result
+
+
+OUTPUT_COLUMNS = [
+    "image_id", "class_name", "confidence", "confidence_level", "uncertainty",
+    "uncertainty_level", "predictive_entropy", "expected_entropy", "mutual_information",
+    "variation_ratio", "reliable_prediction", "n_iterations"
+]
+
+
+def _build(args):
+    if args.images:
+        items = iter_image_dir(args.images)
+    else:
+        items = iter_csv_images(args.csv, args.path_column, args.id_column)
+
+    backbone, _ = classify.get_split_models()
+    store = FeatureStore(args.store, dim=backbone.feature_dim, dtype=args.dtype, create=True)
+
+    started = time.perf_counter()
+    added, skipped, failed = build_store(store, items, args.batch_size, args.decode_threads)
+    print(f"\n✅ Store {args.store}: {len(store)} images ({added} added, {skipped} skipped, "
+          f"{failed} failed) in {time.perf_counter() - started:.1f}s")
+
+
+def _rescore(args):
+    store = FeatureStore(args.store)
+    thresholds = {key: getattr(args, key) for key in THRESHOLDS if getattr(args, key) is not None}
+    adaptive = classify.AdaptiveSampling() if args.adaptive else None
+
+    output = open(args.output, "w", newline="") if args.output else None
+    writer = None
+    if output and not args.output.endswith(".ndjson"):
+        writer = csv.DictWriter(output, fieldnames=OUTPUT_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+
+    classes = dict.fromkeys(CLASS_NAMES, 0)
+    confidence_levels = {"High": 0, "Medium": 0, "Low": 0}
+    uncertainty_levels = {"Low": 0, "Medium": 0, "High": 0}
+    reliable = total = 0
+
+    classify.load_model()
+    started = time.perf_counter()
+    try:
+        for image_id, result in rescore(store, args.n_iterations, thresholds, args.batch_size,
+                                        args.start, args.stop, adaptive):
+            total += 1
+            classes[result["class_name"]] += 1
+            confidence_levels[result["confidence_level"]] += 1
+            uncertainty_levels[result["uncertainty_level"]] += 1
+            reliable += bool(result["reliable_prediction"])
+
+            if writer:
+                writer.writerow({"image_id": image_id, **result})
+            elif output:
+                output.write(json.dumps({"image_id": image_id, **result}) + "\n")
+    finally:
+        if output:
+            output.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"\n✅ Re-scored {total} images in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} img/s)")
+    print(f"   Thresholds: {json.dumps({**THRESHOLDS, **thresholds})}")
+    print(f"   Classes: {json.dumps(classes)}")
+    print(f"   Confidence levels: {json.dumps(confidence_levels)}")
+    print(f"   Uncertainty levels: {json.dumps(uncertainty_levels)}")
+    print(f"   Reliable: {reliable} ({reliable / max(total, 1):.1%})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="bn_1 feature store for bulk MC Dropout re-scoring")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Compute features for images and append them to a store")
+    source = build.add_mutually_exclusive_group(required=True)
+    source.add_argument("--images", help="Directory of images (IDs are relative paths)")
+    source.add_argument("--csv", help="CSV listing the images")
+    build.add_argument("--path-column", default="path", help="CSV column with image paths")
+    build.add_argument("--id-column", help="CSV column with image IDs (default: the path)")
+    build.add_argument("--store", required=True, help="Feature store directory")
+    build.add_argument("--dtype", default="float16", choices=STORE_DTYPES, help="On-disk feature dtype")
+    build.add_argument("--batch-size", type=int, default=32, help="Images per backbone pass")
+    build.add_argument("--decode-threads", type=int, default=4, help="Parallel image decoders")
+    build.set_defaults(run=_build)
+
+    rescore_parser = subparsers.add_parser("rescore", help="Run the MC head over stored features")
+    rescore_parser.add_argument("--store", required=True, help="Feature store directory")
+    rescore_parser.add_argument("--n-iterations", type=int, default=30, help="MC samples per image")
+    rescore_parser.add_argument("--adaptive", action="store_true", help="Adaptive MC sampling instead")
+    rescore_parser.add_argument("--batch-size", type=int, default=1024, help="Rows per MC head call")
+    rescore_parser.add_argument("--start", type=int, default=0, help="First row to re-score")
+    rescore_parser.add_argument("--stop", type=int, help="Row to stop before (default: end of store)")
+    rescore_parser.add_argument("--output", help="Write per-image results (.csv or .ndjson)")
+    for key, default in THRESHOLDS.items():
+        rescore_parser.add_argument(f"--{key.replace('_', '-')}", dest=key, type=float,
+                                    help=f"Threshold override (default {default})")
+    rescore_parser.set_defaults(run=_rescore)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,374 @@
+"""
+HTTP load generator for the BayesDR classification API.
+
+Replays a corpus of fundus images against /api/classify and reports latency
+distributions and a saturation curve (throughput and tail latency per load
+level).
+
+Usage:
+    # Against a running server
+    python loadtest.py --url http://127.0.0.1:5500 --mode closed --levels 1 2 4 8 16
+
+    # Open-loop Poisson arrivals at 2, 5 and 10 req/s, with a stand-in model server
+    python loadtest.py --spawn-server flask --stand-in tiny --mode poisson --levels 2 5 10
+
+Modes:
+    closed    `level` clients, each sending its next request as soon as the
+              previous one returns (measures capacity)
+    poisson   open loop, exponential inter-arrival times at `level` req/s
+    constant  open loop, evenly spaced arrivals at `level` req/s
+
+Open-loop latencies are measured from the scheduled arrival time, so time
+spent waiting for a free client counts (no coordinated omission).
+
+The corpus comes from --images, or synthetic fundus photos in the sizes of
+--size-mix. Every request gets a few random trailing bytes unless
+--allow-cache-hits is set, so the server's prediction cache doesn't turn
+the test into a cache benchmark.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from benchmark import load_images, synthetic_fundus
+
+PERCENTILES = (50, 75, 90, 95, 99, 99.9)
+# Latency histogram bucket upper bounds (ms); the last bucket is open-ended
+HISTOGRAM_BOUNDS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_size_mix(spec):
+    """'3000x2000:0.5,1024x1024:0.5' -> [((3000, 2000), 0.5), ((1024, 1024), 0.5)]"""
+    mix = []
+    for part in spec.split(","):
+        size, _, weight = part.partition(":")
+        width, height = (int(v) for v in size.lower().split("x"))
+        mix.append(((width, height), float(weight or 1.0)))
+    return mix
+
+
+def build_corpus(images_dir=None, size_mix="2048x1536:0.6,1024x1024:0.3,640x480:0.1", per_size=4):
+    """
+    Return a list of (filename, image_bytes, weight) to sample requests from.
+
+    Local images are weighted equally; synthetic ones follow the size mix.
+    """
+    if images_dir:
+        return [(name, image_bytes, 1.0) for name, image_bytes in load_images(images_dir)]
+
+    corpus = []
+    for (width, height), weight in parse_size_mix(size_mix):
+        for i in range(per_size):
+            corpus.append((f"synthetic_{width}x{height}_{i}.jpg", synthetic_fundus(width, height, seed=i), weight / per_size))
+    return corpus
+
+
+def encode_multipart(field, filename, data):
+    """multipart/form-data body with one file part."""
+    boundary = uuid.uuid4().hex
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    return head + data + tail, f"multipart/form-data; boundary={boundary}"
+
+
+class LoadClient:
+    """Sends classification requests and records their outcome."""
+
+    def __init__(self, url, endpoint="/api/classify", field="image", timeout=120.0, bust_cache=True):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme or "http"
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or (443 if self.scheme == "https" else 80)
+        self.endpoint = endpoint
+        self.field = field
+        self.timeout = timeout
+        self.bust_cache = bust_cache
+
+    def _connection(self):
+        cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def get(self, path):
+        connection = self._connection()
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def classify(self, filename, image_bytes):
+        """
+        POST one image.
+
+        Returns:
+            Tuple of (status or None, error message or None)
+        """
+        if self.bust_cache:
+            # Trailing bytes after the image data: decoders ignore them, the cache key changes
+            image_bytes = image_bytes + os.urandom(16)
+        body, content_type = encode_multipart(self.field, filename, image_bytes)
+
+        connection = self._connection()
+        try:
+            connection.request("POST", self.endpoint, body=body, headers={"Content-Type": content_type})
+            response = connection.getresponse()
+            payload = response.read()
+            if response.status != 200:
+                try:
+                    message = json.loads(payload).get("message") or json.loads(payload).get("error")
+                except ValueError:
+                    message = payload[:200].decode("utf-8", "replace")
+                return response.status, message
+            return response.status, None
+        except Exception as e:
+            return None, f"{type(e).__name__}: {str(e)}"
+        finally:
+            connection.close()
+
+
+class StepRecorder:
+    """Thread-safe collection of request outcomes for one load level."""
+
+    def __init__(self):
+        self.latencies_ms = []
+        self.completed_at = []
+        self.statuses = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, latency_s, status, error):
+        with self._lock:
+            key = str(status) if status is not None else "connection_error"
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+            if error is None:
+                self.latencies_ms.append(latency_s * 1000.0)
+                self.completed_at.append(time.perf_counter())
+            else:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+
+def latency_distribution(latencies_ms):
+    """Percentiles and histogram of successful request latencies."""
+    if not latencies_ms:
+        return {"count": 0}
+    values = np.asarray(latencies_ms)
+    counts = np.histogram(values, bins=(0,) + HISTOGRAM_BOUNDS_MS + (np.inf,))[0]
+    labels = [f"<={bound}ms" for bound in HISTOGRAM_BOUNDS_MS] + [f">{HISTOGRAM_BOUNDS_MS[-1]}ms"]
+    return {
+        "count": int(len(values)),
+        "mean_ms": round(float(values.mean()), 2),
+        "min_ms": round(float(values.min()), 2),
+        "max_ms": round(float(values.max()), 2),
+        **{f"p{p:g}_ms": round(float(np.percentile(values, p)), 2) for p in PERCENTILES},
+        "histogram": dict(zip(labels, (int(c) for c in counts)))
+    }
+
+
+def run_closed(client, corpus, concurrency, duration, recorder, rng_seed=0):
+    """`concurrency` clients in a loop until the deadline."""
+    deadline = time.perf_counter() + duration
+    weights = [weight for _, _, weight in corpus]
+
+    def client_loop(index):
+        rng = random.Random(rng_seed + index)
+        while time.perf_counter() < deadline:
+            filename, image_bytes, _ = rng.choices(corpus, weights)[0]
+            start = time.perf_counter()
+            status, error = client.classify(filename, image_bytes)
+            recorder.record(time.perf_counter() - start, status, error)
+
+    threads = [threading.Thread(target=client_loop, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_open(client, corpus, rate, duration, recorder, poisson=True, max_in_flight=256, rng_seed=0):
+    """
+    Open-loop arrivals at `rate` req/s; latency counts from the scheduled arrival.
+
+    Returns:
+        Number of requests that arrived
+    """
+    rng = random.Random(rng_seed)
+    weights = [weight for _, _, weight in corpus]
+
+    def send(scheduled_at, filename, image_bytes):
+        status, error = client.classify(filename, image_bytes)
+        recorder.record(time.perf_counter() - scheduled_at, status, error)
+
+    arrivals = 0
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="bayesdr-load") as executor:
+        started = time.perf_counter()
+        next_arrival = started
+        while next_arrival < started + duration:
+            arrivals += 1
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            filename, image_bytes, _ = rng.choices(corpus, weights)[0]
+            executor.submit(send, next_arrival, filename, image_bytes)
+            next_arrival += rng.expovariate(rate) if poisson else 1.0 / rate
+    return arrivals
+
+
+def run_step(client, corpus, mode, level, duration, max_in_flight):
+    recorder = StepRecorder()
+    started = time.perf_counter()
+    if mode == "closed":
+        run_closed(client, corpus, int(level), duration, recorder)
+    else:
+        arrivals = run_open(client, corpus, float(level), duration, recorder, poisson=(mode == "poisson"),
+                            max_in_flight=max_in_flight)
+    elapsed = time.perf_counter() - started
+
+    total = sum(recorder.statuses.values())
+    succeeded = len(recorder.latencies_ms)
+    step = {
+        "mode": mode,
+        "level": level,
+        "duration_s": round(elapsed, 2),
+        "requests": total,
+        "succeeded": succeeded,
+        "error_rate": round(1.0 - succeeded / total, 4) if total else 0.0,
+        "throughput_rps": round(succeeded / elapsed, 2),
+        "statuses": recorder.statuses,
+        "errors": dict(sorted(recorder.errors.items(), key=lambda item: -item[1])[:5]),
+        "latency": latency_distribution(recorder.latencies_ms)
+    }
+    if mode != "closed":
+        # Saturated: a backlog built up, i.e. completions within the arrival
+        # window fell behind the arrivals (or requests started failing)
+        in_window = sum(1 for t in recorder.completed_at if t <= started + duration)
+        step["offered_rps"] = float(level)
+        step["arrivals"] = arrivals
+        step["throughput_rps"] = round(in_window / duration, 2)
+        step["saturated"] = in_window < 0.9 * arrivals or step["error_rate"] > 0.01
+    return step
+
+
+def spawn_server(kind, url, stand_in=None, extra_env=None, ready_timeout=600.0):
+    """Start app.py (flask) or asgi_app (uvicorn) in a subprocess and wait for /api/health."""
+    port = urlsplit(url).port or 5500
+    env = {**os.environ, "BAYESDR_PORT": str(port), **(extra_env or {})}
+    if stand_in:
+        env["BAYESDR_STAND_IN"] = stand_in
+
+    if kind == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "asgi_app:app", "--host", "127.0.0.1",
+                   "--port", str(port), "--log-level", "warning"]
+    else:
+        command = [sys.executable, "app.py"]
+
+    print(f"🚀 Starting {kind} server on port {port}" + (f" with the '{stand_in}' stand-in model" if stand_in else ""))
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    client = LoadClient(url)
+    deadline = time.time() + ready_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode} before becoming healthy")
+        try:
+            status, _ = client.get("/api/health")
+            if status == 200:
+                print("✅ Server is healthy")
+                return process
+        except OSError:
+            pass
+        time.sleep(0.5)
+
+    process.terminate()
+    raise RuntimeError(f"Server not healthy after {ready_timeout:.0f}s")
+
+
+def print_curve(steps):
+    print(f"\n{'mode':8s} {'level':>7s} {'reqs':>6s} {'rps':>8s} {'err%':>6s} {'p50 ms':>9s} "
+          f"{'p95 ms':>9s} {'p99 ms':>9s}  saturated")
+    for step in steps:
+        latency = step["latency"]
+        p = lambda key: f"{latency[key]:9.1f}" if key in latency else f"{'-':>9s}"
+        saturated = "yes" if step.get("saturated") else ("no" if "saturated" in step else "-")
+        print(f"{step['mode']:8s} {step['level']:>7g} {step['requests']:6d} {step['throughput_rps']:8.2f} "
+              f"{step['error_rate'] * 100:6.2f} {p('p50_ms')} {p('p95_ms')} {p('p99_ms')}  {saturated}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the BayesDR classification API")
+    parser.add_argument("--url", default="http://127.0.0.1:5500", help="Server base URL")
+    parser.add_argument("--endpoint", default="/api/classify", help="Endpoint to POST images to")
+    parser.add_argument("--images", help="Directory of images to replay (default: synthetic)")
+    parser.add_argument("--size-mix", default="2048x1536:0.6,1024x1024:0.3,640x480:0.1",
+                        help="Synthetic image sizes and weights, WxH:weight,...")
+    parser.add_argument("--images-per-size", type=int, default=4, help="Synthetic images per size")
+    parser.add_argument("--mode", default="closed", choices=["closed", "poisson", "constant"])
+    parser.add_argument("--levels", type=float, nargs="+", default=[1, 2, 4, 8],
+                        help="Concurrency (closed) or req/s (open loop) per step")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per step")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Untimed seconds before the first step")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout (s)")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="Client cap for open-loop modes")
+    parser.add_argument("--allow-cache-hits", action="store_true", help="Send the corpus bytes unchanged")
+    parser.add_argument("--spawn-server", choices=["flask", "asgi"], help="Start the server for the test")
+    parser.add_argument("--stand-in", choices=["tiny", "densenet"], help="Stand-in model for --spawn-server")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    corpus = build_corpus(args.images, args.size_mix, args.images_per_size)
+    print(f"📦 Corpus: {len(corpus)} images, "
+          f"{sum(len(image_bytes) for _, image_bytes, _ in corpus) / len(corpus) / 1024:.0f} KB average")
+
+    server = spawn_server(args.spawn_server, args.url, args.stand_in) if args.spawn_server else None
+    client = LoadClient(args.url, args.endpoint, timeout=args.timeout, bust_cache=not args.allow_cache_hits)
+
+    steps = []
+    try:
+        if args.warmup > 0:
+            run_closed(client, corpus, 1, args.warmup, StepRecorder())
+
+        for level in args.levels:
+            print(f"🔄 {args.mode} load at level {level:g} for {args.duration:.0f}s...")
+            steps.append(run_step(client, corpus, args.mode, level, args.duration, args.max_in_flight))
+            print_curve(steps[-1:])
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    print("\nSaturation curve:")
+    print_curve(steps)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "loadtest": "classify",
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "config": {key: value for key, value in vars(args).items() if key != "output"},
+                "corpus_size": len(corpus),
+                "steps": steps
+            }, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+"""
+Request metrics, per-stage timing spans and logging setup.
+
+Every request gets a RequestTrace with an ID (taken from a valid incoming
+X-Request-ID header, or generated). Code on the request path wraps its
+stages in span(), which records the duration in the
+bayesdr_stage_duration_seconds histogram and adds it to the traces of the
+request(s) being served. A micro-batch serves several requests, so its
+backbone and MC head time is added to every one of them.
+
+Stages:
+    upload_read  parsing the multipart body / reading the upload
+    validate     header-only image checks before decoding
+    queue        waiting in the micro-batcher queue
+    decode       opening and decoding the image (incl. JPEG draft, RGB)
+    resize       resizing to 224x224 and scaling to [0, 1]
+    augment      building the test-time augmentation views
+    fast_backbone  the cascade's own first-stage backbone, if configured
+    fast_head    the cascade's first-stage head pass
+    backbone     feature extraction (up to bn_1)
+    mc_head      MC Dropout samples of the head
+    stats        uncertainty statistics and result dicts
+    serialize    JSON encoding of the response
+
+Metrics are rendered in the Prometheus text format by render() for the
+/api/metrics endpoint. Each request's stage breakdown is returned in a
+Server-Timing header and logged at DEBUG, or at WARNING for requests over
+BAYESDR_SLOW_REQUEST_MS.
+"""
+
+import bisect
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# ✅ Logging: BAYESDR_LOG_LEVEL=DEBUG logs every request with its stage timings
+LOG_LEVEL = os.environ.get("BAYESDR_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+# Libraries whose DEBUG output would drown ours
+QUIET_LOGGERS = ("PIL", "asyncio", "h5py", "urllib3", "httpx", "httpcore", "multipart", "python_multipart")
+
+# ✅ Requests slower than this are logged with their stage breakdown (0 = off)
+SLOW_REQUEST_MS = float(os.environ.get("BAYESDR_SLOW_REQUEST_MS", "2000"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGES = ("upload_read", "validate", "queue", "decode", "resize", "augment", "fast_backbone", "fast_head", "backbone",
+          "mc_head", "stats", "serialize")
+
+# Seconds; spans range from sub-millisecond decodes to multi-second batches
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+logger = logging.getLogger("bayesdr.requests")
+
+
+def configure_logging(level=None):
+    """
+    Send log records to stderr at BAYESDR_LOG_LEVEL (default INFO).
+
+    The root logger is left alone if it is already configured, e.g. by
+    uvicorn or a test harness.
+    """
+    level = level or LOG_LEVEL
+    logging.basicConfig(level=level, format=LOG_FORMAT)
+    if logging.getLevelName(level) == logging.DEBUG:
+        for name in QUIET_LOGGERS:
+            logging.getLogger(name).setLevel(logging.INFO)
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [per-bucket counts (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        names = self.labelnames + ("le",)
+        for key, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(names, key + (_format_value(bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry:
+    """A set of metrics rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REQUESTS = REGISTRY.counter(
+    "bayesdr_requests_total", "HTTP requests by endpoint and status code", ("endpoint", "status")
+)
+REQUEST_DURATION = REGISTRY.histogram(
+    "bayesdr_request_duration_seconds", "Time from request start to response headers", ("endpoint",)
+)
+STAGE_DURATION = REGISTRY.histogram(
+    "bayesdr_stage_duration_seconds", "Time spent per pipeline stage (once per batch for batched stages)", ("stage",)
+)
+IMAGES = REGISTRY.counter(
+    "bayesdr_images_total", "Images classified, by outcome (computed, cached or failed)", ("outcome",)
+)
+UPLOAD_REJECTIONS = REGISTRY.counter(
+    "bayesdr_upload_rejections_total", "Uploads rejected before decoding, by reason", ("reason",)
+)
+MODEL_PREDICTIONS = REGISTRY.counter(
+    "bayesdr_model_predictions_total", "Predictions served, by model version and predicted class",
+    ("version", "class_name")
+)
+CASCADE_ROUTES = REGISTRY.counter(
+    "bayesdr_cascade_routes_total", "Cascade images by the stage that produced their result (fast or full)", ("stage",)
+)
+MC_SAMPLES = REGISTRY.histogram(
+    "bayesdr_mc_samples", "MC Dropout samples drawn per image", buckets=(10, 20, 30, 50, 100, 200, 500)
+)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    return REGISTRY.render()
+
+
+class RequestTrace:
+    """Stage timings of one request."""
+
+    __slots__ = ("request_id", "started_at", "stages")
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.started_at = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    def server_timing(self):
+        """Stage durations as a Server-Timing header value (milliseconds)."""
+        return ", ".join(f"{stage};dur={seconds * 1000.0:.2f}" for stage, seconds in self.stages.items())
+
+    def summary(self):
+        return " ".join(f"{stage}={seconds * 1000.0:.1f}ms" for stage, seconds in self.stages.items())
+
+
+_current_traces = contextvars.ContextVar("bayesdr_traces", default=())
+
+
+def request_id_from_header(value):
+    """Accept a client-supplied request ID only if it is short and plain."""
+    if value and REQUEST_ID_PATTERN.match(value):
+        return value
+    return None
+
+
+def current_traces():
+    """Traces of the request(s) the current code is working for."""
+    return _current_traces.get()
+
+
+def begin_request(request_id=None):
+    """
+    Start tracing a request in the current context.
+
+    Args:
+        request_id: Client-supplied X-Request-ID, used if valid
+
+    Returns:
+        Tuple of (RequestTrace, token); pass the token to release_request()
+    """
+    trace = RequestTrace(request_id_from_header(request_id))
+    return trace, _current_traces.set((trace,))
+
+
+def release_request(token):
+    """Stop attributing spans in the current context to the request."""
+    _current_traces.reset(token)
+
+
+def finish_request(trace, endpoint, status):
+    """Record a finished request's metrics and log its stage breakdown."""
+    elapsed = trace.elapsed()
+    REQUESTS.inc(endpoint=endpoint, status=status)
+    REQUEST_DURATION.observe(elapsed, endpoint=endpoint)
+
+    if SLOW_REQUEST_MS > 0 and elapsed * 1000.0 > SLOW_REQUEST_MS:
+        logger.warning("⏱️  Slow request %s %s -> %s in %.1fms: %s",
+                       trace.request_id, endpoint, status, elapsed * 1000.0, trace.summary())
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Request %s %s -> %s in %.1fms: %s",
+                     trace.request_id, endpoint, status, elapsed * 1000.0, trace.summary())
+
+
+@contextmanager
+def tracing(traces):
+    """Attribute spans in this block to the given traces (e.g. a micro-batch)."""
+    token = _current_traces.set(tuple(trace for trace in traces if trace is not None))
+    try:
+        yield
+    finally:
+        _current_traces.reset(token)
+
+
+def record_stage(stage, seconds, traces=None):
+    """Record a stage duration in the histogram and the given (or current) traces."""
+    STAGE_DURATION.observe(seconds, stage=stage)
+    for trace in current_traces() if traces is None else traces:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def span(stage):
+    """Time the block as `stage` (see STAGES)."""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started_at)
@@ -0,0 +1,342 @@
+"""
+Registry of model versions, for hot-swapping models without a restart.
+
+Versions are registered by name (see classify.ModelVersion) and loaded on
+demand. Loading builds the backbone, head and samplers and runs a warm-up
+batch, so a version is only swapped in once it can serve at full speed.
+activate() loads in a background thread and then switches the active name
+under a lock. Requests pin the loaded model they started with
+(classify.use_model()), so in-flight batches finish on the old version
+while new requests get the new one.
+
+A candidate version can get a percentage of the traffic, or be asked for
+explicitly (?model=), to compare it with the active one. Requests only
+ever get a version that is loaded (or the active one or the candidate,
+which are loaded at startup or by activate()/set_candidate()); asking for
+any other version raises ModelNotLoaded, so no request, and no batch it
+shares, waits for a model to load. At most max_loaded versions stay in
+memory: beyond that, the least recently used version that is neither
+active nor the candidate is unloaded, making room before a load where it
+can. Only a swap to a version that is neither holds one more, until the
+previous one is unloaded. An unloaded model is freed once the last
+in-flight request using it has finished.
+
+With a worker pool the models live in the worker processes, each with its
+own registry: activate() and set_candidate() take a preload callable that
+has every worker load the version (see follow()) before the switch.
+"""
+
+import gc
+import logging
+import os
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# ✅ Loaded versions kept in memory (the active one, a candidate, one to roll back to...)
+MAX_LOADED_MODELS = int(os.environ.get("BAYESDR_MAX_LOADED_MODELS", "2"))
+
+logger = logging.getLogger(__name__)
+
+
+class ModelNotLoaded(LookupError):
+    """A request asked for a registered version that is not in memory."""
+
+
+class ModelRegistry:
+    """
+    Named model versions, the active one and an optional candidate.
+
+    Args:
+        loader: Callable building the loaded (and warmed-up) model of a version
+        max_loaded: Number of loaded versions to keep in memory
+    """
+
+    def __init__(self, loader, max_loaded=MAX_LOADED_MODELS):
+        self._loader = loader
+        self.max_loaded = max(1, int(max_loaded))
+
+        self._versions = {}
+        self._loaded = OrderedDict()  # name -> loaded model, least recently used first
+        self._load_locks = {}
+        self._states = {}
+        self._lock = threading.RLock()
+        self._executor = None
+
+        self.active = None
+        self.candidate = None
+        self.candidate_percent = 0.0
+        self.swaps = 0
+
+    def register(self, version, replace=False):
+        """
+        Add a version (the first one registered becomes active).
+
+        Raises:
+            ValueError: If the name is taken (unless replace) or is the active
+                        version's or the candidate's
+        """
+        with self._lock:
+            existing = self._versions.get(version.name)
+            if existing is not None:
+                if not replace:
+                    raise ValueError(f"Model version '{version.name}' is already registered")
+                if version.name == self.active and existing != version:
+                    raise ValueError(f"Model version '{version.name}' is active; register the new model under "
+                                     f"another name and activate that")
+                if version.name == self.candidate and existing != version:
+                    # Replacing it would unload the candidate, which requests may not load
+                    raise ValueError(f"Model version '{version.name}' is the candidate; clear the candidate "
+                                     f"before registering a new model under its name")
+            if existing != version:
+                self._versions[version.name] = version
+                self._loaded.pop(version.name, None)
+                self._states[version.name] = "registered"
+            if self.active is None:
+                self.active = version.name
+        return version
+
+    def version(self, name=None):
+        """
+        A registered version (default: the active one); does not load it.
+
+        Raises:
+            ValueError: For unknown names
+        """
+        with self._lock:
+            name = self.active if name is None else name
+            if name not in self._versions:
+                raise ValueError(f"Unknown model version '{name}'. Registered: {', '.join(self._versions)}")
+            return self._versions[name]
+
+    def acquire(self, name=None, load=None):
+        """
+        The loaded model of a version (default: the active one), loading it if needed.
+
+        Concurrent callers for the same version wait for one load.
+
+        Args:
+            name: Registered version name
+            load: Whether to load a version that is not in memory; by default
+                  only the active version and the candidate are loaded
+
+        Raises:
+            ValueError: For unknown names
+            ModelNotLoaded: If the version is not in memory and may not be loaded
+        """
+        version = self.version(name)
+        with self._lock:
+            loaded = self._loaded.get(version.name)
+            if loaded is not None:
+                self._loaded.move_to_end(version.name)
+                return loaded
+            if load is None:
+                load = version.name in (self.active, self.candidate)
+            if not load:
+                raise self._not_loaded(version.name)
+            load_lock = self._load_locks.setdefault(version.name, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                loaded = self._loaded.get(version.name)
+                if loaded is not None:
+                    return loaded  # Loaded while we waited
+                self._states[version.name] = "loading"
+                self._evict(reserve=1)
+
+            try:
+                loaded = self._loader(version)
+            except Exception as e:
+                with self._lock:
+                    self._states[version.name] = f"failed: {e}"
+                raise
+
+            with self._lock:
+                if self._versions.get(version.name) == version:
+                    self._loaded[version.name] = loaded
+                    self._states[version.name] = "loaded"
+                    self._evict(keep=version.name)
+            return loaded
+
+    def activate(self, name, preload=True):
+        """
+        Make a version the active one, after loading and warming it up in the background.
+
+        Args:
+            name: Registered version name
+            preload: True to load before swapping; a callable to have other
+                     processes load it first instead (called with the
+                     ModelVersion and its new role, "active"; e.g.
+                     InferencePool.follow); False swaps at once
+
+        Returns:
+            concurrent.futures.Future resolving to the previous active name
+
+        Raises:
+            ValueError: For unknown names
+        """
+        self.version(name)
+
+        def swap():
+            if callable(preload):
+                preload(self.version(name), "active")
+            elif preload:
+                self.acquire(name, load=True)
+            with self._lock:
+                previous, self.active = self.active, name
+                if self.candidate == name:
+                    self.candidate, self.candidate_percent = None, 0.0
+                self.swaps += 1
+                self._evict()
+            logger.info("🔁 Active model version: %s (was %s)", name, previous)
+            return previous
+
+        return self._background().submit(swap)
+
+    def set_candidate(self, name=None, percent=0.0, preload=True):
+        """
+        Route `percent` of the requests that do not ask for a version to `name` (None clears it).
+
+        Like activate(), a preloaded candidate only gets traffic once it is warmed
+        up. A preload callable is called with the ModelVersion and "candidate"
+        before the switch, or with None after clearing the candidate.
+
+        Returns:
+            concurrent.futures.Future resolving when the candidate is in place
+
+        Raises:
+            ValueError: For unknown names, a percentage outside 0-100, or
+                        max_loaded too small to keep a candidate next to the active version
+        """
+        percent = float(percent)
+        if not 0.0 <= percent <= 100.0:
+            raise ValueError("Candidate percent must be between 0 and 100")
+        if name is not None:
+            self.version(name)
+            if self.max_loaded < 2 and name != self.active:
+                raise ValueError("A candidate needs BAYESDR_MAX_LOADED_MODELS of at least 2")
+
+        def switch():
+            if name is not None and callable(preload):
+                preload(self.version(name), "candidate")
+            elif name is not None and preload:
+                self.acquire(name, load=True)
+            with self._lock:
+                self.candidate = name
+                self.candidate_percent = percent if name is not None else 0.0
+                self._evict()
+            logger.info("🧪 Candidate model version: %s (%.1f%% of traffic)", name, self.candidate_percent)
+            if name is None and callable(preload):
+                preload(None, "candidate")  # After the switch: requests already routed to it still find it
+
+        if not preload or (name is None and not callable(preload)):
+            switch()
+            future = Future()
+            future.set_result(None)
+            return future
+        return self._background().submit(switch)
+
+    def follow(self, version, role="active"):
+        """
+        Mirror a switch made in another process's registry, loading the version here first.
+
+        Worker processes follow the front process this way. The version replaces
+        any registered under its name (even the active one), is loaded in the
+        calling thread and then takes `role`. The previous active version stays
+        loaded until its slot is needed, for requests routed before the switch.
+
+        Args:
+            version: ModelVersion, or None to clear the candidate
+            role: "active" or "candidate"
+
+        Raises:
+            ValueError: For another role, or clearing the active version
+        """
+        if role not in ("active", "candidate") or (version is None and role == "active"):
+            raise ValueError(f"Cannot follow a {role} model version of {getattr(version, 'name', None)}")
+        if version is not None:
+            with self._lock:
+                if self._versions.get(version.name) != version:
+                    self._versions[version.name] = version
+                    self._loaded.pop(version.name, None)
+                    self._states[version.name] = "registered"
+            self.acquire(version.name, load=True)
+
+        name = None if version is None else version.name
+        with self._lock:
+            previous = self.active
+            if role == "active":
+                self.active = name
+                if self.candidate == name:
+                    self.candidate = None
+            else:
+                self.candidate = name
+            self._evict(keep=previous)
+
+    def route(self, requested=None):
+        """
+        Name of the version to serve a request with.
+
+        Args:
+            requested: Version the client asked for (?model=), or None
+
+        Returns:
+            The requested version, else the candidate for candidate_percent
+            of requests, else the active one
+
+        Raises:
+            ValueError: For unknown names
+            ModelNotLoaded: If the requested version is neither active, the
+                            candidate nor in memory (it is not loaded for a request)
+        """
+        if requested:
+            name = self.version(requested).name
+            with self._lock:
+                if name in (self.active, self.candidate) or name in self._loaded:
+                    return name
+            raise self._not_loaded(name)
+        with self._lock:
+            if self.candidate is not None and random.random() * 100.0 < self.candidate_percent:
+                return self.candidate
+            return self.active
+
+    def _not_loaded(self, name):
+        return ModelNotLoaded(f"Model version '{name}' is not loaded; make it the candidate (percent 0 serves "
+                              f"only ?model={name} requests) or activate it first")
+
+    def _evict(self, keep=None, reserve=0):
+        # Caller holds self._lock; reserve frees slots for versions about to load
+        protected = {self.active, self.candidate, keep}
+        evicted = []
+        for name in list(self._loaded):
+            if len(self._loaded) + reserve <= self.max_loaded:
+                break
+            if name not in protected:
+                del self._loaded[name]
+                self._states[name] = "unloaded"
+                evicted.append(name)
+        if evicted:
+            logger.info("🗑️  Unloaded model version(s): %s", ", ".join(evicted))
+            gc.collect()
+
+    def _background(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bayesdr-model-loader")
+            return self._executor
+
+    def stats(self):
+        """Versions and routing, for health checks."""
+        with self._lock:
+            return {
+                "active": self.active,
+                "candidate": self.candidate,
+                "candidate_percent": self.candidate_percent,
+                "max_loaded": self.max_loaded,
+                "swaps": self.swaps,
+                "versions": [
+                    dict(version.describe(), state=self._states.get(name, "registered"))
+                    for name, version in self._versions.items()
+                ]
+            }
@@ -0,0 +1,180 @@
+"""
+Backbone runtimes and the portable MC Dropout head.
+
+The backbone (input -> bn_1 features) can run on Keras, TFLite, ONNX
+Runtime or a prebuilt SavedModel serving artifact. Every runtime is a
+callable taking a float32 batch of shape (N, 224, 224, 3) and returning
+bn_1 features of shape (N, 1024).
+
+The head is stored separately (head.npz: layer configs + weights) so a
+server using an exported backbone never has to parse the full .h5 model.
+The SavedModel artifact also carries the traced MC sampler, so nothing is
+rebuilt or re-traced at startup.
+
+TensorFlow/Keras are imported lazily, inside the functions that need them.
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+
+RUNTIMES = ("keras", "tflite", "onnx", "savedmodel")
+
+
+class KerasBackbone:
+    """Backbone as a Keras model (the reference implementation)."""
+
+    runtime = "keras"
+
+    def __init__(self, model):
+        import tensorflow as tf
+
+        self.model = model
+        self.feature_dim = model.output_shape[-1]
+        # One traced graph for any batch size instead of eager layer-by-layer calls
+        self._forward = tf.function(
+            lambda images: model(images, training=False),
+            input_signature=[tf.TensorSpec(shape=(None,) + tuple(model.input_shape[1:]), dtype=tf.float32)]
+        )
+
+    def __call__(self, img_batch):
+        return self._forward(np.asarray(img_batch, dtype=np.float32)).numpy()
+
+
+class TFLiteBackbone:
+    """
+    Backbone exported to TFLite (float32, float16, dynamic-range or int8).
+
+    The interpreter is not thread-safe, so calls are serialized; the input
+    tensor is only resized when the batch size changes.
+    """
+
+    runtime = "tflite"
+
+    def __init__(self, path, num_threads=None):
+        import tensorflow as tf
+
+        self.path = path
+        self._interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads or None)
+        self._input = self._interpreter.get_input_details()[0]["index"]
+        self._output = self._interpreter.get_output_details()[0]["index"]
+        self._batch_size = None
+        self._lock = threading.Lock()
+        self.feature_dim = int(self._interpreter.get_output_details()[0]["shape"][-1])
+
+    def __call__(self, img_batch):
+        img_batch = np.ascontiguousarray(img_batch, dtype=np.float32)
+        with self._lock:
+            if img_batch.shape[0] != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input, img_batch.shape)
+                self._interpreter.allocate_tensors()
+                self._batch_size = img_batch.shape[0]
+            self._interpreter.set_tensor(self._input, img_batch)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output).copy()
+
+
+class OnnxBackbone:
+    """Backbone exported to ONNX, run with ONNX Runtime on CPU."""
+
+    runtime = "onnx"
+
+    def __init__(self, path, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnx runtime needs onnxruntime: pip install onnxruntime")
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self._session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self._input = self._session.get_inputs()[0].name
+        self.feature_dim = int(self._session.get_outputs()[0].shape[-1])
+
+    def __call__(self, img_batch):
+        return self._session.run(None, {self._input: np.asarray(img_batch, dtype=np.float32)})[0]
+
+
+class SavedModelArtifact:
+    """
+    Serving artifact written by `export_model.py artifact`: a SavedModel with
+    the backbone and the MC sampler as already-traced concrete functions.
+
+    Besides being a backbone callable, it provides `mc_sampler`, a drop-in
+    for classify._build_mc_sampler() with the same (features, n_iterations)
+    signature, and `seeded_mc_sampler` for classify._build_seeded_mc_sampler()
+    (None for artifacts exported before seeded sampling existed).
+    """
+
+    runtime = "savedmodel"
+
+    def __init__(self, path):
+        import tensorflow as tf
+
+        self.path = path
+        self._module = tf.saved_model.load(path)
+        self.feature_dim = int(self._module.feature_dim.numpy())
+        self.mc_sampler = self._module.mc_sample
+        self.seeded_mc_sampler = getattr(self._module, "mc_sample_seeded", None)
+
+    def __call__(self, img_batch):
+        return self._module.features(np.asarray(img_batch, dtype=np.float32)).numpy()
+
+
+def load_backbone(runtime, path, num_threads=None):
+    """Load an exported backbone for the given runtime ('tflite', 'onnx' or 'savedmodel')."""
+    if not path or not os.path.exists(path):
+        raise FileNotFoundError(f"Backbone file for the {runtime} runtime not found: {path!r}")
+    if runtime == "tflite":
+        return TFLiteBackbone(path, num_threads)
+    if runtime == "onnx":
+        return OnnxBackbone(path, num_threads)
+    if runtime == "savedmodel":
+        return SavedModelArtifact(path)
+    raise ValueError(f"Unknown backbone runtime '{runtime}'. Use one of: {', '.join(RUNTIMES)}")
+
+
+def save_head(model, layer_names, path):
+    """Save the head layers' configs and weights of a trained model to an .npz file."""
+    from tensorflow import keras
+
+    configs = []
+    arrays = {}
+    for i, name in enumerate(layer_names):
+        layer = model.get_layer(name)
+        configs.append(keras.layers.serialize(layer))
+        for j, weight in enumerate(layer.get_weights()):
+            arrays[f"layer{i}_w{j}"] = weight
+
+    feature_dim = model.get_layer(layer_names[0]).input.shape[-1]
+    np.savez(path, configs=np.array(json.dumps(configs)), feature_dim=np.array(feature_dim), **arrays)
+
+
+def load_head_layers(path):
+    """
+    Rebuild the head layers saved by save_head().
+
+    Returns:
+        Tuple of (layers, feature_dim) with weights loaded
+    """
+    from tensorflow import keras
+
+    with np.load(path) as data:
+        configs = json.loads(str(data["configs"]))
+        feature_dim = int(data["feature_dim"])
+
+        layers = []
+        x = keras.Input(shape=(feature_dim,))
+        for i, config in enumerate(configs):
+            layer = keras.layers.deserialize(config)
+            x = layer(x)
+            weights = [data[f"layer{i}_w{j}"] for j in range(len(layer.get_weights()))]
+            if weights:
+                layer.set_weights(weights)
+            layers.append(layer)
+
+    return layers, feature_dim
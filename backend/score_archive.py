@@ -0,0 +1,461 @@
+"""
+Batch scorer for whole image archives.
+
+Scores every image under a directory laid out like the training data
+(dataset/colored_images/<class>/<image>, see bcnn/DenseNet(70:30)/BCNN.ipynb),
+or listed in a CSV, and writes one row per image with every field of
+predict_with_uncertainty():
+
+    python score_archive.py --images dataset/colored_images --output scores.csv
+    python score_archive.py --images dataset/colored_images --output scores.parquet --seed image
+    python score_archive.py --csv cohort.csv --path-column path --label-column grade --output scores.csv
+
+Files are read ahead by a thread pool, each mini-batch is decoded and
+resized by a second pool, and the backbone and MC head run once per
+mini-batch (classify.iter_batch_predictions), so no stage waits on
+per-image Python calls.
+
+Checkpointing: rows are appended to a CSV journal (the output itself, or
+<output>.journal.csv for Parquet) and fsynced every --checkpoint-every
+images. Re-running the same command resumes after the last complete row;
+<output>.checkpoint.json records the model and MC settings, and a resume
+with different ones is refused. Images that failed are kept in the
+journal with their error and not retried.
+
+When the images have labels (the class folder, or --label-column), an
+accuracy and confusion summary is printed at the end.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import classify
+from classify import CLASS_NAMES, THRESHOLDS, get_model_fingerprint, iter_batch_predictions
+from feature_store import iter_csv_images, iter_image_dir
+
+OUTPUT_FORMATS = (".csv", ".parquet")
+
+RESULT_COLUMNS = [
+    "predicted_class", "class_name", "class_label", "confidence", "confidence_level",
+    "uncertainty", "class_uncertainty", "predictive_entropy", "uncertainty_level",
+    "expected_entropy", "mutual_information", "variation_ratio", "reliable_prediction",
+    "n_iterations", "adaptive", "converged", "mc_seed"
+]
+PROBABILITY_COLUMNS = [f"probability_{name}" for name in CLASS_NAMES]
+STD_COLUMNS = [f"std_{name}" for name in CLASS_NAMES]
+OUTPUT_COLUMNS = (
+    ["image_id", "path", "label", "correct"] + RESULT_COLUMNS + PROBABILITY_COLUMNS + STD_COLUMNS + ["error"]
+)
+
+# Column types for the Parquet export (everything else is inferred)
+PARQUET_DTYPES = {
+    "image_id": "string", "path": "string", "label": "string", "error": "string", "mc_seed": "string",
+    "correct": "boolean", "reliable_prediction": "boolean", "adaptive": "boolean", "converged": "boolean"
+}
+
+
+def label_from_value(value):
+    """
+    Normalize a label to a class name.
+
+    Accepts a class name (No_DR, Mild, ...) or its index (0-4), as used by
+    the Kaggle folder and CSV layouts.
+
+    Returns:
+        Class name, or None if the value is not a known class
+    """
+    value = str(value).strip()
+    if value in CLASS_NAMES:
+        return value
+    if value.isdigit() and int(value) < len(CLASS_NAMES):
+        return CLASS_NAMES[int(value)]
+    return None
+
+
+def iter_labelled_dir(images_dir):
+    """Yield (image_id, path, label) for an image directory; the label is the class folder, if any."""
+    for image_id, path in iter_image_dir(images_dir):
+        parts = image_id.split(os.sep)
+        yield image_id, path, label_from_value(parts[0]) if len(parts) > 1 else None
+
+
+def iter_labelled_csv(csv_path, path_column="path", id_column=None, label_column=None):
+    """Yield (image_id, path, label) from a CSV; label is None without a label column."""
+    if label_column is None:
+        for image_id, path in iter_csv_images(csv_path, path_column, id_column):
+            yield image_id, path, None
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(csv_path))
+    with open(csv_path, newline="") as f:
+        for row in csv.DictReader(f):
+            path = row[path_column]
+            image_id = row[id_column] if id_column else path
+            path = path if os.path.isabs(path) else os.path.join(base_dir, path)
+            yield image_id, path, label_from_value(row.get(label_column, ""))
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def iter_read_ahead(items, executor, window=256):
+    """
+    Read image files on a thread pool, up to `window` files ahead.
+
+    Args:
+        items: Iterable of (key, path)
+        executor: Thread pool for the reads
+
+    Yields:
+        (key, image_bytes, error) in input order; image_bytes is None when
+        the file could not be read
+    """
+    pending = deque()
+    for key, path in items:
+        pending.append((key, executor.submit(_read_file, path)))
+        if len(pending) >= window:
+            yield _take(pending)
+    while pending:
+        yield _take(pending)
+
+
+def _take(pending):
+    key, future = pending.popleft()
+    try:
+        return key, future.result(), None
+    except OSError as e:
+        return key, None, e
+
+
+class Checkpoint:
+    """
+    CSV journal of scored images plus the settings they were scored with.
+
+    Rows are only trusted up to the last newline, so a journal cut off
+    mid-row by a crash is truncated to its complete rows when reopened.
+    """
+
+    def __init__(self, journal_path, meta_path, settings):
+        self.journal_path = journal_path
+        self.meta_path = meta_path
+        self.settings = settings
+        self.done = set()
+        self._file = None
+        self._writer = None
+
+    def open(self, resume=True):
+        """Open the journal for appending; returns the number of rows already in it."""
+        resume = resume and os.path.exists(self.journal_path)
+        if resume:
+            if os.path.exists(self.meta_path):
+                with open(self.meta_path) as f:
+                    saved = json.load(f)
+                changed = [key for key in self.settings if saved.get(key) != self.settings[key]]
+                if changed:
+                    raise ValueError(f"{self.journal_path} was scored with different settings "
+                                     f"({', '.join(changed)}); use --restart or another output path")
+            self._truncate_partial_row()
+            with open(self.journal_path, newline="") as f:
+                reader = csv.DictReader(f)
+                if reader.fieldnames and reader.fieldnames != OUTPUT_COLUMNS:
+                    raise ValueError(f"{self.journal_path} has different columns; use --restart "
+                                     f"or another output path")
+                self.done = {row["image_id"] for row in reader}
+
+        has_header = resume and os.path.getsize(self.journal_path) > 0
+        self._file = open(self.journal_path, "a" if resume else "w", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=OUTPUT_COLUMNS, extrasaction="ignore")
+        if not has_header:
+            self._writer.writeheader()
+
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({**self.settings, "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S")}, f, indent=2)
+        os.replace(tmp_path, self.meta_path)
+
+        return len(self.done)
+
+    def _truncate_partial_row(self):
+        with open(self.journal_path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                f.truncate(end)
+
+    def write(self, row):
+        self._writer.writerow(row)
+        self.done.add(row["image_id"])
+
+    def commit(self):
+        """Make the rows written so far durable."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.commit()
+            self._file.close()
+            self._file = None
+
+
+def result_row(image_id, path, label, result=None, error=None):
+    """Flatten a predict_with_uncertainty() result into an output row."""
+    row = {"image_id": image_id, "path": path, "label": label or ""}
+    if error is not None:
+        row["error"] = str(error)
+        return row
+
+    row.update({column: result.get(column) for column in RESULT_COLUMNS})
+    row["adaptive"] = bool(result.get("adaptive", False))
+    row.update(zip(PROBABILITY_COLUMNS, result["probabilities"]))
+    row.update(zip(STD_COLUMNS, result["std_deviations"]))
+    if label:
+        row["correct"] = result["class_name"] == label
+    return row
+
+
+def score_archive(items, checkpoint, n_iterations=30, batch_size=32, decode_threads=4, read_threads=8,
+                  adaptive=None, seed=None, checkpoint_every=1024):
+    """
+    Score (image_id, path, label) items and append the rows to the checkpoint journal.
+
+    Images already in the journal are skipped, so an interrupted run can be
+    resumed. Rows are committed every `checkpoint_every` images.
+
+    Returns:
+        Tuple of (n_scored, n_skipped, n_failed)
+    """
+    counts = {"scored": 0, "skipped": 0, "failed": 0}
+    pending = {}      # image_id -> (path, label) for images in flight
+    read_errors = {}  # image_id -> OSError, for files that could not be read
+
+    def todo():
+        for image_id, path, label in items:
+            image_id = str(image_id)
+            if image_id in checkpoint.done or image_id in pending:
+                counts["skipped"] += 1
+                continue
+            pending[image_id] = (path, label)
+            yield image_id, path
+
+    def readable(executor):
+        for image_id, image_bytes, error in iter_read_ahead(todo(), executor, window=batch_size * 4):
+            if error is not None:
+                read_errors[image_id] = error
+                image_bytes = b""
+            yield image_id, image_bytes
+
+    started = last_report = time.perf_counter()
+    since_commit = 0
+    with ThreadPoolExecutor(max_workers=max(1, read_threads), thread_name_prefix="bayesdr-score-read") as executor:
+        predictions = iter_batch_predictions(
+            readable(executor), n_iterations, batch_size, adaptive=adaptive, seed=seed,
+            decode_threads=decode_threads
+        )
+        for image_id, result, error in predictions:
+            path, label = pending.pop(image_id)
+            error = read_errors.pop(image_id, error)
+            checkpoint.write(result_row(image_id, path, label, result, error))
+            counts["failed" if error is not None else "scored"] += 1
+
+            since_commit += 1
+            if since_commit >= checkpoint_every:
+                checkpoint.commit()
+                since_commit = 0
+
+                now = time.perf_counter()
+                if now - last_report >= 5.0:
+                    last_report = now
+                    print(f"📦 {counts['scored']} scored, {counts['skipped']} skipped, {counts['failed']} failed "
+                          f"({counts['scored'] / max(now - started, 1e-9):.1f} img/s)")
+
+    checkpoint.commit()
+    return counts["scored"], counts["skipped"], counts["failed"]
+
+
+def summarize_scores(journal_path):
+    """
+    Accuracy and confusion matrix over the labelled, successfully scored rows of a journal.
+
+    Returns:
+        Dict with totals, accuracy, reliable-subset accuracy, per-class
+        precision/recall and the confusion matrix (rows = label, columns =
+        prediction, in CLASS_NAMES order); accuracy is None without labels
+    """
+    index = {name: i for i, name in enumerate(CLASS_NAMES)}
+    confusion = [[0] * len(CLASS_NAMES) for _ in CLASS_NAMES]
+    totals = {"rows": 0, "failed": 0, "labelled": 0, "reliable": 0, "reliable_labelled": 0, "reliable_correct": 0}
+    predicted = dict.fromkeys(CLASS_NAMES, 0)
+
+    with open(journal_path, newline="") as f:
+        for row in csv.DictReader(f):
+            totals["rows"] += 1
+            if row["error"]:
+                totals["failed"] += 1
+                continue
+            predicted[row["class_name"]] += 1
+            reliable = row["reliable_prediction"] == "True"
+            totals["reliable"] += reliable
+            if row["label"]:
+                totals["labelled"] += 1
+                confusion[index[row["label"]]][index[row["class_name"]]] += 1
+                if reliable:
+                    totals["reliable_labelled"] += 1
+                    totals["reliable_correct"] += row["label"] == row["class_name"]
+
+    correct = sum(confusion[i][i] for i in range(len(CLASS_NAMES)))
+    per_class = {}
+    for i, name in enumerate(CLASS_NAMES):
+        support = sum(confusion[i])
+        predicted_as = sum(confusion[j][i] for j in range(len(CLASS_NAMES)))
+        per_class[name] = {
+            "support": support,
+            "recall": confusion[i][i] / support if support else None,
+            "precision": confusion[i][i] / predicted_as if predicted_as else None
+        }
+
+    return {
+        **totals,
+        "predicted": predicted,
+        "accuracy": correct / totals["labelled"] if totals["labelled"] else None,
+        "reliable_accuracy": (totals["reliable_correct"] / totals["reliable_labelled"]
+                              if totals["reliable_labelled"] else None),
+        "per_class": per_class,
+        "confusion_matrix": confusion
+    }
+
+
+def print_summary(summary):
+    scored = summary["rows"] - summary["failed"]
+    print(f"   Rows: {summary['rows']} ({scored} scored, {summary['failed']} failed)")
+    print(f"   Predicted: {json.dumps(summary['predicted'])}")
+    print(f"   Reliable: {summary['reliable']} ({summary['reliable'] / max(scored, 1):.1%})")
+    if summary["accuracy"] is None:
+        return
+
+    print(f"\n📊 Accuracy: {summary['accuracy']:.2%} on {summary['labelled']} labelled images")
+    if summary["reliable_accuracy"] is not None:
+        print(f"   Reliable predictions: {summary['reliable_accuracy']:.2%} "
+              f"on {summary['reliable_labelled']} labelled images")
+
+    width = max(len(name) for name in CLASS_NAMES) + 2
+    corner = "label \\ predicted"
+    print(f"\n   {corner:<{width + 2}}" + "".join(f"{name:>{width}}" for name in CLASS_NAMES)
+          + f"{'recall':>{width}}")
+    for name, row in zip(CLASS_NAMES, summary["confusion_matrix"]):
+        recall = summary["per_class"][name]["recall"]
+        print(f"   {name:<{width + 2}}" + "".join(f"{count:>{width}}" for count in row)
+              + (f"{recall:>{width}.1%}" if recall is not None else f"{'-':>{width}}"))
+    print(f"   {'precision':<{width + 2}}" + "".join(
+        f"{precision:>{width}.1%}" if precision is not None else f"{'-':>{width}}"
+        for precision in (summary["per_class"][name]["precision"] for name in CLASS_NAMES)
+    ))
+
+
+def export_parquet(journal_path, output_path):
+    """Convert the CSV journal into a Parquet file (needs pandas and pyarrow)."""
+    try:
+        import pandas as pd
+    except ImportError:
+        raise ImportError("Parquet output needs pandas and pyarrow: pip install pandas pyarrow")
+
+    frame = pd.read_csv(journal_path, dtype=PARQUET_DTYPES)
+    tmp_path = output_path + ".tmp"
+    frame.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+    return len(frame)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score an image archive with MC Dropout uncertainty")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--images", help="Image directory, e.g. dataset/colored_images (class folders = labels)")
+    source.add_argument("--csv", help="CSV listing the images")
+    parser.add_argument("--path-column", default="path", help="CSV column with image paths")
+    parser.add_argument("--id-column", help="CSV column with image IDs (default: the path)")
+    parser.add_argument("--label-column", help="CSV column with class names or indices")
+    parser.add_argument("--output", required=True, help="Output file (.csv or .parquet)")
+    parser.add_argument("--n-iterations", type=int, default=30, help="MC samples per image")
+    parser.add_argument("--adaptive", action="store_true", help="Adaptive MC sampling instead")
+    parser.add_argument("--seed", default=classify.DEFAULT_MC_SEED,
+                        help="MC Dropout seed: 'image', an integer, or 'random' (default: BAYESDR_MC_SEED)")
+    parser.add_argument("--batch-size", type=int, default=32, help="Images per backbone pass")
+    parser.add_argument("--decode-threads", type=int, default=os.cpu_count() or 1,
+                        help="Parallel image decoders (default: one per CPU)")
+    parser.add_argument("--read-threads", type=int, default=8, help="Parallel file readers")
+    parser.add_argument("--checkpoint-every", type=int, default=1024, help="Images between journal fsyncs")
+    parser.add_argument("--restart", action="store_true", help="Discard an existing journal instead of resuming")
+    parser.add_argument("--summary", help="Also write the accuracy/confusion summary as JSON")
+    args = parser.parse_args(argv)
+
+    extension = os.path.splitext(args.output)[1].lower()
+    if extension not in OUTPUT_FORMATS:
+        parser.error(f"--output must end in one of: {', '.join(OUTPUT_FORMATS)}")
+    try:
+        seed = classify.parse_seed(args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    adaptive = classify.AdaptiveSampling() if args.adaptive else None
+    cache.configure(0, "")  # Every image is scored once; the journal is what makes a run resumable
+
+    if args.images:
+        items = iter_labelled_dir(args.images)
+    else:
+        items = iter_labelled_csv(args.csv, args.path_column, args.id_column, args.label_column)
+
+    classify.load_model()
+    settings = {
+        "model_fingerprint": get_model_fingerprint(),
+        "mc_config": classify.mc_config_tag(args.n_iterations, adaptive),
+        "seed": seed,
+        "thresholds": THRESHOLDS
+    }
+    journal_path = args.output if extension == ".csv" else args.output + ".journal.csv"
+    checkpoint = Checkpoint(journal_path, args.output + ".checkpoint.json", settings)
+
+    try:
+        resumed = checkpoint.open(resume=not args.restart)
+    except ValueError as e:
+        parser.error(str(e))
+    if resumed:
+        print(f"🔄 Resuming {journal_path}: {resumed} images already scored")
+
+    started = time.perf_counter()
+    try:
+        scored, skipped, failed = score_archive(
+            items, checkpoint, args.n_iterations, args.batch_size, args.decode_threads, args.read_threads,
+            adaptive, seed, args.checkpoint_every
+        )
+    except KeyboardInterrupt:
+        print(f"\n⚠️  Interrupted; {len(checkpoint.done)} images are in {journal_path}. "
+              f"Re-run the same command to resume.")
+        return 130
+    finally:
+        checkpoint.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"\n✅ Scored {scored} images in {elapsed:.1f}s ({scored / max(elapsed, 1e-9):.1f} img/s), "
+          f"{skipped} skipped, {failed} failed")
+
+    if extension == ".parquet":
+        rows = export_parquet(journal_path, args.output)
+        print(f"📦 Wrote {rows} rows to {args.output}")
+
+    summary = summarize_scores(journal_path)
+    print_summary(summary)
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
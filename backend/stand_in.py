@@ -0,0 +1,81 @@
+"""
+Stand-in for the trained BCNN, for benchmarks and CI without the real weights.
+
+The stand-in has the same interface as bayesian_densenet_final.h5: a
+224x224x3 input, a 1024-d `bn_1` layer and the same head layers
+(dense_1 .. bayesian_dropout_3, output) with the same shapes. Weights are
+random (seeded), so predictions are meaningless but the serving stack does
+the same work.
+
+Kinds:
+    densenet  DenseNet121 backbone, as in the notebook; realistic compute cost
+    tiny      a few strided convolutions; fast, for CI and load-test plumbing
+
+Use it via BAYESDR_STAND_IN=tiny|densenet (load_model() builds it instead
+of reading MODEL_PATH), or write an .h5 for tools that need a file:
+    python stand_in.py --kind densenet --output stand_in.h5
+"""
+
+import argparse
+import sys
+
+STAND_IN_KINDS = ("densenet", "tiny")
+FEATURE_DIM = 1024
+HEAD_UNITS = (512, 256, 128)
+NUM_CLASSES = 5
+
+
+def build_stand_in_model(kind="tiny", seed=0, dropout_rate=0.5):
+    """
+    Build a randomly initialized model with the BCNN's layer names and shapes.
+
+    Args:
+        kind: 'densenet' or 'tiny'
+        seed: Weight initialization seed
+        dropout_rate: Rate of the bayesian_dropout_* layers (as in training)
+
+    Returns:
+        Uncompiled keras.Model
+    """
+    from tensorflow import keras
+    from tensorflow.keras import layers
+
+    if kind not in STAND_IN_KINDS:
+        raise ValueError(f"Unknown stand-in kind '{kind}'. Use one of: {', '.join(STAND_IN_KINDS)}")
+
+    keras.utils.set_random_seed(seed)
+
+    if kind == "densenet":
+        base_model = keras.applications.DenseNet121(input_shape=(224, 224, 3), include_top=False, weights=None)
+        inputs, x = base_model.input, base_model.output
+    else:
+        inputs = keras.Input(shape=(224, 224, 3))
+        x = layers.Conv2D(32, 3, strides=4, activation="relu", name="stand_in_conv_1")(inputs)
+        x = layers.Conv2D(64, 3, strides=2, activation="relu", name="stand_in_conv_2")(x)
+        x = layers.Conv2D(FEATURE_DIM, 1, activation="relu", name="stand_in_conv_3")(x)
+
+    # Same head as build_bayesian_cnn_densenet() in the notebook
+    x = layers.GlobalAveragePooling2D(name="global_avg_pool")(x)
+    x = layers.BatchNormalization(name="bn_1")(x)
+    for i, units in enumerate(HEAD_UNITS, start=1):
+        x = layers.Dense(units, activation="relu", name=f"dense_{i}")(x)
+        x = layers.Dropout(dropout_rate, name=f"bayesian_dropout_{i}")(x)
+    outputs = layers.Dense(NUM_CLASSES, activation="softmax", name="output")(x)
+
+    return keras.Model(inputs, outputs, name=f"stand_in_{kind}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a stand-in BCNN model file")
+    parser.add_argument("--kind", default="tiny", choices=STAND_IN_KINDS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True, help="Output .h5 path")
+    args = parser.parse_args(argv)
+
+    model = build_stand_in_model(args.kind, args.seed)
+    model.save(args.output)
+    print(f"✅ Stand-in model ({args.kind}, seed {args.seed}) saved to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
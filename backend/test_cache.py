@@ -0,0 +1,57 @@
+"""
+Prediction cache: keys keep results apart, and the cache can be turned off.
+
+    cd backend && python -m pytest -q
+"""
+
+import pytest
+
+pytest.importorskip("numpy")
+
+import cache
+import classify
+
+
+def test_result_keys_separate_settings_seeds_and_models():
+    image_hash = cache.hash_bytes(b"image")
+    other = classify.ModelVersion("other", "keras", classify.MODEL_PATH, stand_in="densenet")
+    fingerprints = (classify.get_registry().version().fingerprint, other.fingerprint)
+    configs = (
+        classify.mc_config_tag(30),
+        classify.mc_config_tag(50),
+        classify.mc_config_tag(30, adaptive=classify.AdaptiveSampling()),
+        classify.mc_config_tag(30, tta=classify.TestTimeAugmentation()),
+        classify.mc_config_tag(30, cascade=classify.Cascade())
+    )
+
+    keys = [
+        cache.result_key(image_hash, fingerprint, config, seed)
+        for fingerprint in fingerprints
+        for config in configs
+        for seed in (None, classify.SEED_FROM_IMAGE, 7)
+    ]
+    assert len(set(keys)) == len(keys)
+
+
+def test_result_keys_change_with_the_schema_version(monkeypatch):
+    key = cache.result_key("hash", "fingerprint", 30, None)
+    monkeypatch.setattr(cache, "RESULT_SCHEMA_VERSION", cache.RESULT_SCHEMA_VERSION + 1)
+    assert cache.result_key("hash", "fingerprint", 30, None) != key
+
+
+def test_seeded_features_are_cached_apart():
+    assert cache.features_key("hash", "fingerprint") != cache.features_key("hash", "fingerprint", batch_invariant=True)
+
+
+def test_configure_replaces_the_shared_cache(monkeypatch):
+    monkeypatch.setattr(cache, "_cache", None)
+    enabled = cache.configure(1024 * 1024, "")
+    assert cache.get_cache() is enabled and enabled.enabled
+
+    enabled.put_result("key", {"class_name": "Mild"})
+    assert enabled.get_result("key") == {"class_name": "Mild"}
+
+    disabled = cache.configure(0, "")
+    assert cache.get_cache() is disabled and not disabled.enabled
+    disabled.put_result("key", {"class_name": "Mild"})
+    assert disabled.get_result("key") is None
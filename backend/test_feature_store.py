@@ -0,0 +1,56 @@
+"""
+Feature store: commits survive reopening, damaged stores are refused.
+
+    cd backend && python -m pytest -q
+"""
+
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from feature_store import ERRORS_FILE, IDS_FILE, FeatureStore
+
+
+def _store(path, n_rows=3):
+    store = FeatureStore(str(path), dim=4, create=True)
+    store.append([f"image-{i}" for i in range(n_rows)], np.arange(n_rows * 4, dtype=np.float32).reshape(n_rows, 4))
+    return store
+
+
+def test_append_and_reopen(tmp_path):
+    _store(tmp_path)
+    store = FeatureStore(str(tmp_path))
+    assert len(store) == 3
+    assert store.index_of("image-2") == 2
+    np.testing.assert_array_equal(store.features(1, 2), [[4, 5, 6, 7]])
+
+
+def test_missing_ids_are_refused(tmp_path):
+    _store(tmp_path)
+    with open(os.path.join(tmp_path, IDS_FILE), "w") as f:
+        f.write("image-0\nimage-1\n")
+    with pytest.raises(ValueError, match="damaged"):
+        FeatureStore(str(tmp_path))
+
+
+def test_uncommitted_ids_are_truncated(tmp_path):
+    _store(tmp_path)
+    with open(os.path.join(tmp_path, IDS_FILE), "a") as f:
+        f.write("image-3\n")
+    assert FeatureStore(str(tmp_path)).ids == ["image-0", "image-1", "image-2"]
+
+
+def test_retried_errors_keep_one_row(tmp_path):
+    store = _store(tmp_path)
+    store.record_errors([("bad", "cannot identify image"), ("worse", "truncated")])
+    store.record_errors([("bad", "still broken")])
+
+    with open(os.path.join(tmp_path, ERRORS_FILE)) as f:
+        rows = [json.loads(line) for line in f]
+    assert rows == [{"image_id": "bad", "error": "still broken"}, {"image_id": "worse", "error": "truncated"}]
+
+    store.append(["worse"], np.zeros((1, 4), dtype=np.float32))
+    assert FeatureStore(str(tmp_path)).errors == {"bad": "still broken"}
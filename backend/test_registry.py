@@ -0,0 +1,117 @@
+"""
+Model registry: hot swaps, candidates, eviction and worker processes following the front process.
+
+    cd backend && python -m pytest -q
+"""
+
+import pytest
+
+pytest.importorskip("numpy")
+
+import classify
+from registry import ModelNotLoaded, ModelRegistry
+
+
+def version(name, stand_in="tiny"):
+    return classify.ModelVersion(name, "keras", classify.MODEL_PATH, stand_in=stand_in)
+
+
+@pytest.fixture
+def loads():
+    """Names passed to the registry's loader, in order."""
+    return []
+
+
+@pytest.fixture
+def registry(loads):
+    def loader(model_version):
+        loads.append(model_version.name)
+        return classify.LoadedModel(model_version)
+
+    registry = ModelRegistry(loader, max_loaded=2)
+    for name in ("a", "b", "c"):
+        registry.register(version(name))
+    return registry
+
+
+def test_activate_loads_before_switching_and_evicts(registry, loads):
+    assert registry.acquire().name == "a"
+    assert registry.activate("b").result(timeout=10) == "a"
+    assert registry.active == "b" and loads == ["a", "b"]
+
+    registry.activate("c").result(timeout=10)
+    assert loads == ["a", "b", "c"]
+    assert [v["state"] for v in registry.stats()["versions"]] == ["unloaded", "loaded", "loaded"]
+
+
+def test_requests_never_load_a_version(registry, loads):
+    registry.acquire()
+    with pytest.raises(ModelNotLoaded):
+        registry.acquire("b")
+    with pytest.raises(ModelNotLoaded):
+        registry.route("b")
+    with pytest.raises(ValueError):
+        registry.route("missing")
+    assert registry.route() == registry.route("a") == "a"
+    assert loads == ["a"]
+
+
+def test_in_flight_requests_keep_their_version(registry, monkeypatch):
+    monkeypatch.setattr(classify, "_registry", registry)
+    with classify.use_model() as pinned:
+        registry.activate("b").result(timeout=10)
+        assert classify.current_model() is pinned and pinned.name == "a"
+    assert classify.current_model().name == "b"
+
+
+def test_candidate_gets_traffic_once_loaded(registry, loads):
+    registry.set_candidate("b", 100).result(timeout=10)
+    assert loads == ["b"] and registry.route() == "b"
+    registry.set_candidate(None).result(timeout=10)
+    assert registry.route() == "a"
+
+
+def test_the_candidate_cannot_be_replaced(registry):
+    registry.set_candidate("b", 0).result(timeout=10)
+    with pytest.raises(ValueError, match="is the candidate"):
+        registry.register(version("b", stand_in="densenet"), replace=True)
+    registry.register(version("b"), replace=True)  # The same model is fine
+    assert registry.acquire("b", load=False).name == "b"
+
+
+def test_preload_callable_runs_before_the_switch(registry, loads):
+    calls = []
+
+    def preload(model_version, role):
+        calls.append((getattr(model_version, "name", None), role, registry.active, registry.candidate))
+
+    registry.activate("b", preload=preload).result(timeout=10)
+    registry.set_candidate("c", 10, preload=preload).result(timeout=10)
+    registry.set_candidate(None, preload=preload).result(timeout=10)
+    assert calls == [("b", "active", "a", None), ("c", "candidate", "b", None), (None, "candidate", "b", None)]
+    assert loads == []  # Loaded elsewhere (the workers), not here
+
+    def failing(model_version, role):
+        raise RuntimeError("worker could not load it")
+
+    with pytest.raises(RuntimeError):
+        registry.activate("c", preload=failing).result(timeout=10)
+    assert registry.active == "b"
+
+
+def test_follow_mirrors_the_front_process(registry, loads):
+    registry.acquire()
+    # The front process re-pointed "a" after activating another version
+    registry.follow(version("a", stand_in="densenet"), "active")
+    assert registry.version("a").stand_in == "densenet" and loads == ["a", "a"]
+
+    registry.follow(version("b"), "active")
+    # The previous active version stays for tasks routed before the switch
+    assert registry.acquire("a", load=False).name == "a"
+    registry.follow(version("c"), "candidate")
+    assert (registry.active, registry.candidate) == ("b", "c")
+
+    registry.follow(None, "candidate")
+    assert registry.candidate is None
+    with pytest.raises(ValueError):
+        registry.follow(None, "active")
@@ -0,0 +1,92 @@
+"""
+Seeded MC Dropout (results do not depend on batching) and the fused samplers.
+
+    cd backend && python -m pytest -q
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import cache
+import classify
+from stand_in import FEATURE_DIM
+
+
+@pytest.fixture(scope="module")
+def images(png):
+    return [png(seed=seed) for seed in range(5)]
+
+
+@pytest.mark.parametrize("seed", [classify.SEED_FROM_IMAGE, 1234])
+def test_seeded_results_are_batch_invariant(tiny_model, images, seed):
+    alone = [classify.predict_with_uncertainty(image_bytes, n_iterations=30, seed=seed) for image_bytes in images]
+
+    for order, batch_size in ((list(range(5)), 5), (list(range(5))[::-1], 5), (list(range(5)), 2)):
+        outputs = classify.predict_batch_with_uncertainty([images[i] for i in order], n_iterations=30,
+                                                          batch_size=batch_size, seed=seed)
+        for i, (result, error) in zip(order, outputs):
+            assert error is None
+            assert result == alone[i], f"image {i} differs in order {order}, batch size {batch_size}"
+
+
+def test_image_seed_depends_on_the_image(tiny_model, images):
+    first, second = (classify.predict_with_uncertainty(image_bytes, seed=classify.SEED_FROM_IMAGE)
+                     for image_bytes in images[:2])
+    assert first["probabilities"] != second["probabilities"]
+
+
+def test_seeded_sampler_is_prefix_stable(tiny_model):
+    features = np.random.default_rng(1).normal(size=(3, FEATURE_DIM)).astype(np.float32)
+    seeds = classify.mc_seeds(["ab" * 32, "cd" * 32, "ef" * 32], classify.SEED_FROM_IMAGE)
+
+    whole = classify.sample_mc_predictions(features, 20, seeds)
+    chunked = np.concatenate([classify.sample_mc_predictions(features, 10, seeds, offset=offset)
+                              for offset in (0, 10)], axis=1)
+    np.testing.assert_array_equal(whole, chunked)
+
+
+def test_unseeded_batches_do_not_fill_the_seeded_feature_cache(tiny_model, images, monkeypatch):
+    prediction_cache = cache.PredictionCache(max_bytes=16 * 1024 * 1024)
+    monkeypatch.setattr(classify, "get_cache", lambda: prediction_cache)
+    fingerprint = classify.get_model_fingerprint()
+
+    classify.predict_batch_with_uncertainty(images[:3], n_iterations=10)
+    for image_bytes in images[:3]:
+        image_hash = cache.hash_bytes(image_bytes)
+        assert prediction_cache.get_features(cache.features_key(image_hash, fingerprint)) is not None
+        assert prediction_cache.get_features(cache.features_key(image_hash, fingerprint, batch_invariant=True)) is None
+
+
+def test_samplers_match_the_keras_dropout_layers(tiny_model):
+    from tensorflow import keras
+
+    keras.utils.set_random_seed(0)
+    features = np.random.default_rng(0).normal(size=(4, FEATURE_DIM)).astype(np.float32)
+    n_iterations = 4000
+
+    # mc_head's own Dropout layers draw an independent mask per row
+    reference = tiny_model.mc_head(np.repeat(features, n_iterations, axis=0)).numpy().reshape(4, n_iterations, -1)
+    fused = classify.sample_mc_predictions(features, n_iterations)
+    seeds = classify.mc_seeds([f"{i:064x}" for i in range(1, 5)], classify.SEED_FROM_IMAGE)
+    seeded = classify.sample_mc_predictions(features, n_iterations, seeds)
+
+    # Five standard errors of the mean: a real mask or scaling bug is far outside it
+    tolerance = 5 * reference.std(axis=1).max() / np.sqrt(n_iterations)
+    for samples in (fused, seeded):
+        assert samples.shape == reference.shape
+        np.testing.assert_allclose(samples.mean(axis=1), reference.mean(axis=1), atol=tolerance)
+        np.testing.assert_allclose(samples.std(axis=1), reference.std(axis=1), atol=tolerance)
+
+
+def test_deterministic_cascade_is_rejected_on_the_savedmodel_runtime(monkeypatch):
+    with pytest.raises(ValueError, match="no deterministic head"):
+        classify.Cascade(fast_iterations=0).check_runtime("savedmodel")
+    classify.Cascade(fast_iterations=4).check_runtime("savedmodel")
+    classify.Cascade(fast_iterations=0).check_runtime("keras")
+
+    # With the cascade on by default, loading such a version fails outright
+    monkeypatch.setattr(classify, "CASCADE_BY_DEFAULT", True)
+    monkeypatch.setattr(classify, "CASCADE_FAST_ITERATIONS", 0)
+    with pytest.raises(ValueError, match="no deterministic head"):
+        classify._load_version(classify.ModelVersion("served", "savedmodel", "/nonexistent"))
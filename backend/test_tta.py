@@ -0,0 +1,21 @@
+"""
+Test-time augmentation: sample counts are reported per view.
+
+    cd backend && python -m pytest -q
+"""
+
+import pytest
+
+pytest.importorskip("numpy")
+
+import classify
+
+
+def test_tta_reports_mc_passes_and_augmentations_apart(tiny_model, png):
+    tta = classify.TestTimeAugmentation("identity,hflip,rot10")
+    result = classify.predict_with_uncertainty(png(), n_iterations=12, seed=classify.SEED_FROM_IMAGE, tta=tta)
+
+    assert result["n_iterations"] == 12
+    assert result["n_augmentations"] == 3
+    assert [view["view"] for view in result["tta"]["per_view"]] == tta.views
+    assert all(view["n_iterations"] == 12 for view in result["tta"]["per_view"])
@@ -0,0 +1,34 @@
+"""
+MC Dropout statistics: the BALD decomposition and the single-image summary.
+
+    cd backend && python -m pytest -q
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import classify
+from uncertainty import compute_statistics
+
+
+def test_predictive_entropy_decomposes():
+    samples = np.random.default_rng(0).dirichlet(np.ones(5), size=(3, 40))
+    statistics = compute_statistics(samples)
+    np.testing.assert_allclose(statistics["predictive_entropy"],
+                               statistics["expected_entropy"] + statistics["mutual_information"], atol=1e-6)
+    assert (statistics["mutual_information"] >= -1e-9).all()
+
+
+def test_identical_samples_carry_no_model_uncertainty():
+    samples = np.tile([0.7, 0.1, 0.1, 0.05, 0.05], (30, 1))
+    result = classify.summarize_predictions(samples, 30, verbose=False)
+    assert result["class_name"] == classify.CLASS_NAMES[0]
+    assert result["n_iterations"] == 30
+    assert result["mutual_information"] == pytest.approx(0.0, abs=1e-6)
+    assert result["variation_ratio"] == 0.0
+
+
+def test_summarize_predictions_checks_the_sample_count():
+    with pytest.raises(ValueError):
+        classify.summarize_predictions(np.full((30, 5), 0.2), 20, verbose=False)
@@ -0,0 +1,39 @@
+"""
+Upload header validation: the magic bytes, the declared size and the pixel mode.
+
+    cd backend && python -m pytest -q
+"""
+
+import pytest
+
+pytest.importorskip("PIL")
+
+import uploads
+
+
+@pytest.mark.parametrize("mode", ["RGB", "L"])
+def test_valid_images_pass(png, mode):
+    assert uploads.check_image_header(png(mode=mode)) is None
+
+
+def test_rejects_files_that_are_not_images():
+    assert uploads.check_image_header(b"%PDF-1.7 not an image")["error"] == "Invalid image"
+
+
+@pytest.mark.parametrize("image_bytes", [
+    pytest.param(b"\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIH", id="truncated-png"),
+    pytest.param(b"BM" + bytes(64), id="zeroed-bmp")
+])
+def test_rejects_corrupt_headers(image_bytes):
+    assert uploads.check_image_header(image_bytes)["error"] == "Invalid image"
+
+
+def test_rejects_16_bit_greyscale(png):
+    rejection = uploads.check_image_header(png(mode="I;16"))
+    assert rejection["error"] == "Unsupported image mode"
+
+
+def test_rejects_images_over_the_pixel_limit(png, monkeypatch):
+    monkeypatch.setattr(uploads, "MAX_IMAGE_PIXELS", 100)
+    assert uploads.check_image_header(png(20, 20))["error"] == "Image too large"
+    assert uploads.check_image_header(png(10, 10)) is None
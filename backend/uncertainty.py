@@ -0,0 +1,133 @@
+"""
+Vectorized uncertainty statistics for MC Dropout samples.
+
+Works on (N images, T samples, C classes) arrays in one pass, or streams
+samples chunk by chunk (Welford / Chan et al. parallel update), so T never
+has to be held in memory.
+
+Metrics per image:
+    mean, std            per-class mean and (population) std of the samples
+    predictive_entropy   H[mean_t p_t]             (total uncertainty)
+    expected_entropy     mean_t H[p_t]             (aleatoric part)
+    mutual_information   predictive - expected     (BALD, epistemic part)
+    variation_ratio      1 - (votes for the modal class) / T
+"""
+
+import numpy as np
+
+EPSILON = 1e-10  # Same log guard as the original per-image entropy
+
+
+def entropy(probabilities, axis=-1):
+    """Shannon entropy (nats) along `axis`."""
+    return -np.sum(probabilities * np.log(probabilities + EPSILON), axis=axis)
+
+
+class MCStatistics:
+    """
+    Streaming statistics for N images, updated with chunks of MC samples.
+
+    Each update() merges a chunk's mean and sum of squared deviations into
+    the running ones (Chan's parallel form of Welford's algorithm), so the
+    result matches a single pass over all samples. Images can be updated
+    independently via `rows`, e.g. only the ones still sampling in
+    adaptive mode.
+    """
+
+    def __init__(self, n_images, n_classes):
+        self.count = np.zeros(n_images, dtype=np.int64)
+        self._mean = np.zeros((n_images, n_classes), dtype=np.float64)
+        self._m2 = np.zeros((n_images, n_classes), dtype=np.float64)
+        self._entropy_sum = np.zeros(n_images, dtype=np.float64)
+        self._votes = np.zeros((n_images, n_classes), dtype=np.int64)
+
+    @classmethod
+    def from_samples(cls, samples):
+        """Statistics of a full (N, T, C) sample array."""
+        samples = np.asarray(samples)
+        stats = cls(samples.shape[0], samples.shape[2])
+        stats.update(samples)
+        return stats
+
+    def update(self, samples, rows=None):
+        """
+        Merge a chunk of samples.
+
+        Args:
+            samples: Array of shape (A, t, C)
+            rows: Indices of the A images being updated (default: all N)
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        rows = np.arange(len(self.count)) if rows is None else np.asarray(rows)
+        n_new = samples.shape[1]
+        if n_new == 0:
+            return
+
+        n_old = self.count[rows][:, None]
+        n_total = n_old + n_new
+
+        chunk_mean = samples.mean(axis=1)
+        chunk_m2 = np.sum((samples - chunk_mean[:, None, :]) ** 2, axis=1)
+        delta = chunk_mean - self._mean[rows]
+
+        self._mean[rows] += delta * (n_new / n_total)
+        self._m2[rows] += chunk_m2 + delta ** 2 * (n_old * n_new / n_total)
+        self.count[rows] = n_total[:, 0]
+
+        self._entropy_sum[rows] += entropy(samples).sum(axis=1)
+        n_classes = samples.shape[2]
+        self._votes[rows] += np.sum(np.argmax(samples, axis=2)[..., None] == np.arange(n_classes), axis=1)
+
+    def _counts(self, rows):
+        count = self.count if rows is None else self.count[rows]
+        return np.maximum(count, 1)
+
+    def _select(self, array, rows):
+        return array if rows is None else array[rows]
+
+    def mean(self, rows=None):
+        return self._select(self._mean, rows)
+
+    def std(self, rows=None):
+        return np.sqrt(self._select(self._m2, rows) / self._counts(rows)[:, None])
+
+    def predictive_entropy(self, rows=None):
+        return entropy(self.mean(rows))
+
+    def expected_entropy(self, rows=None):
+        return self._select(self._entropy_sum, rows) / self._counts(rows)
+
+    def mutual_information(self, rows=None):
+        # Clipped: float rounding can make it a hair negative when samples agree
+        return np.maximum(self.predictive_entropy(rows) - self.expected_entropy(rows), 0.0)
+
+    def variation_ratio(self, rows=None):
+        return 1.0 - self._select(self._votes, rows).max(axis=1) / self._counts(rows)
+
+    def summary(self, rows=None):
+        """All metrics as a dict of arrays (per image, or per selected row)."""
+        return {
+            "n_samples": self._select(self.count, rows),
+            "mean": self.mean(rows),
+            "std": self.std(rows),
+            "predictive_entropy": self.predictive_entropy(rows),
+            "expected_entropy": self.expected_entropy(rows),
+            "mutual_information": self.mutual_information(rows),
+            "variation_ratio": self.variation_ratio(rows)
+        }
+
+
+def compute_statistics(samples):
+    """
+    All metrics for a full sample array in one vectorized pass.
+
+    Args:
+        samples: MC Dropout samples, shape (N, T, C), or (T, C) for one image
+
+    Returns:
+        Dict of arrays, see MCStatistics.summary()
+    """
+    samples = np.asarray(samples)
+    if samples.ndim == 2:
+        samples = samples[np.newaxis]
+    return MCStatistics.from_samples(samples).summary()
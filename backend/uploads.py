@@ -0,0 +1,246 @@
+"""
+Helpers for handling uploaded image files and archives.
+
+check_image_header() validates an image from its header alone (magic
+bytes, declared dimensions and mode) before anything decodes it, so a
+non-image, a decompression bomb or an exotic pixel format is rejected in
+microseconds instead of costing a worker seconds of CPU and gigabytes of RAM.
+"""
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+import metrics
+from classify import MAX_IMAGE_PIXELS
+
+# Allowed image types and per-image size limit
+ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "bmp", "tiff"}
+MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+
+# ✅ Header validation: signature -> PIL format of the allowed types
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"BM", "BMP"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF")
+)
+# Modes preprocess_image() converts to RGB correctly (16-bit "I;16" would be clipped to white)
+SUPPORTED_MODES = {"1", "L", "LA", "P", "PA", "RGB", "RGBA", "RGBX", "CMYK", "YCbCr"}
+
+# Batch limits
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+MAX_BATCH_FILES = int(os.environ.get("BAYESDR_MAX_BATCH_FILES", "500"))
+MAX_ARCHIVE_SIZE = int(os.environ.get("BAYESDR_MAX_ARCHIVE_MB", "512")) * 1024 * 1024
+
+
+def get_extension(filename):
+    """Lower-case file extension without the dot ('' if there is none)."""
+    return filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+
+
+def is_archive(filename):
+    """Whether the filename looks like a supported zip/tar archive."""
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def check_image_file(filename, size):
+    """
+    Validate an image file's name and size.
+
+    Returns:
+        None if the file is acceptable, otherwise a dict with 'error' and 'message'
+    """
+    file_ext = get_extension(filename)
+    if file_ext not in ALLOWED_EXTENSIONS:
+        metrics.UPLOAD_REJECTIONS.inc(reason="extension")
+        return {
+            "error": "Invalid file type",
+            "message": f"Allowed types: {', '.join(ALLOWED_EXTENSIONS).upper()}",
+            "received": file_ext
+        }
+
+    if size == 0:
+        metrics.UPLOAD_REJECTIONS.inc(reason="empty")
+        return {
+            "error": "Empty file",
+            "message": "The uploaded file appears to be empty"
+        }
+
+    if size > MAX_FILE_SIZE:
+        metrics.UPLOAD_REJECTIONS.inc(reason="file_too_large")
+        return {
+            "error": "File too large",
+            "message": f"Maximum file size is 10MB. Your file: {size / (1024*1024):.2f}MB"
+        }
+
+    return None
+
+
+def image_format(image_bytes):
+    """PIL format name from the file's magic bytes, or None if it is not an allowed image type."""
+    for signature, image_format in IMAGE_SIGNATURES:
+        if image_bytes.startswith(signature):
+            return image_format
+    return None
+
+
+def _rejected(reason, error, message):
+    metrics.UPLOAD_REJECTIONS.inc(reason=reason)
+    return {"error": error, "message": message}
+
+
+def check_image_header(image_bytes):
+    """
+    Validate an image from its header, without decoding any pixel data.
+
+    Checks the magic bytes (the extension is only the client's claim), the
+    declared dimensions against MAX_IMAGE_PIXELS and the mode against
+    SUPPORTED_MODES. Rejections are counted by reason.
+
+    Returns:
+        None if the image may be decoded, otherwise a dict with 'error' and 'message'
+    """
+    with metrics.span("validate"):
+        detected = image_format(image_bytes)
+        if detected is None:
+            return _rejected("not_an_image", "Invalid image",
+                             f"The file is not a {', '.join(sorted(ALLOWED_EXTENSIONS)).upper()} image")
+
+        try:
+            # Image.open() only parses the header; pixels are decoded on load()
+            with Image.open(io.BytesIO(image_bytes), formats=[detected]) as img:
+                width, height = img.size
+                mode = img.mode
+        except Image.DecompressionBombError:
+            return _rejected("too_many_pixels", "Image too large",
+                             f"Images may have at most {MAX_IMAGE_PIXELS:,} pixels")
+        except Exception as e:
+            return _rejected("corrupt_header", "Invalid image", f"Could not read the {detected} header: {str(e)}")
+
+        if width <= 0 or height <= 0:
+            return _rejected("corrupt_header", "Invalid image", f"The {detected} header declares a {width}x{height} image")
+
+        if width * height > MAX_IMAGE_PIXELS:
+            return _rejected("too_many_pixels", "Image too large",
+                             f"Images may have at most {MAX_IMAGE_PIXELS:,} pixels. Yours: {width}x{height}")
+
+        if mode not in SUPPORTED_MODES:
+            return _rejected("unsupported_mode", "Unsupported image mode",
+                             f"Pixel mode {mode} is not supported; use 8-bit RGB or grayscale")
+
+    return None
+
+
+def _is_hidden(name):
+    """Skip OS metadata entries such as __MACOSX/ and dotfiles."""
+    parts = name.replace("\\", "/").split("/")
+    return any(part.startswith(".") or part == "__MACOSX" for part in parts if part)
+
+
+def iter_archive(filename, fileobj):
+    """
+    Yield (name, bytes) for every regular file inside a zip or tar archive.
+
+    Entries are read one at a time. Entries larger than MAX_FILE_SIZE are
+    yielded as (name, None) so the caller can report them without reading them.
+    """
+    if filename.lower().endswith(".zip"):
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or _is_hidden(info.filename):
+                    continue
+                if info.file_size > MAX_FILE_SIZE:
+                    yield info.filename, None
+                    continue
+                yield info.filename, archive.read(info)
+    else:
+        with tarfile.open(fileobj=fileobj, mode="r:*") as archive:
+            for member in archive:
+                if not member.isfile() or _is_hidden(member.name):
+                    continue
+                if member.size > MAX_FILE_SIZE:
+                    yield member.name, None
+                    continue
+                yield member.name, archive.extractfile(member).read()
+
+
+def _file_size(fileobj):
+    """Size of a seekable upload stream without reading it."""
+    fileobj.seek(0, 2)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    return size
+
+
+def detach_uploads(files):
+    """
+    Copy uploaded files into spooled temp files owned by the caller.
+
+    Flask closes request files when the view returns, so a streaming
+    response has to keep its own copies. Small files stay in memory,
+    large ones spill to disk; close them when the stream is finished.
+
+    Returns:
+        List of FileStorage objects backed by the copies
+    """
+    detached = []
+    for file in files:
+        copy = tempfile.SpooledTemporaryFile(max_size=MAX_FILE_SIZE)
+        shutil.copyfileobj(file.stream, copy)
+        copy.seek(0)
+        detached.append(FileStorage(stream=copy, filename=file.filename, content_type=file.content_type))
+    return detached
+
+
+def iter_batch_files(files):
+    """
+    Lazily expand uploaded files (images and/or archives) into single images.
+
+    Only one image is held in memory at a time, so this can feed a
+    streaming pipeline of any size.
+
+    Args:
+        files: Iterable of werkzeug FileStorage objects
+
+    Yields:
+        (filename, image_bytes, error) tuples; error is None for files that
+        passed validation, otherwise image_bytes is None.
+
+    Raises:
+        ValueError: If an archive is unreadable or the batch is too large
+    """
+    count = 0
+
+    def entries():
+        for file in files:
+            if file.filename == "":
+                continue
+
+            if is_archive(file.filename):
+                if _file_size(file.stream) > MAX_ARCHIVE_SIZE:
+                    raise ValueError(f"Archive {file.filename} exceeds {MAX_ARCHIVE_SIZE // (1024*1024)}MB")
+                try:
+                    for name, image_bytes in iter_archive(file.filename, file.stream):
+                        size = MAX_FILE_SIZE + 1 if image_bytes is None else len(image_bytes)
+                        yield name, image_bytes, size
+                except (zipfile.BadZipFile, tarfile.TarError) as e:
+                    raise ValueError(f"Could not read archive {file.filename}: {str(e)}")
+            else:
+                image_bytes = file.read(MAX_FILE_SIZE + 1)
+                yield file.filename, image_bytes, len(image_bytes)
+
+    for name, image_bytes, size in entries():
+        count += 1
+        if count > MAX_BATCH_FILES:
+            raise ValueError(f"Too many images in one batch (maximum {MAX_BATCH_FILES})")
+
+        error = check_image_file(name, size) or check_image_header(image_bytes)
+        yield name, None if error else image_bytes, error
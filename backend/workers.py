@@ -0,0 +1,524 @@
+"""
+Multi-process inference worker pool.
+
+Each worker process loads the front process's model versions, with pinned
+TensorFlow intra/inter-op thread counts so that N workers together use
+the machine's cores without oversubscribing them.
+
+The front (Flask) process decodes and preprocesses images directly into
+shared-memory slots and only sends small task tuples to the workers, so
+image tensors are never pickled. Crashed workers are detected and
+restarted; their in-flight requests fail instead of hanging.
+
+Each task names the model version the front process routed it to.
+Workers never load a version for a task: follow() has every worker load a
+newly activated version (or candidate) and the front process only routes
+to it once all of them have (see ModelRegistry.follow()).
+"""
+
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import cache
+import classify
+import metrics
+from classify import IMAGE_SIZE, get_cache, get_registry, hash_bytes, mc_config_tag, preprocess_image, result_key
+
+# ✅ Worker pool configuration (override with environment variables)
+NUM_WORKERS = int(os.environ.get("BAYESDR_WORKERS", "0"))  # 0 = run inference in-process
+INTRA_OP_THREADS = int(os.environ.get("BAYESDR_INTRA_OP_THREADS", "0"))  # 0 = cores / workers
+INTER_OP_THREADS = int(os.environ.get("BAYESDR_INTER_OP_THREADS", "1"))
+SLOTS_PER_WORKER = int(os.environ.get("BAYESDR_SLOTS_PER_WORKER", "8"))
+WORKER_MAX_BATCH = int(os.environ.get("BAYESDR_WORKER_MAX_BATCH", "8"))
+HEALTH_CHECK_INTERVAL = 1.0  # seconds
+# Memory: each worker holds the loaded model version(s) (see BAYESDR_MAX_LOADED_MODELS).
+# The result cache (BAYESDR_CACHE_MB) lives in the front process only; workers run without one.
+
+SLOT_SHAPE = (IMAGE_SIZE[1], IMAGE_SIZE[0], 3)
+
+logger = logging.getLogger(__name__)
+
+
+def _attach_slots(shm_name, n_slots):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slots = np.ndarray((n_slots,) + SLOT_SHAPE, dtype=np.float32, buffer=shm.buf)
+    return shm, slots
+
+
+def _follow(version, role):
+    """Mirror one switch of the front process's registry; returns an error string or None."""
+    try:
+        classify.get_registry().follow(version, role)
+    except Exception as e:
+        logger.error("❌ Could not follow %s model version %s: %s", role, getattr(version, "name", None), e)
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def _worker_main(worker_id, model_path, shm_name, n_slots, tasks, results, intra_threads, inter_threads,
+                 routing, generation):
+    """
+    Worker process: load the front process's versions, then serve tasks until a None sentinel.
+
+    Besides tasks, the queue carries ("follow", generation, version, role)
+    messages, answered with ("followed", ...) once the version is loaded.
+    """
+    # Pin thread pools before TensorFlow creates them
+    os.environ["OMP_NUM_THREADS"] = str(intra_threads)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+
+    metrics.configure_logging()
+    cache.configure(0, "")  # The front process caches results; a copy per worker would only cost memory
+    classify.MODEL_PATH = model_path
+    for role, version in routing:
+        classify.get_registry().follow(version, role)
+
+    shm, slots = _attach_slots(shm_name, n_slots)
+    results.put(("ready", worker_id, os.getpid(), classify.get_startup_timings(), generation))
+
+    try:
+        held = None  # A follow message that ended the previous batch
+        while True:
+            task, held = (held, None) if held is not None else (tasks.get(), None)
+            if task is None:
+                break
+            if task[0] == "follow":
+                _, generation, version, role = task
+                results.put(("followed", worker_id, generation, _follow(version, role)))
+                continue
+
+            # Drain whatever else is already queued into one backbone batch
+            batch = [task]
+            stop = False
+            while len(batch) < WORKER_MAX_BATCH:
+                try:
+                    task = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if task is None:
+                    stop = True
+                    break
+                if task[0] == "follow":
+                    held = task  # Tasks queued before it were routed before the switch
+                    break
+                batch.append(task)
+
+            groups = {}
+            for task in batch:
+                _, _, _, n_iterations, adaptive, seed, tta, cascade, version = task
+                group = (version.name, mc_config_tag(n_iterations, adaptive, tta, cascade), seed)
+                groups.setdefault(group, []).append(task)
+
+            for tasks_in_group in groups.values():
+                n_iterations, adaptive, seed, tta, cascade, version = tasks_in_group[0][3:]
+                prepared = classify.PreparedBatch()
+                prepared.decoded = [(task[0], task[2]) for task in tasks_in_group]
+                prepared.img_batch = slots[[task[1] for task in tasks_in_group]]
+
+                # Stage timings go back to the front process, which owns the metrics
+                trace = metrics.RequestTrace()
+                outputs = []
+                try:
+                    # Loaded when this worker followed the front process; never for a task
+                    loaded = classify.resolve_model(version)
+                except Exception as e:
+                    outputs = [(task[0], None, f"{type(e).__name__}: {e}") for task in tasks_in_group]
+                else:
+                    with metrics.tracing((trace,)), classify.use_model(loaded):
+                        predictions = classify.infer_prepared_batch(
+                            prepared, n_iterations, adaptive, seed, tta, cascade
+                        )
+                        for task_id, result, error in predictions:
+                            error = None if error is None else f"{type(error).__name__}: {error}"
+                            outputs.append((task_id, result, error))
+                results.put(("done", worker_id, outputs, trace.stages))
+
+            if stop:
+                break
+    finally:
+        del slots
+        shm.close()
+
+
+class _Task:
+    __slots__ = ("future", "slot", "image_hash", "result_key", "worker_id", "traces")
+
+    def __init__(self, future, slot, image_hash, result_key):
+        self.future = future
+        self.slot = slot
+        self.image_hash = image_hash
+        self.result_key = result_key
+        self.worker_id = None
+        self.traces = metrics.current_traces()
+
+
+class _Worker:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.tasks = None
+        self.ready = False
+        self.pid = None
+        self.in_flight = set()
+        self.completed = 0
+        self.restarts = 0
+        self.startup = {}
+        self.followed = 0  # Generation of the front process's routing this worker has loaded
+        self.follow_error = None
+
+
+class InferencePool:
+    """
+    Pool of model-holding worker processes behind a submit() -> Future API.
+
+    Args:
+        num_workers: Number of worker processes
+        intra_op_threads: TF intra-op threads per worker (default: cores / workers)
+        inter_op_threads: TF inter-op threads per worker
+        slots_per_worker: Shared-memory image slots per worker (bounds in-flight requests)
+    """
+
+    def __init__(self, num_workers=None, intra_op_threads=None, inter_op_threads=None,
+                 slots_per_worker=SLOTS_PER_WORKER, model_path=None):
+        self.num_workers = max(1, num_workers or NUM_WORKERS or 1)
+        cores = os.cpu_count() or 1
+        self.intra_op_threads = intra_op_threads or INTRA_OP_THREADS or max(1, cores // self.num_workers)
+        self.inter_op_threads = inter_op_threads or INTER_OP_THREADS
+        self.model_path = model_path or classify.MODEL_PATH
+
+        self._ctx = mp.get_context("spawn")
+        self._n_slots = self.num_workers * max(1, slots_per_worker)
+        slot_bytes = int(np.prod(SLOT_SHAPE)) * np.dtype(np.float32).itemsize
+        self._shm = shared_memory.SharedMemory(create=True, size=self._n_slots * slot_bytes)
+        self._slots = np.ndarray((self._n_slots,) + SLOT_SHAPE, dtype=np.float32, buffer=self._shm.buf)
+        self._free_slots = queue.Queue()
+        for slot in range(self._n_slots):
+            self._free_slots.put(slot)
+
+        self._results = self._ctx.Queue()
+        self._workers = [_Worker(worker_id) for worker_id in range(self.num_workers)]
+        self._tasks = {}
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._followed = threading.Condition(self._lock)
+        # Versions each worker loads: the front process's active one and candidate
+        registry = get_registry()
+        self._routing = {"active": registry.version()}
+        if registry.candidate is not None:
+            self._routing["candidate"] = registry.version(registry.candidate)
+        self._generation = 0
+        self._closed = False
+        self._started_at = time.time()
+        self._ready_at = None
+
+        for worker in self._workers:
+            self._spawn(worker)
+
+        self._collector = threading.Thread(target=self._collect_results, name="bayesdr-pool-results", daemon=True)
+        self._collector.start()
+        self._monitor = threading.Thread(target=self._monitor_workers, name="bayesdr-pool-monitor", daemon=True)
+        self._monitor.start()
+
+    def _spawn(self, worker):
+        worker.tasks = self._ctx.Queue()
+        worker.ready = False
+        with self._lock:
+            routing = list(self._routing.items())
+            generation = self._generation
+        worker.process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker.worker_id, self.model_path, self._shm.name, self._n_slots,
+                  worker.tasks, self._results, self.intra_op_threads, self.inter_op_threads,
+                  routing, generation),
+            name=f"bayesdr-worker-{worker.worker_id}",
+            daemon=True
+        )
+        worker.process.start()
+        worker.pid = worker.process.pid
+        logger.info("🚀 Started inference worker %d (pid %d, %d intra-op / %d inter-op threads)",
+                    worker.worker_id, worker.pid, self.intra_op_threads, self.inter_op_threads)
+
+    def follow(self, version, role="active"):
+        """
+        Have every worker load a version and give it `role`, as the front process is about to.
+
+        The registry's preload for the pool (see ModelRegistry.activate()):
+        returns once every worker can serve the version, so the front process
+        never routes a task to a worker that would have to load it first.
+        Workers restarted meanwhile load it on startup.
+
+        Args:
+            version: ModelVersion, or None to clear the candidate
+            role: "active" or "candidate"
+
+        Raises:
+            RuntimeError: If a worker could not load the version
+        """
+        with self._lock:
+            previous = dict(self._routing)
+            if version is None:
+                self._routing.pop(role, None)
+            else:
+                self._routing[role] = version
+                if role == "active" and self._routing.get("candidate") == version:
+                    del self._routing["candidate"]
+            generation = self._send_routing([(role, version)])
+
+            while not self._closed:
+                behind = [w for w in self._workers if w.followed < generation]
+                failed = [w for w in self._workers if w.followed == generation and w.follow_error]
+                if failed:
+                    # The front process does not switch, so neither do the workers that did load it
+                    self._routing = previous
+                    self._send_routing([("candidate", previous.get("candidate")), ("active", previous["active"])])
+                    raise RuntimeError(f"Inference worker {failed[0].worker_id} could not load model version "
+                                       f"{getattr(version, 'name', None)}: {failed[0].follow_error}")
+                if not behind:
+                    return
+                self._followed.wait(timeout=HEALTH_CHECK_INTERVAL)
+        raise RuntimeError("Inference pool is shut down")
+
+    def _send_routing(self, changes):
+        # Caller holds self._lock; returns the generation the workers reach after the changes
+        for role, version in changes:
+            self._generation += 1
+            for worker in self._workers:
+                worker.tasks.put(("follow", self._generation, version, role))
+        return self._generation
+
+    def submit(self, image_bytes, n_iterations=30, adaptive=None, seed=None, tta=None, cascade=None, model=None):
+        """
+        Classify an image on a worker process.
+
+        Cached results are returned without decoding. Otherwise the image is
+        preprocessed in the calling thread straight into a shared-memory slot.
+
+        Returns:
+            concurrent.futures.Future resolving to the predict_with_uncertainty() dict
+        """
+        future = Future()
+        if self._closed:
+            future.set_exception(RuntimeError("Inference pool is shut down"))
+            return future
+
+        cache = get_cache()
+        image_hash = hash_bytes(image_bytes)
+        try:
+            mc_config = mc_config_tag(n_iterations, adaptive, tta, cascade)
+            # Resolved here, so the workers follow the front process's active version
+            version = get_registry().version(model)
+        except ValueError as e:
+            future.set_exception(e)
+            return future
+        key = result_key(image_hash, version.fingerprint, mc_config, seed)
+
+        cached = cache.get_result(key)
+        if cached is not None:
+            metrics.IMAGES.inc(outcome="cached")
+            future.set_result(cached)
+            return future
+
+        # Blocks when every slot is in use: natural backpressure
+        slot = self._free_slots.get()
+        try:
+            preprocess_image(image_bytes, out=self._slots[slot])
+        except Exception as e:
+            self._free_slots.put(slot)
+            metrics.IMAGES.inc(outcome="failed")
+            future.set_exception(e)
+            return future
+
+        task = _Task(future, slot, image_hash, key)
+        with self._lock:
+            task_id = next(self._task_ids)
+            worker = min(
+                (w for w in self._workers if w.process.is_alive()),
+                key=lambda w: (not w.ready, len(w.in_flight)),
+                default=self._workers[0]
+            )
+            task.worker_id = worker.worker_id
+            worker.in_flight.add(task_id)
+            self._tasks[task_id] = task
+            worker.tasks.put((task_id, slot, image_hash, n_iterations, adaptive, seed, tta, cascade, version))
+
+        return future
+
+    def predict(self, image_bytes, n_iterations=30, adaptive=None, seed=None, tta=None, cascade=None, model=None,
+                timeout=None):
+        """Blocking convenience wrapper around submit()."""
+        return self.submit(image_bytes, n_iterations, adaptive, seed, tta, cascade, model).result(timeout=timeout)
+
+    def map_predictions(self, items, n_iterations=30, adaptive=None, window=None, seed=None, tta=None, cascade=None,
+                        model=None):
+        """
+        Classify an iterable of (key, image_bytes) across the pool.
+
+        Keeps at most `window` images in flight (default: all slots).
+
+        Yields:
+            (key, result, error) in submission order
+        """
+        window = window or self._n_slots
+        pending = []
+        for key, image_bytes in items:
+            pending.append((key, self.submit(image_bytes, n_iterations, adaptive, seed, tta, cascade, model)))
+            if len(pending) >= window:
+                yield self._resolve(*pending.pop(0))
+        for key, future in pending:
+            yield self._resolve(key, future)
+
+    @staticmethod
+    def _resolve(key, future):
+        try:
+            return key, future.result(), None
+        except Exception as e:
+            return key, None, e
+
+    def _finish(self, task_id, result=None, error=None):
+        with self._lock:
+            task = self._tasks.pop(task_id, None)
+            if task is None:
+                return
+            worker = self._workers[task.worker_id]
+            worker.in_flight.discard(task_id)
+            worker.completed += 1
+        self._free_slots.put(task.slot)
+        metrics.IMAGES.inc(outcome="computed" if error is None else "failed")
+
+        if error is not None:
+            task.future.set_exception(error if isinstance(error, Exception) else RuntimeError(error))
+        else:
+            get_cache().put_result(task.result_key, result)
+            task.future.set_result(result)
+
+    def _collect_results(self):
+        while not self._closed:
+            try:
+                message = self._results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+
+            kind, worker_id = message[0], message[1]
+            if kind == "ready":
+                with self._lock:
+                    self._workers[worker_id].ready = True
+                    self._workers[worker_id].startup = message[3]
+                    self._workers[worker_id].followed = message[4]
+                    self._workers[worker_id].follow_error = None
+                    if self._ready_at is None:
+                        self._ready_at = time.time()
+                    self._followed.notify_all()
+                logger.info("✅ Inference worker %d ready (pid %d)", worker_id, message[2])
+            elif kind == "followed":
+                with self._lock:
+                    self._workers[worker_id].followed = message[2]
+                    self._workers[worker_id].follow_error = message[3]
+                    self._followed.notify_all()
+            elif kind == "done":
+                outputs, stages = message[2], message[3]
+                with self._lock:
+                    tasks = [self._tasks.get(task_id) for task_id, _, _ in outputs]
+                traces = [trace for task in tasks if task is not None for trace in task.traces]
+                for stage, seconds in stages.items():
+                    metrics.record_stage(stage, seconds, traces)
+                for task_id, result, error in outputs:
+                    self._finish(task_id, result, error)
+
+    def _monitor_workers(self):
+        """Health check: restart crashed workers and fail their in-flight requests."""
+        while not self._closed:
+            time.sleep(HEALTH_CHECK_INTERVAL)
+            for worker in self._workers:
+                if self._closed or worker.process.is_alive():
+                    continue
+
+                exitcode = worker.process.exitcode
+                logger.warning("⚠️  Inference worker %d (pid %d) died with exit code %s, restarting...",
+                               worker.worker_id, worker.pid, exitcode)
+                with self._lock:
+                    lost = list(worker.in_flight)
+                for task_id in lost:
+                    self._finish(task_id, error=RuntimeError(
+                        f"Inference worker crashed (exit code {exitcode}) while processing this image"
+                    ))
+                worker.restarts += 1
+                self._spawn(worker)
+
+    def stats(self):
+        """Per-worker liveness, readiness, load and restart counts."""
+        with self._lock:
+            workers = [{
+                "worker_id": w.worker_id,
+                "pid": w.pid,
+                "alive": w.process.is_alive(),
+                "ready": w.ready,
+                "in_flight": len(w.in_flight),
+                "completed": w.completed,
+                "restarts": w.restarts,
+                "startup": w.startup
+            } for w in self._workers]
+        return {
+            "num_workers": self.num_workers,
+            "ready_workers": sum(1 for w in workers if w["ready"] and w["alive"]),
+            "intra_op_threads": self.intra_op_threads,
+            "inter_op_threads": self.inter_op_threads,
+            "free_slots": self._free_slots.qsize(),
+            "total_slots": self._n_slots,
+            "uptime_s": round(time.time() - self._started_at, 1),
+            # Pool creation until the first worker could serve
+            "time_to_ready_s": round(self._ready_at - self._started_at, 3) if self._ready_at else None,
+            "workers": workers
+        }
+
+    @property
+    def ready(self):
+        return any(w.ready and w.process.is_alive() for w in self._workers)
+
+    def shutdown(self, timeout=5.0):
+        """Stop the workers and release the shared memory."""
+        if self._closed:
+            return
+        self._closed = True
+        for worker in self._workers:
+            try:
+                worker.tasks.put(None)
+            except Exception:
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        with self._lock:
+            pending = list(self._tasks.values())
+            self._tasks.clear()
+        for task in pending:
+            task.future.set_exception(RuntimeError("Inference pool is shut down"))
+        del self._slots
+        self._shm.close()
+        self._shm.unlink()
+
+
+# Global pool instance
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Get the shared InferencePool, starting NUM_WORKERS workers on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = InferencePool()
+    return _pool
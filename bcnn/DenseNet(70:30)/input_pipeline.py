@@ -0,0 +1,379 @@
+"""
+tf.data input pipeline for training and evaluating the BCNN.
+
+Replaces ImageDataGenerator.flow_from_dataframe in BCNN.ipynb with the same
+data, splits and augmentations, built so DenseNet121 is not left waiting
+on input:
+
+- images are decoded and resized to 224x224 once, in parallel, and cached
+  as uint8 TFRecord shards (<cache_dir>/<split>-NNNNN-of-NNNNN.tfrecord);
+  later epochs and runs only read the shards
+- records are parsed, rescaled and augmented a whole batch at a time
+  (rotation, shift, shear, zoom and flip are folded into one projective
+  transform per image)
+- batches are prefetched while the model trains on the previous one
+
+Splits are the notebook's: shuffle with random_state=42, then stratified
+train_test_split into 70/15/15. The image listing is sorted first, so the
+split is the same on every machine.
+
+From the notebook:
+
+    from input_pipeline import load_image_index, split_dataset, make_dataset
+    df = load_image_index("dataset/colored_images")
+    train_df, val_df, test_df = split_dataset(df)
+    train_ds = make_dataset(train_df, "dataset/colored_images", training=True, cache_dir="cache", name="train")
+    val_ds = make_dataset(val_df, "dataset/colored_images", cache_dir="cache", name="val")
+
+Build the caches and measure input throughput on its own:
+
+    python input_pipeline.py --images dataset/colored_images --cache-dir cache
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from sklearn.model_selection import train_test_split
+
+CLASS_NAMES = ["No_DR", "Mild", "Moderate", "Severe", "Proliferate_DR"]
+IMAGE_SIZE = (224, 224)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tiff")
+
+SPLIT_SEED = 42
+# flow_from_dataframe resizes with nearest neighbour; keep it for parity
+# with the trained model (the Kaggle images are already 224x224)
+INTERPOLATION = "nearest"
+
+CACHE_VERSION = 1
+DEFAULT_SHARDS = 8
+SHUFFLE_BUFFER = 4096
+
+
+class Augmentation:
+    """
+    Random affine augmentation settings, with ImageDataGenerator's meaning.
+
+    rotation_range and shear_range are in degrees, shifts are fractions of
+    the width/height, zoom draws x and y scales independently from
+    [1 - zoom_range, 1 + zoom_range]. The defaults are the notebook's.
+    """
+
+    def __init__(self, rotation_range=20, width_shift_range=0.2, height_shift_range=0.2, shear_range=0.2,
+                 zoom_range=0.2, horizontal_flip=True, fill_mode="nearest"):
+        self.rotation_range = float(rotation_range)
+        self.width_shift_range = float(width_shift_range)
+        self.height_shift_range = float(height_shift_range)
+        self.shear_range = float(shear_range)
+        self.zoom_range = float(zoom_range)
+        self.horizontal_flip = bool(horizontal_flip)
+        self.fill_mode = fill_mode.upper()
+
+        if self.fill_mode not in ("NEAREST", "REFLECT", "WRAP", "CONSTANT"):
+            raise ValueError("fill_mode must be one of: nearest, reflect, wrap, constant")
+        if not 0 <= self.zoom_range < 1:
+            raise ValueError("zoom_range must be in [0, 1)")
+
+
+def load_image_index(image_dir, seed=SPLIT_SEED):
+    """
+    List a class-folder image directory (<image_dir>/<class>/<image>).
+
+    Returns:
+        DataFrame with filename (relative to image_dir) and label columns,
+        shuffled with random_state=seed as in the notebook
+    """
+    filenames, labels = [], []
+    for label in sorted(os.listdir(image_dir)):
+        class_dir = os.path.join(image_dir, label)
+        if label not in CLASS_NAMES or not os.path.isdir(class_dir):
+            continue
+        for name in sorted(os.listdir(class_dir)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                filenames.append(os.path.join(label, name))
+                labels.append(label)
+
+    df = pd.DataFrame({"filename": filenames, "label": labels})
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def split_dataset(df, seed=SPLIT_SEED, test_size=0.30):
+    """
+    Stratified train/val/test split, as in the notebook (70/15/15).
+
+    Returns:
+        Tuple of (train_df, val_df, test_df)
+    """
+    train_df, temp_df = train_test_split(df, test_size=test_size, random_state=seed, stratify=df["label"])
+    val_df, test_df = train_test_split(temp_df, test_size=0.50, random_state=seed, stratify=temp_df["label"])
+    return train_df, val_df, test_df
+
+
+def _label_indices(df):
+    index = {name: i for i, name in enumerate(CLASS_NAMES)}
+    return np.array([index[label] for label in df["label"]], dtype=np.int64)
+
+
+def _decode_image(path, label):
+    """Read, decode and resize one image to a uint8 (224, 224, 3) tensor."""
+    image = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    image = tf.image.resize(image, IMAGE_SIZE, method=INTERPOLATION)
+    image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+    return tf.ensure_shape(image, IMAGE_SIZE + (3,)), label
+
+
+def _decoded_images(df, image_dir):
+    """Dataset of (uint8 image, label index) in df order, decoded in parallel."""
+    paths = [os.path.join(image_dir, filename) for filename in df["filename"]]
+    ds = tf.data.Dataset.from_tensor_slices((paths, _label_indices(df)))
+    return ds.map(_decode_image, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+
+
+def _cache_fingerprint(df, image_dir):
+    """Changes whenever the listed files, their labels or their contents change."""
+    digest = hashlib.sha256(f"v{CACHE_VERSION}:{IMAGE_SIZE}:{INTERPOLATION}".encode())
+    for filename, label in zip(df["filename"], df["label"]):
+        stat = os.stat(os.path.join(image_dir, filename))
+        digest.update(f"\n{filename}\t{label}\t{stat.st_size}\t{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def cache_split(df, image_dir, cache_dir, name, num_shards=DEFAULT_SHARDS):
+    """
+    Decode a split once into TFRecord shards, unless an up-to-date cache exists.
+
+    Shards hold contiguous runs of df's rows, so reading them in order gives
+    back df's order. <name>.json is written last and marks the cache as
+    complete; a cache for a different file list is rebuilt.
+
+    Returns:
+        List of shard paths, in row order
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_path = os.path.join(cache_dir, f"{name}.json")
+    fingerprint = _cache_fingerprint(df, image_dir)
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        shards = [os.path.join(cache_dir, shard) for shard in manifest["shards"]]
+        if manifest.get("fingerprint") == fingerprint and all(os.path.exists(shard) for shard in shards):
+            return shards
+        os.remove(manifest_path)
+
+    num_shards = max(1, min(num_shards, len(df)))
+    per_shard = math.ceil(len(df) / num_shards)
+    num_shards = math.ceil(len(df) / per_shard)
+    names = [f"{name}-{i:05d}-of-{num_shards:05d}.tfrecord" for i in range(num_shards)]
+
+    print(f"📦 Caching {len(df)} {name} images into {num_shards} shards under {cache_dir}...")
+    started = time.perf_counter()
+    writer = None
+    for row, (image, label) in enumerate(_decoded_images(df, image_dir).as_numpy_iterator()):
+        if row % per_shard == 0:
+            if writer is not None:
+                writer.close()
+            writer = tf.io.TFRecordWriter(os.path.join(cache_dir, names[row // per_shard]))
+        example = tf.train.Example(features=tf.train.Features(feature={
+            "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+            "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)]))
+        }))
+        writer.write(example.SerializeToString())
+    if writer is not None:
+        writer.close()
+
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({
+            "version": CACHE_VERSION,
+            "fingerprint": fingerprint,
+            "count": len(df),
+            "image_size": list(IMAGE_SIZE),
+            "shards": names,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+        }, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    print(f"✅ Cached {name} in {time.perf_counter() - started:.1f}s")
+
+    return [os.path.join(cache_dir, shard) for shard in names]
+
+
+_RECORD_SPEC = {
+    "image": tf.io.FixedLenFeature([], tf.string),
+    "label": tf.io.FixedLenFeature([], tf.int64)
+}
+
+
+def _parse_records(records):
+    """Parse a batch of serialized records into uint8 images and label indices."""
+    parsed = tf.io.parse_example(records, _RECORD_SPEC)
+    images = tf.io.decode_raw(parsed["image"], tf.uint8)
+    images = tf.reshape(images, [-1, IMAGE_SIZE[0], IMAGE_SIZE[1], 3])
+    return images, parsed["label"]
+
+
+def augment_batch(images, seed, augmentation):
+    """
+    Apply a random affine transform to every image of a batch in one op.
+
+    Args:
+        images: float32 (B, H, W, 3) batch
+        seed: int64 shape-(2,) stateless seed for the batch
+        augmentation: Augmentation settings
+
+    Returns:
+        Augmented float32 batch of the same shape
+    """
+    batch = tf.shape(images)[0]
+    height = tf.cast(tf.shape(images)[1], tf.float32)
+    width = tf.cast(tf.shape(images)[2], tf.float32)
+    seeds = tf.random.experimental.stateless_split(seed, num=7)
+
+    def uniform(i, limit, center=0.0):
+        return tf.random.stateless_uniform([batch], seed=seeds[i], minval=center - limit, maxval=center + limit)
+
+    theta = uniform(0, augmentation.rotation_range * math.pi / 180)
+    shear = uniform(1, augmentation.shear_range * math.pi / 180)
+    zoom_x = uniform(2, augmentation.zoom_range, center=1.0)
+    zoom_y = uniform(3, augmentation.zoom_range, center=1.0)
+    shift_x = uniform(4, augmentation.width_shift_range) * width
+    shift_y = uniform(5, augmentation.height_shift_range) * height
+    if augmentation.horizontal_flip:
+        flip = tf.where(tf.random.stateless_uniform([batch], seed=seeds[6]) < 0.5, -1.0, 1.0)
+    else:
+        flip = tf.ones([batch])
+
+    # Output pixel p maps to input pixel R·S·Z·F·(p - c) + c + shift
+    cos, sin = tf.cos(theta), tf.sin(theta)
+    a00 = cos * zoom_x * flip
+    a01 = (-cos * tf.sin(shear) - sin * tf.cos(shear)) * zoom_y
+    a10 = sin * zoom_x * flip
+    a11 = (-sin * tf.sin(shear) + cos * tf.cos(shear)) * zoom_y
+    cx, cy = (width - 1) / 2, (height - 1) / 2
+    a02 = cx + shift_x - (a00 * cx + a01 * cy)
+    a12 = cy + shift_y - (a10 * cx + a11 * cy)
+    zeros = tf.zeros([batch])
+    transforms = tf.stack([a00, a01, a02, a10, a11, a12, zeros, zeros], axis=1)
+
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=transforms,
+        output_shape=tf.shape(images)[1:3],
+        fill_value=0.0,
+        interpolation="BILINEAR",
+        fill_mode=augmentation.fill_mode
+    )
+
+
+def make_dataset(df, image_dir, training=False, batch_size=32, cache_dir=None, name=None, augmentation=None,
+                 seed=None, num_shards=DEFAULT_SHARDS):
+    """
+    Build a batched, prefetched dataset of (images, one-hot labels).
+
+    Images are rescaled to [0, 1] (rescale=1./255). Training datasets are
+    reshuffled and augmented every epoch; evaluation datasets keep df's
+    order, so predictions line up with df's rows.
+
+    Args:
+        df: DataFrame with filename and label columns (see load_image_index())
+        image_dir: Directory the filenames are relative to
+        training: Shuffle and augment
+        batch_size: Images per batch
+        cache_dir: Cache decoded images here as TFRecord shards (recommended);
+                   None decodes the files every epoch
+        name: Cache name for this split, e.g. "train" (required with cache_dir)
+        augmentation: Augmentation settings; default Augmentation() when training
+        seed: Seed for shuffling and augmentation; None = different every run
+        num_shards: Shards to write when building the cache
+
+    Returns:
+        tf.data.Dataset with a known length (len(ds) == number of batches)
+    """
+    if cache_dir is not None and not name:
+        raise ValueError("A cache name is needed with cache_dir, e.g. name='train'")
+    if training and augmentation is None:
+        augmentation = Augmentation()
+
+    if cache_dir is not None:
+        shards = cache_split(df, image_dir, cache_dir, name, num_shards)
+        # Parallel reads interleave the shards; evaluation reads them in order
+        ds = tf.data.TFRecordDataset(shards, num_parallel_reads=tf.data.AUTOTUNE if training else None)
+        if training:
+            ds = ds.shuffle(min(len(df), SHUFFLE_BUFFER), seed=seed, reshuffle_each_iteration=True)
+        ds = ds.batch(batch_size).map(_parse_records, num_parallel_calls=tf.data.AUTOTUNE)
+    else:
+        paths = [os.path.join(image_dir, filename) for filename in df["filename"]]
+        ds = tf.data.Dataset.from_tensor_slices((paths, _label_indices(df)))
+        if training:
+            ds = ds.shuffle(len(df), seed=seed, reshuffle_each_iteration=True)
+        ds = ds.map(_decode_image, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not training)
+        ds = ds.batch(batch_size)
+
+    def to_inputs(images, labels):
+        return tf.cast(images, tf.float32) * (1.0 / 255), tf.one_hot(labels, len(CLASS_NAMES))
+
+    if training and augmentation is not None:
+        def augmented_inputs(batch, batch_seed):
+            images, labels = to_inputs(*batch)
+            return augment_batch(images, tf.stack([batch_seed, tf.constant(0, tf.int64)]), augmentation), labels
+
+        seeds = tf.data.Dataset.random(seed=seed, rerandomize_each_iteration=True)
+        ds = tf.data.Dataset.zip((ds, seeds)).map(augmented_inputs, num_parallel_calls=tf.data.AUTOTUNE)
+    else:
+        ds = ds.map(to_inputs, num_parallel_calls=tf.data.AUTOTUNE)
+
+    ds = ds.apply(tf.data.experimental.assert_cardinality(math.ceil(len(df) / batch_size)))
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+def make_datasets(image_dir, cache_dir=None, batch_size=32, seed=None):
+    """
+    The notebook's three splits as datasets.
+
+    Returns:
+        Dict with train_df/val_df/test_df and train/val/test datasets
+    """
+    train_df, val_df, test_df = split_dataset(load_image_index(image_dir))
+    return {
+        "train_df": train_df,
+        "val_df": val_df,
+        "test_df": test_df,
+        "train": make_dataset(train_df, image_dir, training=True, batch_size=batch_size, cache_dir=cache_dir,
+                              name="train", seed=seed),
+        "val": make_dataset(val_df, image_dir, batch_size=batch_size, cache_dir=cache_dir, name="val"),
+        "test": make_dataset(test_df, image_dir, batch_size=batch_size, cache_dir=cache_dir, name="test")
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the tf.data caches and measure input throughput")
+    parser.add_argument("--images", default="dataset/colored_images", help="Class-folder image directory")
+    parser.add_argument("--cache-dir", help="TFRecord cache directory (default: decode every epoch)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=2, help="Training epochs to time")
+    parser.add_argument("--seed", type=int, help="Shuffle/augmentation seed")
+    args = parser.parse_args(argv)
+
+    datasets = make_datasets(args.images, args.cache_dir, args.batch_size, args.seed)
+    for split in ("train", "val", "test"):
+        print(f"   {split}: {len(datasets[split + '_df'])} images, {len(datasets[split])} batches")
+
+    for epoch in range(args.epochs):
+        started = time.perf_counter()
+        images = 0
+        for batch, _ in datasets["train"]:
+            images += int(batch.shape[0])
+        elapsed = time.perf_counter() - started
+        print(f"⏱️  Epoch {epoch + 1}: {images} training images in {elapsed:.2f}s "
+              f"({images / max(elapsed, 1e-9):.1f} img/s)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())